@@ -0,0 +1,91 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Aggregate mode (MQTT_AGGREGATE): collect the values of all devices read in one READ_RATE burst
+- Publish them as one document (MQTT_ENCODING) when ReadRateTimer sees all devices released:
+  {"timestamp": <SYNC_TIMESTAMP of burst>, "<name>": {<values>}, ...}
+"""
+
+import threading
+
+# Local imports
+import payload
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+
+class BurstAggregator:
+  """
+  Collect values per device (from all worker threads) and publish them once per burst
+  """
+  def __init__(self, t_mqtt, topic, encoding="json"):
+    """
+    Args:
+      :param mqtt.MQTTClient t_mqtt:
+      :param str topic: topic of aggregated document
+      :param str encoding: MQTT_ENCODING
+
+    Returns:
+      None
+    """
+    logger.debug(f">> topic = {topic}")
+    self.__t_mqtt = t_mqtt
+    self.__topic = topic
+    self.__encoding = encoding
+    self.__lock = threading.Lock()
+
+    # name:values of devices read in current burst
+    self.__burst = dict()
+
+    logger.debug("<<")
+    return
+
+  def add(self, name, values):
+    """
+    Add values of a device to current burst
+
+    :param str name: device name
+    :param dict values: values to publish; timestamp is replaced by timestamp of burst
+    :return: None
+    """
+    with self.__lock:
+      self.__burst[name] = {key: value for key, value in values.items() if key != "timestamp"}
+
+  def publish(self, ts):
+    """
+    Publish current burst; called by ReadRateTimer when all devices have released the cycle
+
+    :param int ts: timestamp of burst
+    :return: None
+    """
+    with self.__lock:
+      burst = self.__burst
+      self.__burst = dict()
+
+    if not burst:
+      return
+
+    burst["timestamp"] = ts
+    message = payload.encode(burst, self.__encoding)
+    self.__t_mqtt.do_publish(self.__topic, message, retain=False)
+    logger.debug("Published burst of %s devices", len(burst) - 1)
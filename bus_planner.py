@@ -0,0 +1,289 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Estimate MBUS bus utilisation of a configuration (startup check and tools/kamstrup-bus-planner.py)
+- Derate READ_RATE and read_rate when estimated utilisation is too high (MBUS_PLANNER_POLICY)
+- BusGovernor: measure actual bus occupancy and stretch read intervals when bus is overloaded
+
+Estimate of one transaction (EN 13757-2):
+- Every character is 11 bits (start, 8 data, parity, stop)
+- Device answers within 330 bit times + 50ms
+- SND_NKE (5 chars) + ACK (1 char), only when link is initialised before every read (MBUS_PING_MODE)
+- REQ_UD2 (5 chars) + RSP_UD (long frame; length depends on model)
+- Multi telegram readout: REQ_UD2 + RSP_UD for every telegram (max_telegrams; worst case)
+"""
+
+import threading
+import time
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+BITS_PER_CHAR = 11
+SHORT_FRAME_LENGTH = 5
+ACK_LENGTH = 1
+
+# Max long frame; used when model of device is unknown
+MAX_FRAME_LENGTH = 261
+
+# Length of RSP_UD long frame per model (bytes); standard readout of a single telegram
+# Measured with tools/kamstrup_sim.py telegrams; a device logs its observed length when it differs
+FRAME_LENGTH = {
+  'MC303': 144,
+  'MC601': 96,
+}
+
+
+def frame_length(device, frame_lengths=None):
+  """
+  Estimated length of RSP_UD long frame of a device
+
+  :param dict device: entry of MBUS_KAMSTRUP_DEVICES
+  :param dict frame_lengths: name:length; observed frame lengths, override model defaults
+  :return: bytes
+  :rtype: int
+  """
+  frame_lengths = frame_lengths or dict()
+  return frame_lengths.get(device['name'], FRAME_LENGTH.get(device.get('model'), MAX_FRAME_LENGTH))
+
+
+def response_delay(baudrate):
+  """
+  Max time between end of request and start of response
+
+  :param int baudrate:
+  :return: seconds
+  :rtype: float
+  """
+  return 330 / baudrate + 0.05
+
+
+def transaction_time(baudrate, frame_length, ping):
+  """
+  Estimate bus time of reading one device
+
+  :param int baudrate:
+  :param int frame_length: length of RSP_UD long frame (bytes)
+  :param bool ping: link is initialised (SND_NKE) before request
+  :return: seconds
+  :rtype: float
+  """
+  chars = SHORT_FRAME_LENGTH + frame_length
+  t = response_delay(baudrate)
+  if ping:
+    chars += SHORT_FRAME_LENGTH + ACK_LENGTH
+    t += response_delay(baudrate)
+
+  return t + chars * BITS_PER_CHAR / baudrate
+
+
+def estimate(buses, devices, read_rate, ping_mode, frame_lengths=None):
+  """
+  Estimate utilisation per bus
+
+  Args:
+    :param dict buses: MBUS_BUSES
+    :param list devices: MBUS_KAMSTRUP_DEVICES
+    :param int read_rate: READ_RATE
+    :param str ping_mode: MBUS_PING_MODE
+    :param dict frame_lengths: name:length; observed frame lengths, override model defaults
+
+  Returns:
+    :rtype: dict
+    :return: bus:{'utilisation': float, 'burst_time': float, 'devices': [dict]}; per device
+             name, model, frame_length, transaction_time, read_rate and free_running
+  """
+  default_bus = next(iter(buses))
+
+  report = {bus: {'utilisation': 0.0, 'burst_time': 0.0, 'devices': list()} for bus in buses}
+  for device in devices:
+    bus = device.get('bus', default_bus)
+    model = device.get('model')
+    length = frame_length(device, frame_lengths)
+    t = transaction_time(buses[bus]['baudrate'], length, ping_mode != "adaptive")
+    t += (device.get('max_telegrams', 1) - 1) * transaction_time(buses[bus]['baudrate'], length, False)
+    rate = device.get('read_rate') or read_rate
+
+    report[bus]['devices'].append({'name': device['name'],
+                                   'model': model,
+                                   'frame_length': length,
+                                   'transaction_time': t,
+                                   'read_rate': rate,
+                                   'free_running': bool(device.get('read_rate'))})
+    report[bus]['utilisation'] += t * rate / 3600
+    if not device.get('read_rate'):
+      report[bus]['burst_time'] += t
+
+  return report
+
+
+def derate(report, read_rate, max_utilisation):
+  """
+  Lower read rates so that utilisation of every bus is at most max_utilisation
+  All read rates on a bus are lowered by same factor; READ_RATE is shared by all buses,
+  and is lowered by factor of worst bus
+
+  Args:
+    :param dict report: as returned by estimate()
+    :param int read_rate: READ_RATE
+    :param float max_utilisation:
+
+  Returns:
+    :rtype: tuple
+    :return: (READ_RATE, {name: read_rate}) of free running devices
+  """
+  factors = {bus: max(1.0, r['utilisation'] / max_utilisation) for bus, r in report.items()}
+  device_rates = dict()
+  for bus, r in report.items():
+    for device in r['devices']:
+      if device['free_running']:
+        device_rates[device['name']] = device['read_rate'] / factors[bus]
+
+  return read_rate / max(factors.values(), default=1.0), device_rates
+
+
+def format_report(report, max_utilisation):
+  """
+  Human readable report
+
+  :param dict report: as returned by estimate()
+  :param float max_utilisation:
+  :return: lines
+  :rtype: list
+  """
+  lines = list()
+  for bus, r in report.items():
+    status = "OK" if r['utilisation'] <= max_utilisation else "OVERLOADED"
+    lines.append(f"{bus}: utilisation = {round(100 * r['utilisation'], 1)}% "
+                 f"(max {round(100 * max_utilisation)}%); burst = {round(r['burst_time'], 2)} s; {status}")
+    for device in r['devices']:
+      lines.append(f"  {device['name']}: model = {device['model']}; frame = {device['frame_length']} bytes; "
+                   f"read = {round(device['transaction_time'], 2)} s; "
+                   f"read_rate = {device['read_rate']}{'' if device['free_running'] else ' (READ_RATE)'}")
+
+  return lines
+
+
+def check(buses, devices, read_rate, ping_mode, max_utilisation, policy):
+  """
+  Startup check of configuration (MBUS_PLANNER_POLICY)
+  - "warn": log a warning when a bus is overloaded
+  - "derate": lower READ_RATE and read_rate of overloaded buses
+  - "refuse": raise ValueError when a bus is overloaded
+
+  Args:
+    :param dict buses: MBUS_BUSES
+    :param list devices: MBUS_KAMSTRUP_DEVICES
+    :param int read_rate: READ_RATE
+    :param str ping_mode: MBUS_PING_MODE
+    :param float max_utilisation: MBUS_MAX_UTILISATION
+    :param str policy: MBUS_PLANNER_POLICY
+
+  Returns:
+    :rtype: tuple
+    :return: (READ_RATE, {name: read_rate}) to be used
+  """
+  logger.debug(f">> policy = {policy}")
+
+  report = estimate(buses, devices, read_rate, ping_mode)
+  device_rates = {device['name']: device['read_rate'] for device in devices if device.get('read_rate')}
+
+  for line in format_report(report, max_utilisation):
+    logger.info(line)
+
+  overloaded = [bus for bus, r in report.items() if r['utilisation'] > max_utilisation]
+  if not overloaded:
+    return read_rate, device_rates
+
+  if policy == "refuse":
+    raise ValueError(f"Bus(es) {', '.join(overloaded)} overloaded; lower READ_RATE/read_rate or number of devices")
+
+  if policy == "derate":
+    read_rate, device_rates = derate(report, read_rate, max_utilisation)
+    logger.warning(f"Bus(es) {', '.join(overloaded)} overloaded; derated READ_RATE = {round(read_rate, 1)}; "
+                   f"read_rate = {({name: round(rate, 1) for name, rate in device_rates.items()})}")
+  else:
+    logger.warning(f"Bus(es) {', '.join(overloaded)} overloaded; reads will be late or skipped")
+
+  return read_rate, device_rates
+
+
+class BusGovernor:
+  """
+  Measure occupancy of a bus (time the bus is held, see MBusSession.busy_time) and
+  return a stretch factor for read intervals, to keep utilisation at max_utilisation
+  Shared by all threads reading the bus
+  """
+
+  # Seconds over which occupancy is measured
+  WINDOW = 60
+
+  def __init__(self, bus, mbus_session, max_utilisation):
+    """
+    Args:
+      :param str bus: name of bus
+      :param MBusSession mbus_session:
+      :param float max_utilisation: MBUS_MAX_UTILISATION
+
+    Returns:
+      None
+    """
+    logger.debug(f">> {bus}")
+    self.__bus = bus
+    self.__mbus_session = mbus_session
+    self.__max_utilisation = max_utilisation
+    self.__lock = threading.Lock()
+
+    # Read intervals are multiplied by stretch; never below 1
+    self.__stretch = 1.0
+
+    # Start of measurement window
+    self.__window_time = time.monotonic()
+    self.__window_busy = mbus_session.busy_time
+
+    logger.debug("<<")
+    return
+
+  def stretch(self):
+    """
+    Stretch factor for read intervals; updated once per WINDOW
+
+    :return: factor >= 1
+    :rtype: float
+    """
+    with self.__lock:
+      now = time.monotonic()
+      if now - self.__window_time < self.WINDOW:
+        return self.__stretch
+
+      busy = self.__mbus_session.busy_time
+      utilisation = (busy - self.__window_busy) / (now - self.__window_time)
+      self.__window_time = now
+      self.__window_busy = busy
+
+      stretch = max(1.0, self.__stretch * utilisation / self.__max_utilisation)
+      if abs(stretch - self.__stretch) > 0.05 * self.__stretch:
+        logger.info(f"{self.__bus}: utilisation = {round(100 * utilisation, 1)}%; "
+                    f"read intervals stretched by {round(stretch, 2)}")
+      self.__stretch = stretch
+
+      return self.__stretch
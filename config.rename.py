@@ -1,5 +1,6 @@
 """
   Rename to config.py
+  Settings missing in an older config.py get the default of this file (config_defaults.py)
 
   Configure:
   - MQTT client
@@ -15,9 +16,8 @@ import serial
 loglevel = "INFO"
 
 # NROF parameter reads from power meter per hour (60 equals every minute)
-# If rate is too high for numer of devices connected, parser might "collapse"
-# No safety checks build in for too high read_rate
-# You have to balance nrof devices, baud-rate and READ_RATE
+# If rate is too high for numer of devices connected, reads will be late or skipped
+# You have to balance nrof devices, baud-rate and READ_RATE (see MBUS_PLANNER_POLICY)
 # With a baud-rate of 2400, reading one device takes about 1.3 seconds
 READ_RATE = 60  # Every minute
 
@@ -36,26 +36,125 @@ MQTT_PASSWORD = "secret"
 MQTT_RATE = 100
 MQTT_TOPIC_PREFIX = "kamstrup"
 
+# Bounded queue between meter threads and MQTT client; 0 is no queue (publish directly to paho)
+# Messages are handed to the MQTT client when connected (or spooled, see MQTT_SPOOL_DIR)
+# MQTT_QUEUE_POLICY when queue is full:
+# "block": meter thread waits (max MQTT_QUEUE_BLOCK_TIMEOUT seconds, then message is dropped)
+# "drop-oldest" or "drop-newest": drop oldest or new message
+# "coalesce": per topic only latest message is queued (no stale readings after reconnect); when full, drop oldest
+MQTT_QUEUE_SIZE = 1000
+MQTT_QUEUE_POLICY = "drop-oldest"
+MQTT_QUEUE_BLOCK_TIMEOUT = 5
+
+# Store-and-forward while disconnected from MQTT broker
+# When set, messages are stored in bounded segment files in this directory instead of in memory,
+# and survive a restart; after reconnect they are published (unchanged, with original timestamp),
+# at most MQTT_SPOOL_DRAIN_RATE messages per second. When full, oldest messages are dropped
+MQTT_SPOOL_DIR = None  # eg "/var/spool/kamstrup-mqtt"
+MQTT_SPOOL_MAX_BYTES = 16 * 1024 * 1024
+MQTT_SPOOL_SEGMENT_BYTES = 1024 * 1024
+MQTT_SPOOL_DRAIN_RATE = 20
+
+# Encoding of MQTT payloads with values: "json", "msgpack" or "cbor"
+# msgpack and cbor are more compact, and require python package msgpack or cbor2
+MQTT_ENCODING = "json"
+
+# Counter (nrof successful reads since start of parser) per device
+# "topic": publish to <MQTT_TOPIC_PREFIX>/<name>/counter, at most every MQTT_COUNTER_INTERVAL seconds (0 is every read)
+# "payload": add key "counter" to the JSON values of the device
+#            with MQTT_CHANGE_ONLY, counter is published along with changed values; it is not a change by itself
+MQTT_COUNTER_MODE = "topic"
+MQTT_COUNTER_INTERVAL = 300
+
+# Status ("power on"/"power off", retained) per device is published when it changes,
+# and refreshed every MQTT_STATUS_INTERVAL seconds (0 is only when it changes)
+MQTT_STATUS_INTERVAL = 3600
+
+# Aggregate mode
+# When True, values of all devices read in one READ_RATE burst are published as one JSON document
+# to <MQTT_TOPIC_PREFIX>/burst, keyed by device name, with the timestamp of the burst (see SYNC_TIMESTAMP)
+# Devices with own read_rate are published to their own topic
+MQTT_AGGREGATE = False
+
+# Change-only publishing
+# When True, only values which changed more than their deadband since last published are published
+# (with timestamp); telegram is not published when nothing has changed
+MQTT_CHANGE_ONLY = False
+
+# Deadband per JSON key; absolute value (eg 0.05) or relative to last published value (eg "1%")
+# Keys not listed are published on every change
+MQTT_DEADBAND = {
+  'FLOW_TEMPERATURE': 0.05,
+  'RETURN_TEMPERATURE': 0.05,
+  'TEMPERATURE_DIFFERENCE': 0.05,
+  'POWER_W': "1%",
+  'VOLUME_FLOW': "1%",
+}
+
+# Publish all values (keyframe) every MQTT_KEYFRAME_CYCLES reads or every MQTT_KEYFRAME_INTERVAL seconds,
+# whichever comes first; 0 is disabled
+MQTT_KEYFRAME_CYCLES = 60
+MQTT_KEYFRAME_INTERVAL = 3600
+
 # [ MBUS/meterbus ]
 # Depends on your MBUS USB dongle
-# Assumption is there is only one MBUS bus with optionally multiple Kamstrup Multicals
-# All devices need to have same serial settings
+# One or more named MBUS buses (eg one per MBUS USB dongle), each with optionally multiple Kamstrup Multicals
+# Buses are read in parallel; devices on same bus are read one at a time
+# All devices on same bus need to have same serial settings
+# Older configurations with MBUS_PORT, MBUS_BAUDRATE, ... are read as single bus 'mbus0' (deprecated)
 # https://pyserial.readthedocs.io/en/latest/pyserial_api.html#constants
-MBUS_PORT = "/dev/tty-mbus"
-MBUS_BAUDRATE = 2400
-MBUS_BYTESIZE = serial.EIGHTBITS
-MBUS_PARITY = serial.PARITY_EVEN
-MBUS_STOPBIT = serial.STOPBITS_ONE
+MBUS_BUSES = {
+  'mbus0': {'port': "/dev/tty-mbus", 'baudrate': 2400, 'bytesize': serial.EIGHTBITS, 'parity': serial.PARITY_EVEN, 'stopbits': serial.STOPBITS_ONE},
+#  'mbus1': {'port': "/dev/tty-mbus1", 'baudrate': 2400, 'bytesize': serial.EIGHTBITS, 'parity': serial.PARITY_EVEN, 'stopbits': serial.STOPBITS_ONE},
+}
+
+# Scheduling of reading devices
+# "bus": one worker thread per bus reads all devices on that bus, in order of MBUS_KAMSTRUP_DEVICES
+# "device": one worker thread per device; devices on same bus take turns
+MBUS_SCHEDULER = "bus"
+
+# Link initialisation (SND_NKE/ping) before reading a device (REQ_UD2)
+# "always": ping before every read
+# "adaptive": only ping at startup, after a failed read or
+#             when device has not been read successfully for MBUS_PING_IDLE_TIME seconds
+MBUS_PING_MODE = "adaptive"
+MBUS_PING_IDLE_TIME = 600
+
+# Bus capacity
+# At startup, bus utilisation is estimated from baudrate, telegram length (per model) and read rates
+# Use tools/kamstrup-bus-planner.py to check a configuration
+# MBUS_PLANNER_POLICY when estimated utilisation of a bus exceeds MBUS_MAX_UTILISATION:
+# "warn": log a warning
+# "derate": lower READ_RATE and read_rate to fit
+# "refuse": do not start
+MBUS_MAX_UTILISATION = 0.8
+MBUS_PLANNER_POLICY = "warn"
+
+# Measure actual bus utilisation; stretch read intervals when it exceeds MBUS_MAX_UTILISATION
+MBUS_GOVERNOR = True
 
 # [ Kamstrup MBUS device(s) ]
 # Address 254 also works if only one device is connected
 # Address 254 = broadcast address (only use when single device is connected)
 # Use tools/mbus-serial-scan.py /dev/tty-<yourmbus dongle> to find your mbus address
+# 'bus' refers to MBUS_BUSES; can be omitted when there is only one bus
+# 'read_rate' (optional) reads per hour for this device; device is then read independently of READ_RATE
+# 'model' (optional) 'MC303' or 'MC601'; used to estimate bus utilisation (other models: max frame length)
+# 'max_telegrams' (optional) for devices sending their data in more than one telegram (more records follow);
+#   telegrams are requested with toggled FCB, up to max_telegrams per read; default 1 (single telegram)
+#   Values are published once per read, after the last telegram (not telegram by telegram); when a telegram
+#   cannot be decoded, no values of that read are published
+# When a device cannot be read in time, missed reads are skipped (and logged), not queued
 MBUS_KAMSTRUP_DEVICES = [
-#{'name': 'MC601', 'mbus_address': 3},
-{'name': 'MC303', 'mbus_address': 11}
+#{'name': 'MC601', 'mbus_address': 3, 'bus': 'mbus0', 'read_rate': 360, 'model': 'MC601'},
+{'name': 'MC303', 'mbus_address': 11, 'bus': 'mbus0', 'model': 'MC303'}
 ]
 
+# Capture raw MBUS transactions (requests & responses per device read) to this file; None is no capture
+# Append only; grows with every read (about 160 bytes per read of a MC303)
+# Replay with: kamstrup-mqtt.py --replay <file> [--speed <factor>]
+CAPTURE_FILE = None  # eg "/var/tmp/kamstrup.cap"
+
 # INFLUXDB
 # All kamstrup meters are read in a single sequential burst (determined by READ_RATE)
 # Generate same time stamp for all meters read in one sequential burst
@@ -64,3 +163,51 @@ MBUS_KAMSTRUP_DEVICES = [
 # Reading burst for the 2 power meters used in this example takes about 2 seconds
 # Timestamp is with 1sec accuracy; if you need more, adapt code a bit
 SYNC_TIMESTAMP = True
+
+# Write values as InfluxDB line protocol as well; no MQTT -> Telegraf json_v2 parsing needed
+# None: disabled
+# "stdout": for Telegraf [[inputs.execd]] with data_format = "influx" (log messages go to stderr)
+# "udp://127.0.0.1:8094", "unix:///run/telegraf/kamstrup.sock" or "unixgram:///run/telegraf/kamstrup.sock":
+#   for Telegraf [[inputs.socket_listener]] with data_format = "influx"
+# Tags: topic and FABRICATION_NO; timestamp in nanoseconds
+INFLUX_OUTPUT = None
+INFLUX_MEASUREMENT = "kamstrup_mqtt_heatmeter"
+
+# Keys not written (as excluded_keys in telegraf-kamstrup-heatmeters.conf)
+INFLUX_EXCLUDED_KEYS = ["DATE", "DATE_TIME_GENERAL", "ENERGY_WH_d0_t1", "ENERGY_WH_d0_t2", "ENERGY_WH_d3_t0",
+                        "ON_TIME", "VOLUME_d1_t0", "VOLUME_d2_t0"]
+
+# Field type per key: "int", "uint", "float", "string" or "bool"
+# Keys not listed are written as float when numeric (as Telegraf json_v2), else as string
+# Keep types equal to existing InfluxDB fields, to avoid field type conflicts
+INFLUX_FIELD_TYPES = {
+  'FLOW_TEMPERATURE': "float",
+  'RETURN_TEMPERATURE': "float",
+  'TEMPERATURE_DIFFERENCE': "float",
+  'ENERGY_WH': "uint",
+  'P_Ea': "uint",
+  'POWER_W': "float",
+  'VOLUME': "float",
+  'VOLUME_FLOW': "float",
+  'MANUFACTURER_SPEC': "float",
+}
+
+# METRICS
+# MBUS (bus wait, ping, response and decode time; reads, timeouts, frame errors) and MQTT (publish latency,
+# queue, outages) metrics, exported every METRICS_INTERVAL seconds retained to <MQTT_TOPIC_PREFIX>/metrics
+# 0: disabled
+METRICS_INTERVAL = 300
+
+# Also write metrics in Prometheus text format, eg for the node_exporter textfile collector
+# None: disabled; eg "/var/lib/node_exporter/textfile_collector/kamstrup.prom"
+METRICS_PROMETHEUS_FILE = None
+
+# PROFILING
+# Diagnose CPU and memory usage of the running parser, eg: systemctl kill -s USR1 kamstrup-mqtt
+# SIGUSR1: cProfile all reading threads during PROFILE_CYCLES READ_RATE cycles (not when replaying)
+# SIGUSR2: first signal starts tracemalloc; every next signal writes top allocations and growth since previous
+# Reports are written to PROFILE_DIR; None: disabled, signals are not handled
+# Use a directory only writable by the parser, eg "/var/lib/kamstrup-mqtt/profile"
+PROFILE_DIR = None
+PROFILE_CYCLES = 10
+PROFILE_TOP = 25
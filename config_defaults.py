@@ -0,0 +1,84 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Defaults of settings added to config.rename.py after a config.py was created
+- A config.py of an older version keeps working; missing settings get the default of config.rename.py
+- MBUS_BUSES is derived from MBUS_PORT and friends, see mbus_session.configured_buses()
+"""
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Defaults as in config.rename.py
+# Deadbands and Influx keys are only used when MQTT_CHANGE_ONLY and INFLUX_OUTPUT are enabled; default is none
+DEFAULTS = {
+  'MQTT_QUEUE_SIZE': 1000,
+  'MQTT_QUEUE_POLICY': "drop-oldest",
+  'MQTT_QUEUE_BLOCK_TIMEOUT': 5,
+  'MQTT_SPOOL_DIR': None,
+  'MQTT_SPOOL_MAX_BYTES': 16 * 1024 * 1024,
+  'MQTT_SPOOL_SEGMENT_BYTES': 1024 * 1024,
+  'MQTT_SPOOL_DRAIN_RATE': 20,
+  'MQTT_ENCODING': "json",
+  'MQTT_COUNTER_MODE': "topic",
+  'MQTT_COUNTER_INTERVAL': 300,
+  'MQTT_STATUS_INTERVAL': 3600,
+  'MQTT_AGGREGATE': False,
+  'MQTT_CHANGE_ONLY': False,
+  'MQTT_DEADBAND': {},
+  'MQTT_KEYFRAME_CYCLES': 60,
+  'MQTT_KEYFRAME_INTERVAL': 3600,
+  'MBUS_SCHEDULER': "bus",
+  'MBUS_PING_MODE': "adaptive",
+  'MBUS_PING_IDLE_TIME': 600,
+  'MBUS_MAX_UTILISATION': 0.8,
+  'MBUS_PLANNER_POLICY': "warn",
+  'MBUS_GOVERNOR': True,
+  'CAPTURE_FILE': None,
+  'INFLUX_OUTPUT': None,
+  'INFLUX_MEASUREMENT': "kamstrup_mqtt_heatmeter",
+  'INFLUX_EXCLUDED_KEYS': [],
+  'INFLUX_FIELD_TYPES': {},
+  'METRICS_INTERVAL': 300,
+  'METRICS_PROMETHEUS_FILE': None,
+  'PROFILE_DIR': None,
+  'PROFILE_CYCLES': 10,
+  'PROFILE_TOP': 25,
+}
+
+
+def apply(config):
+  """
+  Set missing settings of configuration to their default
+
+  :param config: configuration module
+  :return: names of settings which got their default
+  :rtype: list
+  """
+  missing = [key for key in DEFAULTS if not hasattr(config, key)]
+  for key in missing:
+    setattr(config, key, DEFAULTS[key])
+
+  if missing:
+    logger.warning(f"Not in config.py, default is used (see config.rename.py): {', '.join(missing)}")
+
+  return missing
@@ -0,0 +1,157 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Change-only publishing (MQTT_CHANGE_ONLY): select the values of a telegram which have changed
+  more than their deadband since they were last published
+- Deadband per key (MQTT_DEADBAND): absolute (eg 0.05) or relative to last published value (eg "1%")
+  Keys without deadband are published on every change
+- Keyframe (all values) every MQTT_KEYFRAME_CYCLES telegrams or MQTT_KEYFRAME_INTERVAL seconds,
+  so late subscribers recover state
+"""
+
+import time
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Always published when a telegram is published
+KEY_TIMESTAMP = "timestamp"
+
+# Read counter (MQTT_COUNTER_MODE = "payload"); changes every read, so it is not a change by itself
+# Published along with changed values
+KEY_COUNTER = "counter"
+
+# Keys not filtered; added to published values when another value has changed
+UNFILTERED_KEYS = (KEY_TIMESTAMP, KEY_COUNTER)
+
+
+def parse_deadband(deadband):
+  """
+  :param deadband: absolute (int, float) or relative (str, eg "1%")
+  :return: (absolute, relative); relative as fraction
+  :rtype: tuple
+  """
+  if isinstance(deadband, str):
+    return 0.0, float(deadband.rstrip("% ")) / 100
+
+  return float(deadband), 0.0
+
+
+class DeadbandFilter:
+  """
+  Per device filter; remembers last published values
+  """
+  def __init__(self, name, deadbands, keyframe_cycles=0, keyframe_interval=0):
+    """
+    Args:
+      :param str name: device name
+      :param dict deadbands: key:deadband; see parse_deadband()
+      :param int keyframe_cycles: publish all values every keyframe_cycles telegrams; 0 is disabled
+      :param float keyframe_interval: publish all values every keyframe_interval seconds; 0 is disabled
+
+    Returns:
+      None
+    """
+    logger.debug(f">> {name}")
+    self.__name = name
+    self.__deadbands = {key: parse_deadband(deadband) for key, deadband in deadbands.items()}
+    self.__keyframe_cycles = keyframe_cycles
+    self.__keyframe_interval = keyframe_interval
+
+    # Last published value per key
+    self.__published = dict()
+
+    # Telegrams since last keyframe and time (monotonic) of last keyframe; None is no keyframe yet
+    self.__cycles = 0
+    self.__keyframe_time = None
+
+    logger.debug("<<")
+    return
+
+  def __changed(self, key, value):
+    """
+    :return: True when value differs more than deadband from last published value
+    :rtype: bool
+    """
+    if key not in self.__published:
+      return True
+
+    published = self.__published[key]
+    if not isinstance(value, (int, float)) or not isinstance(published, (int, float)):
+      return value != published
+
+    if key not in self.__deadbands:
+      return value != published
+
+    absolute, relative = self.__deadbands[key]
+    return abs(value - published) > max(absolute, relative * abs(published))
+
+  def is_keyframe(self):
+    """
+    :return: True when next telegram has to be published as keyframe
+    :rtype: bool
+    """
+    if self.__keyframe_time is None:
+      return True
+
+    if self.__keyframe_cycles and self.__cycles >= self.__keyframe_cycles:
+      return True
+
+    if self.__keyframe_interval and time.monotonic() - self.__keyframe_time >= self.__keyframe_interval:
+      return True
+
+    return False
+
+  def filter(self, values):
+    """
+    Select values to publish
+
+    :param dict values: all values of telegram
+    :return: values to publish (all values for a keyframe); empty dict when nothing has changed
+    :rtype: dict
+    """
+    if self.is_keyframe():
+      self.__cycles = 1
+      self.__keyframe_time = time.monotonic()
+      self.__published = dict(values)
+      logger.debug("%s: keyframe", self.__name)
+      return dict(values)
+
+    self.__cycles += 1
+    changed = {key: value for key, value in values.items() if key not in UNFILTERED_KEYS and self.__changed(key, value)}
+    if not changed:
+      return changed
+
+    self.__published.update(changed)
+    for key in UNFILTERED_KEYS:
+      if key in values:
+        changed[key] = values[key]
+
+    return changed
+
+  def reset(self):
+    """
+    Next telegram is published as keyframe (eg after device was disconnected)
+
+    :return: None
+    """
+    self.__keyframe_time = None
@@ -0,0 +1,198 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Write values as InfluxDB line protocol (INFLUX_OUTPUT), bypassing MQTT and Telegraf json_v2 parsing
+- Targets:
+  "stdout": for Telegraf inputs.execd (log messages are written to stderr)
+  "udp://host:port", "unix:///path" or "unixgram:///path": for Telegraf inputs.socket_listener
+- Field type from INFLUX_FIELD_TYPES ("int", "uint", "float", "string", "bool"), else from value:
+  int and float -> float, str -> "<value>"
+  Numbers are written as float unless typed otherwise; the decoder returns an int for a whole number,
+  so typing by Python type would change the field type between reads (as Telegraf json_v2 did)
+- Timestamp in nanoseconds
+
+Line: <measurement>,topic=<MQTT topic>[,FABRICATION_NO=<nr>] <field>=<value>,... <timestamp>
+"""
+
+import socket
+import sys
+import threading
+import time
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Keys written as tag instead of field (as in telegraf-kamstrup-heatmeters.conf)
+TAG_KEYS = ("FABRICATION_NO",)
+
+KEY_TIMESTAMP = "timestamp"
+
+_ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ '})
+_ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ '})
+_ESCAPE_STRING = str.maketrans({'"': r'\"', '\\': r'\\'})
+
+
+def _field_value(value, field_type=None):
+  """
+  :param value:
+  :param str field_type: "int", "uint", "float", "string", "bool"; None is type of value (numbers are float)
+  :return: field value in line protocol
+  :rtype: str
+  """
+  if field_type is None:
+    if isinstance(value, bool):
+      field_type = "bool"
+    elif isinstance(value, (int, float)):
+      field_type = "float"
+    else:
+      field_type = "string"
+
+  if field_type == "int":
+    return f"{int(value)}i"
+  if field_type == "uint":
+    return f"{int(value)}u"
+  if field_type == "float":
+    return repr(float(value))
+  if field_type == "bool":
+    return "true" if value else "false"
+
+  return '"' + str(value).translate(_ESCAPE_STRING) + '"'
+
+
+class LineProtocolWriter:
+  """
+  Write values of all devices as line protocol to one target (thread safe)
+  """
+  def __init__(self, target, measurement, field_types=None, excluded_keys=()):
+    """
+    Args:
+      :param str target: "stdout", "udp://host:port", "unix:///path" or "unixgram:///path"
+      :param str measurement: INFLUX_MEASUREMENT
+      :param dict field_types: key:type; INFLUX_FIELD_TYPES
+      :param excluded_keys: keys not written; INFLUX_EXCLUDED_KEYS
+
+    Returns:
+      None
+    :raises ValueError: unknown target
+    """
+    logger.debug(f">> target = {target}")
+    self.__target = target
+    self.__measurement = measurement.translate(_ESCAPE_MEASUREMENT)
+    self.__field_types = field_types or dict()
+    self.__excluded_keys = set(excluded_keys) | {KEY_TIMESTAMP}
+    self.__lock = threading.Lock()
+
+    # Socket; None for stdout, or when not (yet) connected
+    self.__socket = None
+    self.__address = None
+    self.__family = None
+    self.__type = None
+
+    if target == "stdout":
+      pass
+    elif target.startswith("udp://"):
+      host, port = target[len("udp://"):].rsplit(":", 1)
+      self.__address = (host, int(port))
+      self.__family, self.__type = socket.AF_INET, socket.SOCK_DGRAM
+    elif target.startswith("unixgram://"):
+      self.__address = target[len("unixgram://"):]
+      self.__family, self.__type = socket.AF_UNIX, socket.SOCK_DGRAM
+    elif target.startswith("unix://"):
+      self.__address = target[len("unix://"):]
+      self.__family, self.__type = socket.AF_UNIX, socket.SOCK_STREAM
+    else:
+      raise ValueError(f"Unknown INFLUX_OUTPUT '{target}'")
+
+    logger.debug("<<")
+    return
+
+  def line(self, topic, values):
+    """
+    :param str topic: MQTT topic of device; written as tag topic
+    :param dict values: values of device, including timestamp (seconds)
+    :return: line protocol; None when there are no fields
+    :rtype: str
+    """
+    tags = f",topic={topic.translate(_ESCAPE_KEY)}"
+    fields = list()
+    for key in sorted(values):
+      if key in self.__excluded_keys:
+        continue
+
+      if key in TAG_KEYS:
+        tags += f",{key.translate(_ESCAPE_KEY)}={str(values[key]).translate(_ESCAPE_KEY)}"
+      else:
+        fields.append(f"{key.translate(_ESCAPE_KEY)}={_field_value(values[key], self.__field_types.get(key))}")
+
+    if not fields:
+      return None
+
+    ts = values.get(KEY_TIMESTAMP)
+    ts_ns = int(ts * 1000000000) if ts else time.time_ns()
+    return f"{self.__measurement}{tags} {','.join(fields)} {ts_ns}\n"
+
+  def __send(self, data):
+    if self.__socket is None:
+      self.__socket = socket.socket(self.__family, self.__type)
+      if self.__type == socket.SOCK_STREAM:
+        self.__socket.connect(self.__address)
+
+    if self.__type == socket.SOCK_STREAM:
+      self.__socket.sendall(data)
+    else:
+      self.__socket.sendto(data, self.__address)
+
+  def write(self, topic, values):
+    """
+    Write values of a device
+
+    :param str topic: MQTT topic of device
+    :param dict values: values of device, including timestamp (seconds)
+    :return: None
+    """
+    line = self.line(topic, values)
+    if line is None:
+      return
+
+    with self.__lock:
+      try:
+        if self.__address is None:
+          sys.stdout.write(line)
+          sys.stdout.flush()
+        else:
+          self.__send(line.encode("utf-8"))
+      except OSError as e:
+        logger.warning(f"{self.__target}: {e}")
+        self.close()
+
+  def close(self):
+    """
+    Close socket; is reopened on next write
+
+    :return: None
+    """
+    if self.__socket is not None:
+      try:
+        self.__socket.close()
+      except OSError:
+        pass
+      self.__socket = None
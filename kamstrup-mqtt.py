@@ -5,10 +5,14 @@
    Read Kamstrup Multical via MBUS/Meterbus
 
 3 Worker threads:
-  - MBUS Serial port reader & parser
+  - MBUS Serial port reader & parser (one per bus or one per device; MBUS_SCHEDULER)
   - MQTT client
   - Timer thread controlling reader/parser
 
+Replay mode (--replay FILE):
+  - Telegrams captured with CAPTURE_FILE are decoded & published instead of reading the MBUS
+  - --speed 1 is real time (default); 0 is as fast as possible
+
         This program is free software: you can redistribute it and/or modify
         it under the terms of the GNU General Public License as published by
         the Free Software Foundation, either version 3 of the License, or
@@ -30,21 +34,49 @@ __version__ = "1.1.0"
 __author__ = "Hans IJntema"
 __license__ = "GPLv3"
 
+import argparse
 import signal
 import socket
 import time
 import sys
 import threading
 
+# Startup time is measured from here; see main()
+t_start = time.monotonic()
+
 # Local imports
 import config as cfg
+import aggregate
+import bus_planner
+import config_defaults
+import influx
 import kamstrup_mbus as kamstrup
+import mbus_session
+import metrics
 import mqtt as mqtt
+import payload
+import profiling
 import sample_rate as rate
+import telegram_capture
 
-from log import logger
+from log import logger, set_console_stream
 logger.setLevel(cfg.loglevel)
 
+# Settings added after config.py was created get their default
+config_defaults.apply(cfg)
+
+# Line protocol is written to stdout (Telegraf inputs.execd); log to stderr
+if cfg.INFLUX_OUTPUT == "stdout":
+  set_console_stream(sys.stderr)
+
+
+# ------------------------------------------------------------------------------------
+# Command line
+# ------------------------------------------------------------------------------------
+parser = argparse.ArgumentParser(description="Read Kamstrup Multical via MBUS and publish to MQTT")
+parser.add_argument("--replay", metavar="FILE", help="replay capture file (see CAPTURE_FILE) instead of reading MBUS")
+parser.add_argument("--speed", type=float, default=1.0, help="replay speed; 1 is real time, 0 is as fast as possible")
+args = parser.parse_args()
 
 # ------------------------------------------------------------------------------------
 # Instance running?
@@ -53,9 +85,9 @@ import os
 script = os.path.basename(__file__)
 script = os.path.splitext(script)[0]
 
-# Ensure that only one instance is started
+# Ensure that only one instance is started; a replay can run next to the parser
 if sys.platform == "linux":
-  lockfile = "\0" + script + "_lockfile"
+  lockfile = "\0" + script + ("_replay" if args.replay else "") + "_lockfile"
   try:
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     # Create an abstract socket, by prefixing it with null.
@@ -111,69 +143,229 @@ def exit_gracefully(sig, stackframe):
 
 
 def main():
+  global exit_code
   logger.debug(">>")
 
-  # To ensure that multiple kamstrup.TaskReadHeatMeter will only use the mbus one at a time
-  mbus_semaphore = threading.Semaphore(1)
+  # Configurations with MBUS_PORT (single bus) are still supported
+  try:
+    mbus_buses = mbus_session.configured_buses(cfg)
+  except AttributeError as e:
+    logger.error(f"{e}")
+    return
+
+  # One serial session per mbus, owning the mbus for the lifetime of the parser
+  # Ensures that multiple kamstrup.TaskReadHeatMeter will only use the same mbus one at a time
+  # Different buses are read in parallel
+  mbus_sessions = dict()
+  for bus, settings in mbus_buses.items():
+    mbus_sessions[bus] = mbus_session.MBusSession(settings['port'],
+                                                  settings['baudrate'],
+                                                  settings['bytesize'],
+                                                  settings['parity'],
+                                                  settings['stopbits'])
+
+  # Devices without bus are connected to the first bus
+  default_bus = next(iter(mbus_buses))
+
+  # Check expected bus utilisation; READ_RATE and read_rate might be derated
+  try:
+    read_rate, device_rates = bus_planner.check(mbus_buses,
+                                                cfg.MBUS_KAMSTRUP_DEVICES,
+                                                cfg.READ_RATE,
+                                                cfg.MBUS_PING_MODE,
+                                                cfg.MBUS_MAX_UTILISATION,
+                                                cfg.MBUS_PLANNER_POLICY)
+  except (ValueError, KeyError) as e:
+    logger.error(f"Bus planner: {e}")
+    return
+
+  # Optional dependency of MQTT_ENCODING has to be installed
+  try:
+    payload.Serializer(cfg.MQTT_ENCODING)
+  except (ValueError, ImportError) as e:
+    logger.error(f"MQTT_ENCODING: {e}")
+    return
+
+  # Measure actual bus occupancy; stretch read intervals when a bus is overloaded
+  governors = dict()
+  if cfg.MBUS_GOVERNOR:
+    for bus, session in mbus_sessions.items():
+      governors[bus] = bus_planner.BusGovernor(bus, session, cfg.MBUS_MAX_UTILISATION)
 
   # To flag that MQTT thread has to stop
   t_mqtt_stopper = threading.Event()
 
+  # Bounded queue between meter threads and MQTT thread
+  publish_queue = None
+  if cfg.MQTT_QUEUE_SIZE:
+    try:
+      publish_queue = mqtt.PublishQueue(cfg.MQTT_QUEUE_SIZE, cfg.MQTT_QUEUE_POLICY, cfg.MQTT_QUEUE_BLOCK_TIMEOUT)
+    except ValueError as e:
+      logger.error(f"{e}")
+      return
+
+  # Store messages on disk while disconnected from broker; not when replaying
+  spool = None
+  if cfg.MQTT_SPOOL_DIR and not args.replay:
+    spool = mqtt.Spool(cfg.MQTT_SPOOL_DIR, cfg.MQTT_SPOOL_MAX_BYTES, cfg.MQTT_SPOOL_SEGMENT_BYTES)
+
   # MQTT thread
   t_mqtt = mqtt.MQTTClient(mqtt_broker=cfg.MQTT_BROKER,
                            mqtt_port=cfg.MQTT_PORT,
-                           mqtt_client_id=cfg.MQTT_CLIENT_UNIQ,
+                           mqtt_client_id=cfg.MQTT_CLIENT_UNIQ + ("-replay" if args.replay else ""),
                            mqtt_qos=cfg.MQTT_QOS,
                            mqtt_cleansession=True,
                            mqtt_protocol=mqtt.MQTTv5,
                            username=cfg.MQTT_USERNAME,
                            password=cfg.MQTT_PASSWORD,
                            mqtt_stopper=t_mqtt_stopper,
-                           worker_threads_stopper=t_threads_stopper)
+                           worker_threads_stopper=t_threads_stopper,
+                           spool=spool,
+                           spool_drain_rate=cfg.MQTT_SPOOL_DRAIN_RATE,
+                           publish_queue=publish_queue,
+                           latency_observer=lambda latency: metrics.observe("mqtt_publish_latency_seconds", latency))
 
-  # List of kamstrup.TaskReadHeatMeter objects
-  list_of_heatmeters = list()
+  # MQTT client statistics are exported with the metrics as mqtt_<statistic>
+  metrics.REGISTRY.add_collector(
+    lambda: {f"mqtt_{key}": value for key, value in {**t_mqtt.publish_stats(), **t_mqtt.connection_stats()}.items()})
 
-  # This tread will ensure that all TaskReadHeatMeter will start reading at the same time
-  # Based on READ_RATE, but sequentially, one after the other
-  t_readrate = rate.ReadRateTimer(cfg.READ_RATE, len(cfg.MBUS_KAMSTRUP_DEVICES), t_threads_stopper)
+  # List of kamstrup.TaskReadMBus, kamstrup.TaskReadHeatMeter or telegram_capture.TaskReplay worker threads
+  list_of_workers = list()
+
+  # Capture raw MBUS transactions
+  capture = None
+  if cfg.CAPTURE_FILE and not args.replay:
+    capture = telegram_capture.CaptureWriter(cfg.CAPTURE_FILE)
 
-  # Create one worker thread per heatmeter to read heatmeter and publish data to MQTT
+  # This tread will ensure that all heatmeters without own read_rate will start reading at the same time
+  # Based on READ_RATE, but sequentially, one after the other
+  # READ_RATE is shared by all buses; stretch by the most overloaded bus
+  # In aggregate mode, values of all heatmeters are published in one document when all heatmeters are read
+  nrof_synced = len([device for device in cfg.MBUS_KAMSTRUP_DEVICES if not device.get('read_rate')])
+  stretch = (lambda: max(governor.stretch() for governor in governors.values())) if governors else None
+  aggregator = None
+  if cfg.MQTT_AGGREGATE:
+    aggregator = aggregate.BurstAggregator(t_mqtt, cfg.MQTT_TOPIC_PREFIX + "/burst", cfg.MQTT_ENCODING)
+
+  # Write values as line protocol as well (INFLUX_OUTPUT)
+  influx_writer = None
+  if cfg.INFLUX_OUTPUT:
+    try:
+      influx_writer = influx.LineProtocolWriter(cfg.INFLUX_OUTPUT, cfg.INFLUX_MEASUREMENT,
+                                                cfg.INFLUX_FIELD_TYPES, cfg.INFLUX_EXCLUDED_KEYS)
+    except ValueError as e:
+      logger.error(f"INFLUX_OUTPUT: {e}")
+      return
+
+  # Profile on request; SIGUSR1: cProfile PROFILE_CYCLES cycles, SIGUSR2: tracemalloc report
+  profiler = None
+  if cfg.PROFILE_DIR:
+    profiler = profiling.Profiler(cfg.PROFILE_DIR, cfg.PROFILE_CYCLES, cfg.PROFILE_TOP)
+    signal.signal(signal.SIGUSR1, profiler.request_cpu_profile)
+    signal.signal(signal.SIGUSR2, profiler.request_memory_report)
+
+  # Log time from start till end of first READ_RATE burst; publish aggregated burst document
+  first_burst = True
+
+  def on_cycle_end(ts):
+    nonlocal first_burst
+    if first_burst:
+      logger.info(f"Startup: first burst read {round(time.monotonic() - t_start, 3)} s after start")
+      first_burst = False
+    if aggregator:
+      aggregator.publish(ts)
+    if profiler:
+      profiler.cycle_end()
+
+  t_readrate = rate.ReadRateTimer(read_rate, nrof_synced, t_threads_stopper, stretch, on_cycle_end)
+
+  # kamstrup.HeatMeter objects per bus, in configured order
+  heatmeters_per_bus = {bus: list() for bus in mbus_sessions}
   for i in range(len(cfg.MBUS_KAMSTRUP_DEVICES)):
     name = cfg.MBUS_KAMSTRUP_DEVICES[i]['name']
     mbus_address = cfg.MBUS_KAMSTRUP_DEVICES[i]['mbus_address']
-    list_of_heatmeters.append(kamstrup.TaskReadHeatMeter(name, mbus_address, mbus_semaphore, t_readrate, t_mqtt, t_threads_stopper))
+    bus = cfg.MBUS_KAMSTRUP_DEVICES[i].get('bus', default_bus)
+    device_rate = device_rates.get(name)
+    if bus not in mbus_sessions:
+      logger.error(f"{name}: Unknown bus '{bus}'; check MBUS_BUSES")
+      return
+
+    heatmeters_per_bus[bus].append(kamstrup.HeatMeter(name, mbus_address, mbus_sessions[bus], t_mqtt,
+                                                      device_rate, capture, aggregator, influx_writer, profiler,
+                                                      cfg.MBUS_KAMSTRUP_DEVICES[i].get('max_telegrams', 1),
+                                                      bus_planner.frame_length(cfg.MBUS_KAMSTRUP_DEVICES[i])))
+
+  for bus, heatmeters in heatmeters_per_bus.items():
+    if args.replay:
+      # Captured telegrams are replayed instead of reading MBUS
+      break
+    elif cfg.MBUS_SCHEDULER == "bus":
+      # Create one worker thread per bus to read all heatmeters on that bus and publish data to MQTT
+      if heatmeters:
+        list_of_workers.append(kamstrup.TaskReadMBus(bus, mbus_sessions[bus], heatmeters, t_readrate, t_threads_stopper,
+                                                     governors.get(bus)))
+    else:
+      # Create one worker thread per heatmeter to read heatmeter and publish data to MQTT
+      for heatmeter in heatmeters:
+        list_of_workers.append(kamstrup.TaskReadHeatMeter(heatmeter, mbus_sessions[bus], t_readrate, t_threads_stopper,
+                                                          governors.get(bus)))
+
+  if args.replay:
+    heatmeters_by_name = {heatmeter.name: heatmeter for heatmeters in heatmeters_per_bus.values() for heatmeter in heatmeters}
+    list_of_workers.append(telegram_capture.TaskReplay(args.replay, heatmeters_by_name, args.speed, t_threads_stopper,
+                                                       aggregator))
 
   # Set MQTT last will/testament
   t_mqtt.will_set(cfg.MQTT_TOPIC_PREFIX + "/status", payload="offline", qos=cfg.MQTT_QOS, retain=True)
 
-  # Start MQTT thread
-  t_mqtt.start()
-
+  # Start reading immediately; MQTT connects in parallel, values are kept till it is connected
   # Start TaskReadHeatMeter event timer
-  t_readrate.start()
+  if not args.replay:
+    t_readrate.start()
 
-  # Start all TaskReadHeatMeter threads
-  for i in range(len(cfg.MBUS_KAMSTRUP_DEVICES)):
-    list_of_heatmeters[i].start()
+  # Start all TaskReadMBus/TaskReadHeatMeter threads
+  for worker in list_of_workers:
+    worker.start()
+
+  logger.info(f"Startup: reading started {round(time.monotonic() - t_start, 3)} s after start")
+
+  # Export metrics periodically; retained MQTT topic and optional Prometheus text file
+  if cfg.METRICS_INTERVAL:
+    t_metrics = metrics.TaskMetrics(t_mqtt, cfg.MQTT_TOPIC_PREFIX + "/metrics", cfg.METRICS_INTERVAL,
+                                    cfg.METRICS_PROMETHEUS_FILE, t_threads_stopper,
+                                    lambda document: payload.encode(document, cfg.MQTT_ENCODING))
+    t_metrics.start()
+
+  # Start MQTT thread
+  t_mqtt.start()
 
   # Set MQTT status to online and publish SW version of MQTT parser
   t_mqtt.set_status(cfg.MQTT_TOPIC_PREFIX + "/status", "online", retain=True)
   t_mqtt.do_publish(cfg.MQTT_TOPIC_PREFIX + "/sw-version", f"main={__version__}; mqtt={mqtt.__version__}", retain=True)
 
-  # block till last TaskReadHeatMeter thread stops receiving telegrams/exits
-  for i in range(len(cfg.MBUS_KAMSTRUP_DEVICES)):
-    list_of_heatmeters[i].join()
+  # block till last TaskReadMBus/TaskReadHeatMeter thread stops receiving telegrams/exits
+  for worker in list_of_workers:
+    worker.join()
+
+  # Replay has finished without being stopped or error
+  if args.replay and not t_threads_stopper.is_set():
+    exit_code = 0
 
   logger.debug("t_kamstrup.join exited; set stopper for other threats")
   t_threads_stopper.set()
+  for session in mbus_sessions.values():
+    session.close()
+  if capture:
+    capture.close()
+  if influx_writer:
+    influx_writer.close()
 
   # Set status to offline
   t_mqtt.set_status(cfg.MQTT_TOPIC_PREFIX + "/status", "offline", retain=True)
 
   # Use a simple delay of 1sec before closing MQTT, to allow last MQTT messages to be send
   time.sleep(1)
-  t_mqtt_stopper.set()
+  t_mqtt.stop()
 
   logger.debug("<<")
   return
@@ -0,0 +1,455 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Decode records of a Kamstrup telegram (meterbus.TelegramLong) to key:value pairs for MQTT JSON
+- Records are decoded directly; no conversion of telegram to JSON and back
+- MQTT JSON key per record type is determined once and stored in a lookup table
+- Per device cache of the telegram layout; telegrams with the same layout as the previous telegram
+  are decoded by slicing the raw telegram at known offsets, without the meterbus parser
+- Multi telegram readout (more records follow, DIF 0x1F): every telegram is decoded on its own,
+  with its own layout cache; more_records_follow() tells from the raw telegram whether to request the next
+
+Multical 303 records (as interpreted by meterbus):
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.ENERGY_WH', 'unit': 'MeasureUnit.WH', 'value': 70000}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.VOLUME', 'unit': 'MeasureUnit.M3', 'value': 69.66}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 2125}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 2166}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.ON_TIME', 'unit': 'MeasureUnit.SECONDS', 'value': 16038000}
+RECORD = {'function': 'FunctionType.ERROR_STATE_VALUE', 'storage_number': 0, 'type': 'VIFUnit.ON_TIME', 'unit': 'MeasureUnit.SECONDS', 'value': 93600}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.FLOW_TEMPERATURE', 'unit': 'MeasureUnit.C', 'value': 31.560000000000002}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.RETURN_TEMPERATURE', 'unit': 'MeasureUnit.C', 'value': 30.330000000000002}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.TEMPERATURE_DIFFERENCE', 'unit': 'MeasureUnit.K', 'value': 1.23}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.POWER_W', 'unit': 'MeasureUnit.W', 'value': 2100}
+RECORD = {'function': 'FunctionType.MAXIMUM_VALUE', 'storage_number': 0, 'type': 'VIFUnit.POWER_W', 'unit': 'MeasureUnit.W', 'value': -10000}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.VOLUME_FLOW', 'unit': 'MeasureUnit.M3_H', 'value': 1.299}
+RECORD = {'function': 'FunctionType.MAXIMUM_VALUE', 'storage_number': 0, 'type': 'VIFUnit.VOLUME_FLOW', 'unit': 'MeasureUnit.M3_H', 'value': 1.584}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 0}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.ENERGY_WH', 'unit': 'MeasureUnit.WH', 'value': 0}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.VOLUME', 'unit': 'MeasureUnit.M3', 'value': 0}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 0}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 0}
+RECORD = {'function': 'FunctionType.MAXIMUM_VALUE', 'storage_number': 1, 'type': 'VIFUnit.POWER_W', 'unit': 'MeasureUnit.W', 'value': 0}
+RECORD = {'function': 'FunctionType.MAXIMUM_VALUE', 'storage_number': 1, 'type': 'VIFUnit.VOLUME_FLOW', 'unit': 'MeasureUnit.M3_H', 'value': 0}
+RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.DATE', 'unit': 'MeasureUnit.DATE', 'value': '2023-01-01'}
+
+Multical 601 records contain device (d) and tariff (t); MQTT JSON key is <type>_d<device>_t<tariff>
+"""
+
+import decimal
+from meterbus.core_objects import FunctionType, DataEncoding, MeasureUnit
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Temperatures are rounded to 2 digits
+ROUND_2_DIGITS = ("FLOW_TEMPERATURE", "RETURN_TEMPERATURE")
+
+# Long frame: start, L, L, start, C, A, CI; followed by 12 byte data header when CI = 0x72
+FRAME_START = 0x68
+FRAME_STOP = 0x16
+CI_VARIABLE_DATA = 0x72
+PAYLOAD_OFFSET = 19
+
+# Length of data field, by DIF data field coding (DIF & 0x0F); None for variable length
+DATA_LENGTH = (0, 1, 2, 3, 4, 4, 6, 8, 0, 1, 2, 3, 4, None, 6, 0)
+
+# Units for which meterbus does not decode value as a (scaled) integer
+NON_INTEGER_UNITS = (MeasureUnit.DATE, MeasureUnit.DATE_TIME, MeasureUnit.TIME, MeasureUnit.DATE_TIME_S, MeasureUnit.DBM)
+
+# Lookup table (DIB, VIB, custom VIF) --> (MQTT JSON key, nr of digits to round value to)
+# DIB codes function, storage number, device and tariff; VIB codes the type (VIF)
+# Key is None for records which are not published
+_lut = dict()
+
+
+def record_key(record):
+  """
+  Return MQTT JSON key for record
+
+  Args:
+    :param meterbus.TelegramVariableDataRecord record:
+
+  Returns:
+    :return: (key, ndigits); key is None when record is not published; ndigits is None when value is not rounded
+    :rtype: tuple
+  """
+  lut_key = (bytes(record.dib.parts), bytes(record.vib.parts), bytes(record.vib.customVIF.parts))
+
+  try:
+    return _lut[lut_key]
+  except KeyError:
+    pass
+
+  # First time this record type is seen; determine key
+  interpreted = record.interpreted
+
+  # storage number 1 does not contain any relevant values for Multical 303
+  # Only instantaneous values are published
+  if interpreted['storage_number'] == 1 or record.dib.function_type != FunctionType.INSTANTANEOUS_VALUE:
+    entry = (None, None)
+  else:
+    typ = interpreted['type'].replace("VIFUnit.", "")
+
+    # For Multical 601; device = d; tariff = t
+    if "tariff" in interpreted:
+      entry = (f"{typ}_d{interpreted['device']}_t{interpreted['tariff']}", None)
+    elif typ in ROUND_2_DIGITS:
+      entry = (typ, 2)
+    else:
+      entry = (typ, None)
+
+  logger.debug(f"New record type {lut_key} --> {entry[0]}")
+  _lut[lut_key] = entry
+  return entry
+
+
+def native(value):
+  """
+  Convert decimal.Decimal (as returned by meterbus) to int or float
+  Result is identical to converting the telegram to JSON and back
+
+  Args:
+    :param value: decoded record value
+
+  Returns:
+    :return: value; decimal.Decimal converted to int or float
+  """
+  if isinstance(value, decimal.Decimal):
+    if value.as_tuple().exponent == 0:
+      return int(value)
+    return float(value)
+
+  return value
+
+
+def decode_records(records, values):
+  """
+  Decode telegram records
+
+  Args:
+    :param list records: meterbus.TelegramVariableDataRecord, eg frame.records
+    :param dict values: key:value pairs are added to/updated in values
+
+  Returns:
+    :return: None
+  """
+  # Formatting every record costs more than decoding it; only when debugging
+  debug = logger.isEnabledFor(logging.DEBUG)
+
+  for record in records:
+    key, ndigits = record_key(record)
+    if key is None:
+      continue
+
+    value = native(record.parsed_value)
+    if ndigits is not None:
+      value = round(value, ndigits)
+
+    if debug:
+      logger.debug(f"RECORD: {key} = {value}")
+    values[key] = value
+
+
+def is_long_frame(data):
+  """
+  Check start, length, checksum and stop byte of a raw long frame
+
+  Args:
+    :param bytes data: raw frame
+
+  Returns:
+    :return: True when valid
+    :rtype: bool
+  """
+  return len(data) >= 9 and \
+         data[0] == FRAME_START and data[3] == FRAME_START and \
+         data[1] == data[2] and len(data) == data[1] + 6 and \
+         data[-1] == FRAME_STOP and (sum(data[4:-2]) & 0xFF) == data[-2]
+
+
+def more_records_follow(data):
+  """
+  Check whether device has more records in a next telegram (DIF 0x1F), without decoding the telegram
+  Only the DIB/VIB of the records are walked
+
+  Args:
+    :param bytes data: raw long frame
+
+  Returns:
+    :return: True when more records follow
+    :rtype: bool
+  """
+  pos = PAYLOAD_OFFSET
+  end = len(data) - 2
+  try:
+    while pos < end:
+      dif = data[pos]
+
+      # Fill byte
+      if dif == 0x2F:
+        pos += 1
+        continue
+
+      # Manufacturer specific data till end of telegram; 0x1F: more records follow in next telegram
+      if dif in (0x0F, 0x1F):
+        return dif == 0x1F
+
+      # DIF and DIFE's
+      pos += 1
+      while data[pos - 1] & 0x80:
+        pos += 1
+
+      # VIF and VIFE's; plain text VIF is followed by length and text
+      vif = data[pos]
+      pos += 1
+      if vif == 0x7C:
+        pos += data[pos] + 1
+      else:
+        while data[pos - 1] & 0x80:
+          pos += 1
+
+      length = DATA_LENGTH[dif & 0x0F]
+      if length is None:
+        # Variable length: LVAR; text, BCD or binary
+        lvar = data[pos]
+        if lvar < 0xC0:
+          length = 1 + lvar
+        elif lvar < 0xE0:
+          length = 1 + (lvar & 0x0F)
+        elif lvar < 0xF0:
+          length = 1 + lvar - 0xE0
+        else:
+          return False
+
+      pos += length
+
+  except IndexError:
+    pass
+
+  return False
+
+
+def _int_decoder(mult):
+  """
+  Return function decoding a little endian integer data field, scaled by mult
+  Result is identical to meterbus record.parsed_value, converted by native()
+  """
+  if mult > 1.0:
+    def decode(raw):
+      return int(int.from_bytes(raw, "little", signed=True) * mult)
+  else:
+    def decode(raw):
+      value = int.from_bytes(raw, "little", signed=True) * mult
+      if isinstance(value, float) and not value.is_integer():
+        return value
+      return int(value)
+
+  return decode
+
+
+def _record_decoder(record):
+  """
+  Return function decoding a data field with meterbus, reusing the (learned) record
+  Used for data fields which are not plain integers (BCD, real, dates)
+  """
+  def decode(raw):
+    record.dataField.parts = list(raw)
+    return native(record.parsed_value)
+
+  return decode
+
+
+class TelegramLayoutCache:
+  """
+  Cache of the telegram layout of one device
+
+  Kamstrup telegrams of a device have an identical layout (DIF/VIF of each record) every read
+  After a full decode (meterbus), learn() stores the offset, length and coding of each record
+  decode() decodes telegrams with an identical layout signature by slicing the raw telegram
+  """
+
+  def __init__(self, name):
+    logger.debug(f">> {name}")
+    self.__name = name
+
+    # Frame length and layout signature (CI and DIB/VIB bytes of all records) of cached layout
+    self.__length = 0
+    self.__signature = None
+
+    # (start, end) of DIB/VIB of every record
+    self.__regions = ()
+
+    # (key, start, end, decode function, ndigits) of every published record
+    self.__fields = ()
+
+    # Statistics
+    self.hits = 0
+    self.misses = 0
+
+  def __layout(self, data):
+    return data[6:7] + b"".join(data[start:end] for start, end in self.__regions)
+
+  def decode(self, data, values):
+    """
+    Decode raw telegram when layout matches cached layout
+
+    Args:
+      :param bytes data: raw long frame
+      :param dict values: key:value pairs are added to/updated in values
+
+    Returns:
+      :return: True when decoded; False when layout differs (cache miss)
+      :rtype: bool
+    """
+    if self.__signature is None or len(data) != self.__length or \
+       self.__layout(data) != self.__signature or not is_long_frame(data):
+      self.misses += 1
+      if self.__signature is not None:
+        logger.info(f"{self.__name}: Telegram layout changed; cache misses = {self.misses}")
+        self.__signature = None
+      return False
+
+    self.hits += 1
+    for key, start, end, decode, ndigits in self.__fields:
+      value = decode(data[start:end])
+      if ndigits is not None:
+        value = round(value, ndigits)
+      values[key] = value
+
+    return True
+
+  def learn(self, data, frame):
+    """
+    Learn layout of raw telegram, which has been fully decoded by meterbus
+
+    Args:
+      :param bytes data: raw long frame
+      :param meterbus.TelegramLong frame: data as parsed by meterbus
+
+    Returns:
+      :return: True when layout is cached
+      :rtype: bool
+    """
+    self.__signature = None
+
+    body_header = frame.body.bodyHeader
+    if data[6] != CI_VARIABLE_DATA or not body_header.isLSBOrder:
+      logger.debug(f"{self.__name}: Telegram layout not cacheable; CI = {data[6]}")
+      return False
+
+    records = frame.records
+    regions = []
+    fields = []
+
+    # Walk the records, as meterbus does
+    pos = PAYLOAD_OFFSET
+    end = len(data) - 2
+    index = 0
+    try:
+      while pos < end:
+        dif = data[pos]
+
+        # Fill byte
+        if dif == 0x2F:
+          pos += 1
+          continue
+
+        # More records follow in next telegram (multi telegram readout); rest of telegram is not decoded
+        if dif == 0x1F:
+          if list(data[pos:pos + 1]) != records[index].dib.parts:
+            return False
+          regions.append((pos, pos + 1))
+          index += 1
+          pos = end
+          break
+
+        # Manufacturer specific data; not cached
+        if dif == 0x0F:
+          return False
+
+        start = pos
+        pos += 1
+        while data[pos - 1] & 0x80:
+          pos += 1
+
+        # VIF and VIFE's
+        dib_end = pos
+        pos += 1
+        while data[pos - 1] & 0x80:
+          pos += 1
+
+        length = DATA_LENGTH[dif & 0x0F]
+
+        # Plain text VIF or variable length data; not cached
+        if (data[dib_end] & 0x7F) == 0x7C or length is None:
+          return False
+
+        # meterbus drops records without data
+        if length == 0:
+          continue
+
+        record = records[index]
+        index += 1
+        if list(data[start:dib_end]) != record.dib.parts or list(data[dib_end:pos]) != record.vib.parts:
+          return False
+
+        regions.append((start, pos))
+
+        key, ndigits = record_key(record)
+        if key is not None:
+          mult, unit, _, _ = record._parse_vifx()
+          _, encoding = record.dib.length_encoding
+          if encoding == DataEncoding.ENCODING_INTEGER and unit not in NON_INTEGER_UNITS and \
+             isinstance(mult, (int, float)):
+            decode = _int_decoder(mult)
+          else:
+            decode = _record_decoder(record)
+
+          fields.append((key, pos, pos + length, decode, ndigits))
+
+        pos += length
+
+    except IndexError:
+      return False
+
+    if index != len(records) or pos != end:
+      return False
+
+    self.__regions = tuple(regions)
+    self.__fields = tuple(fields)
+
+    # Verify cached layout gives same result as meterbus
+    expected = dict()
+    decode_records(records, expected)
+    self.__length = len(data)
+    self.__signature = self.__layout(data)
+    cached = dict()
+    if not self.decode(data, cached) or cached != expected:
+      logger.warning(f"{self.__name}: Cached telegram layout does not match meterbus decoding; not cached")
+      self.__signature = None
+      return False
+
+    # Verification is not a real hit
+    self.hits -= 1
+
+    logger.info(f"{self.__name}: Telegram layout cached; {len(records)} records; {len(data)} bytes")
+    return True
@@ -16,16 +16,28 @@ Description
 -----------
 - Read Kamstrup MBUS device
 - Parse data
+
+Scheduling (MBUS_SCHEDULER):
+- "bus": one TaskReadMBus thread per bus, reading all devices on that bus in configured order
+- "device": one TaskReadHeatMeter thread per device; devices on same bus take turns via the bus semaphore
+- Devices without read_rate are read in the READ_RATE burst (ReadRateTimer)
+- Devices with own read_rate are free running; read when their deadline is due (next-due first)
 """
 
+import heapq
+import math
 import threading
 import time
 import serial
 import meterbus
-import json
 
 # Local imports
 import config as cfg
+import deadband
+import kamstrup_decode
+import metrics
+import payload
+import telegram_capture
 
 # Logging
 import __main__
@@ -37,38 +49,130 @@ script = os.path.splitext(script)[0]
 logger = logging.getLogger(script + "." + __name__)
 
 
-class TaskReadHeatMeter(threading.Thread):
-  def __init__(self, name, mbus_address, mbus_semaphore, t_readrate, t_mqtt, t_threads_stopper):
-    logger.debug(f">> {name}")
-    super().__init__()
+class HeatMeter:
+  """
+  Kamstrup Multical connected to a MBUS
+  - Read telegram
+  - Decode telegram and publish values to MQTT
+  """
+  def __init__(self, name, mbus_address, mbus_session, t_mqtt, read_rate=None, capture=None, aggregator=None,
+               influx=None, profiler=None, max_telegrams=1, frame_length=None):
+    logger.debug(">> %s; read_rate = %s", name, read_rate)
     self.__name = name
     self.__mbus_address = mbus_address
-    self.__mbus_semaphore = mbus_semaphore
 
-    # determine when to read MBUS device
-    self.__t_readrate = t_readrate
+    # Labels of metrics of this device
+    self.__labels = {"meter": name}
+
+    # Seconds between reads of a free running device; None when read in the READ_RATE burst
+    self.__interval = 3600/read_rate if read_rate else None
+
+    # Nrof read deadlines skipped because device could not be read in time
+    self.__late = 0
+
+    # Serial session of the MBUS this device is connected to; shared with other devices on same MBUS
+    self.__mbus_session = mbus_session
 
     # MQTT client
     self.__t_mqtt = t_mqtt
 
-    # Signal when to stop
-    self.__t_threads_stopper = t_threads_stopper
+    # telegram_capture.CaptureWriter; None when transactions are not captured
+    self.__capture = capture
+
+    # aggregate.BurstAggregator (MQTT_AGGREGATE); values are published in aggregated burst document
+    # Free running devices are not part of a burst, and publish their own values
+    self.__aggregator = aggregator if self.__interval is None else None
+
+    # influx.LineProtocolWriter (INFLUX_OUTPUT); None when values are only published to MQTT
+    self.__influx = influx
+
+    # profiling.Profiler; reading thread enables its profiler at start of read() during a profiling window
+    self.__profiler = profiler
 
     # Maintain a dictionary of values to be publised to MQTT
     self.__json_values = dict()
 
+    # Encode values (MQTT_ENCODING); key order is precompiled per key set
+    self.__serializer = payload.Serializer(cfg.MQTT_ENCODING)
+
+    # Change-only publishing (MQTT_CHANGE_ONLY); None is publish all values every read
+    self.__deadband = None
+    if cfg.MQTT_CHANGE_ONLY:
+      self.__deadband = deadband.DeadbandFilter(name, cfg.MQTT_DEADBAND, cfg.MQTT_KEYFRAME_CYCLES, cfg.MQTT_KEYFRAME_INTERVAL)
+
     # Keep count of nr of reads since start of parser
     self.__counter = 0
 
-    # Bookkeeping for throttling read rate
-    #self.__lastreadtime = 0
-    #self.__interval = 3600/cfg.READ_RATE
+    # Whether last read was successful
+    self.__is_connected = False
+
+    # Last published status and time (monotonic) of last publish of status and counter; None is not published yet
+    self.__status = None
+    self.__status_time = None
+    self.__counter_time = None
+
+    # Layout of telegrams of this device; to decode telegrams without full meterbus parser
+    # One cache per telegram of a multi telegram readout
+    self.__layout_caches = [kamstrup_decode.TelegramLayoutCache(name)]
+
+    # Max nrof telegrams of a readout (more records follow); 1 is a single REQ_UD2
+    self.__max_telegrams = max(1, max_telegrams)
 
-    logger.debug(f"<< {self.__name}")
+    # Frame length (bytes) estimated by bus_planner; observed length is logged once when it differs
+    self.__frame_length = frame_length
+
+    # Multi telegram readout: FCB of next REQ_UD2; index of telegram returned by read() in the readout
+    self.__fcb = True
+    self.__telegram = 0
+
+    # Values of current readout; added to self.__json_values when all telegrams of the readout are decoded
+    # First decode error of earlier telegrams of a multi telegram readout; reported by publish()
+    self.__readout = dict()
+    self.__readout_error = None
+
+    # Link state for adaptive link initialisation (MBUS_PING_MODE)
+    # Link is known-good after a successful read; time of last successful read (monotonic)
+    self.__link_ok = False
+    self.__link_time = 0
+
+    logger.debug("<< %s", self.__name)
     return
 
-  def __del__(self):
-    logger.debug(f">> {self.__name}")
+  @property
+  def name(self):
+    return self.__name
+
+  @property
+  def interval(self):
+    return self.__interval
+
+  @property
+  def late(self):
+    return self.__late
+
+  def next_deadline(self, deadline, stretch=1.0):
+    """
+    Next read deadline of a free running device
+    Deadlines already passed (read was late) are skipped and counted; reads do not pile up
+
+    :param float deadline: deadline (time.monotonic) of the read just done
+    :param float stretch: interval is stretched by this factor (bus_planner.BusGovernor)
+    :return: next deadline (time.monotonic)
+    :rtype: float
+    """
+    interval = self.__interval * stretch
+    deadline += interval
+    now = time.monotonic()
+    if deadline < now:
+      missed = math.ceil((now - deadline) / interval)
+      self.__late += missed
+      metrics.inc("mbus_late_total", self.__labels, missed)
+
+      # No running total in message; repeated warnings are suppressed by the log module
+      logger.warning(f"{self.__name}: Read is late; skipped {missed} read(s)")
+      deadline += missed * interval
+
+    return deadline
 
   def __publish_telegram(self):
     """
@@ -76,26 +180,369 @@ class TaskReadHeatMeter(threading.Thread):
 
     :return: None
     """
-    logger.debug(f">> {self.__name}")
+    logger.debug(">> %s", self.__name)
 
     # make resilient against double forward slashes in topic
     topic = cfg.MQTT_TOPIC_PREFIX + "/" + self.__name
     topic = topic.replace('//', '/')
 
+    # Counter is part of values (MQTT_COUNTER_MODE)
+    if cfg.MQTT_COUNTER_MODE == "payload":
+      self.__json_values[deadband.KEY_COUNTER] = self.__counter
+
     # Only when kamstrup device was connected, do publish values
     if self.__is_connected:
-      message = json.dumps(self.__json_values, sort_keys=True, separators=(',', ':'))
-      self.__t_mqtt.do_publish(topic, message, retain=False)
-
-    self.__t_mqtt.do_publish(topic + "/counter", str(self.__counter), retain=False)
+      values = self.__json_values
+      if self.__deadband:
+        # Only changed values; nothing when no value has changed
+        values = self.__deadband.filter(values)
+
+      if values and self.__aggregator:
+        self.__aggregator.add(self.__name, values)
+      elif values:
+        message = self.__serializer.dumps(values)
+        self.__t_mqtt.do_publish(topic, message, retain=False)
+
+      if values and self.__influx:
+        self.__influx.write(topic, values)
+    elif self.__deadband:
+      # Publish all values when device is connected again
+      self.__deadband.reset()
+
+    now = time.monotonic()
+
+    # Counter topic is rate limited (MQTT_COUNTER_INTERVAL)
+    if cfg.MQTT_COUNTER_MODE == "topic" and \
+       (self.__counter_time is None or now - self.__counter_time >= cfg.MQTT_COUNTER_INTERVAL):
+      self.__t_mqtt.do_publish(topic + "/counter", str(self.__counter), retain=False)
+      self.__counter_time = now
 
     # Indicate in MQTT whether kamstrup meter is connected (or not)
+    # Retained; only published when status changes, and refreshed every MQTT_STATUS_INTERVAL seconds
     status = "power on" if self.__is_connected else "power off"
-    self.__t_mqtt.do_publish(topic + "/status", status, retain=True)
+    if status != self.__status or \
+       (cfg.MQTT_STATUS_INTERVAL and now - self.__status_time >= cfg.MQTT_STATUS_INTERVAL):
+      self.__t_mqtt.do_publish(topic + "/status", status, retain=True)
+      self.__status = status
+      self.__status_time = now
+
+    logger.debug("<< %s", self.__name)
+    return
+
+  def __ping(self, ser):
+    """
+    Initialise link with device (SND_NKE)
+
+    :param serial.Serial ser:
+    :return: None
+    """
+    t = time.monotonic()
+    meterbus.send_ping_frame(ser, self.__mbus_address)
+    data = meterbus.recv_frame(ser, 1)
+    if not data:
+      metrics.inc("mbus_timeouts_total", self.__labels)
+
+    frame = meterbus.load(data)
+    assert isinstance(frame, meterbus.TelegramACK), "Meterbus did not return a meterbus.TelegramACK"
+    metrics.observe("mbus_ping_seconds", time.monotonic() - t, self.__labels)
+
+    # Device expects FCB set in first REQ_UD2 after SND_NKE
+    self.__fcb = True
+
+  def __request(self, ser):
+    """
+    Request data from device (REQ_UD2)
+    Telegram is received as raw long frame (start, length, checksum and stop byte are checked);
+    telegram is decoded after MBUS has been released
+
+    :param serial.Serial ser:
+    :return: raw long frame
+    :rtype: bytes
+    """
+    if self.__max_telegrams > 1:
+      return self.__request_telegrams(ser)
+
+    t = time.monotonic()
+    meterbus.send_request_frame(ser, self.__mbus_address)
+    return self.__receive(ser, t)
+
+  def __request_telegrams(self, ser):
+    """
+    Multi telegram readout: request telegrams (REQ_UD2, FCB toggled every request) while more records follow
+    Every telegram is decoded while the device transmits the next one; values are added telegram by telegram,
+    telegrams are not concatenated. Last telegram is decoded after MBUS has been released
+    A decode error is not a link failure; it does not end the readout and is reported by publish()
+
+    :param serial.Serial ser:
+    :return: raw long frame of last telegram
+    :rtype: bytes
+    """
+    # Values of an earlier (failed) attempt are discarded
+    self.__readout = dict()
+    self.__readout_error = None
+
+    data = None
+    for index in range(self.__max_telegrams):
+      req = meterbus.send_request_frame_multi(None, self.__mbus_address)
+      if not self.__fcb:
+        req.header.cField.parts[0] &= ~meterbus.CONTROL_MASK_FCB
+
+      t = time.monotonic()
+      meterbus.send_request_frame_multi(ser, req=req)
+      self.__fcb = not self.__fcb
+
+      if data is not None:
+        self.__decode_earlier(data, index - 1)
+
+      data = self.__receive(ser, t)
+      self.__telegram = index
+      if not kamstrup_decode.more_records_follow(data):
+        return data
+
+    logger.warning(f"{self.__name}: More than {self.__max_telegrams} telegrams; remaining records not read")
+    return data
+
+  def __receive(self, ser, t):
+    """
+    Receive response (RSP_UD) as raw long frame (start, length, checksum and stop byte are checked)
+
+    :param serial.Serial ser:
+    :param float t: time (monotonic) request was sent
+    :return: raw long frame
+    :rtype: bytes
+    """
+    # Start, L, L, start; remainder of frame is L + 2 bytes (checksum and stop)
+    # Read timeout is shorter than transmission time of a long frame at 2400 baud; read till complete
+    data = ser.read(4)
+    if len(data) == 4 and data[0] == kamstrup_decode.FRAME_START:
+      remaining = data[1] + 2
+      while remaining > 0:
+        chunk = ser.read(remaining)
+        if not chunk:
+          break
+
+        data += chunk
+        remaining -= len(chunk)
+
+    if not kamstrup_decode.is_long_frame(data):
+      # Complete frame with wrong checksum, start/stop byte or length; otherwise (partial) timeout
+      complete = len(data) >= 4 and data[0] == kamstrup_decode.FRAME_START and len(data) == data[1] + 6
+      metrics.inc("mbus_frame_errors_total" if complete else "mbus_timeouts_total", self.__labels)
+      raise AssertionError("Meterbus did not return a valid long frame")
+
+    metrics.observe("mbus_response_seconds", time.monotonic() - t, self.__labels)
+    return data
+
+  def __decode_earlier(self, data, index):
+    """
+    Decode earlier telegram of a multi telegram readout into self.__readout
+    Exceptions are not raised; first one is kept in self.__readout_error
+
+    :param bytes data: raw long frame
+    :param int index: index of telegram in the readout
+    :return: None
+    """
+    if self.__readout_error is not None:
+      return
+
+    try:
+      self.__decode(data, index)
+    except Exception as e:
+      self.__readout_error = e
+
+  def __decode(self, data, index=0):
+    """
+    Decode telegram and add values to self.__readout
+    Use cached telegram layout; when layout differs from cached layout, decode telegram
+    with meterbus and learn new layout
+
+    :param bytes data: raw long frame
+    :param int index: index of telegram in a multi telegram readout
+    :return: None
+    """
+    while len(self.__layout_caches) <= index:
+      self.__layout_caches.append(
+        kamstrup_decode.TelegramLayoutCache(f"{self.__name} telegram {len(self.__layout_caches) + 1}"))
+    layout_cache = self.__layout_caches[index]
+
+    if layout_cache.decode(data, self.__readout):
+      return
+
+    frame = meterbus.load(data)
+    assert isinstance(frame, meterbus.TelegramLong), "Meterbus did not return a meterbus.TelegramLong"
+    kamstrup_decode.decode_records(frame.records, self.__readout)
+    layout_cache.learn(data, frame)
+
+    # Check estimate of bus utilisation against reality
+    if self.__frame_length and len(data) != self.__frame_length:
+      logger.info(f"{self.__name}: Frame length = {len(data)} bytes; bus planner estimated {self.__frame_length} bytes; "
+                  f"check with tools/kamstrup-bus-planner.py -f {self.__name}={len(data)}")
+      self.__frame_length = None
+
+  def __read_telegram(self, ser):
+    """
+    Read telegram from device
+    Link is initialised (ping) depending on MBUS_PING_MODE; in adaptive mode,
+    a failed request is retried once after initialising the link
+
+    :param serial.Serial ser:
+    :return: raw long frame
+    :rtype: bytes
+    """
+    ping = cfg.MBUS_PING_MODE != "adaptive" or not self.__link_ok or \
+           (time.monotonic() - self.__link_time) > cfg.MBUS_PING_IDLE_TIME
+
+    # Link state is unknown till read succeeds
+    self.__link_ok = False
+
+    if ping:
+      self.__ping(ser)
+      data = self.__request(ser)
+    else:
+      try:
+        data = self.__request(ser)
+      except (serial.SerialException, OSError):
+        raise
+      except Exception as e:
+        logger.debug("%s: Request failed (%s); initialise link and retry", self.__name, e)
+        ser.reset_input_buffer()
+        self.__ping(ser)
+        data = self.__request(ser)
+
+    self.__link_ok = True
+    self.__link_time = time.monotonic()
+    return data
+
+  def read(self, ts):
+    """
+    Read telegram from device
+    Call only while holding the MBUS (mbus_session.acquire)
+
+    :param int ts: timestamp for MQTT
+    :return: raw long frame; None when read failed
+    :rtype: bytes
+    """
+    logger.debug(">> %s", self.__name)
+
+    if self.__profiler:
+      self.__profiler.checkpoint()
+
+    # Add timestamp to dict
+    self.__json_values["timestamp"] = ts
+
+    data = None
+    ser = None
+    try:
+      # Read kamstrup via MBUS; serial port stays open between reads
+      ser = self.__mbus_session.serial()
+      if self.__capture:
+        ser = telegram_capture.CaptureSerial(ser)
+      data = self.__read_telegram(ser)
+
+    except (serial.SerialException, OSError) as e:
+      # I/O error; serial port will be reopened
+      self.__mbus_session.io_error(e)
+      self.__is_connected = False
+
+    except Exception as e:
+      logger.warning(f"{self.__name}: {e}")
+
+      # Flag that we are not connected to Kamstrup or not successfull in getting a telegram
+      self.__is_connected = False
+
+    else:
+      # We are still connected to Kamstrup meter
+      self.__is_connected = True
+      self.__mbus_session.io_ok()
+
+      # We did read values; increment counter
+      self.__counter += 1
+      metrics.inc("mbus_reads_total", self.__labels)
+
+    if self.__capture and ser is not None:
+      self.__capture.write(self.__name, ser.tx, ser.rx)
+
+    return data
+
+  def replay(self, ts, frames):
+    """
+    Decode and publish captured telegrams (replay mode), as if they were read from the device
 
-    logger.debug(f"<< {self.__name}")
+    :param int ts: timestamp for MQTT (time of capture)
+    :param list frames: raw long frames of one read (more than one of a multi telegram readout);
+                        empty when captured read failed
+    :return: None
+    """
+    self.__json_values["timestamp"] = ts
+    self.__is_connected = bool(frames)
+    if self.__is_connected:
+      self.__counter += 1
+
+    # Earlier telegrams of a multi telegram readout
+    self.__readout = dict()
+    self.__readout_error = None
+    for index, data in enumerate(frames[:-1]):
+      self.__decode_earlier(data, index)
+
+    self.__telegram = len(frames) - 1
+    self.publish(frames[-1] if frames else None)
+
+  def publish(self, data):
+    """
+    Decode telegram and publish values to MQTT
+    Call after MBUS has been released
+
+    :param bytes data: raw long frame, as returned by read()
+    :return: None
+    """
+    if self.__is_connected:
+      # Build a dict of key:value, for MQTT JSON
+      # Values are only used when all telegrams of the readout are decoded
+      try:
+        if self.__readout_error is not None:
+          raise self.__readout_error
+
+        t = time.monotonic()
+        self.__decode(data, self.__telegram)
+        metrics.observe("mbus_decode_seconds", time.monotonic() - t, self.__labels)
+        self.__json_values.update(self.__readout)
+      except Exception as e:
+        logger.warning(f"{self.__name}: Cannot decode telegram; {e}")
+        self.__is_connected = False
+
+    self.__readout = dict()
+    self.__readout_error = None
+    self.__publish_telegram()
+
+
+class TaskReadHeatMeter(threading.Thread):
+  """
+  Read one device (MBUS_SCHEDULER = "device")
+  """
+  def __init__(self, heatmeter, mbus_session, t_readrate, t_threads_stopper, governor=None):
+    logger.debug(">> %s", heatmeter.name)
+    super().__init__()
+    self.__name = heatmeter.name
+    self.__heatmeter = heatmeter
+
+    # Serial session of the MBUS this device is connected to; shared with other devices on same MBUS
+    self.__mbus_session = mbus_session
+
+    # determine when to read MBUS device
+    self.__t_readrate = t_readrate
+
+    # Signal when to stop
+    self.__t_threads_stopper = t_threads_stopper
+
+    # Stretches read interval of free running devices when bus is overloaded; None is no stretching
+    self.__governor = governor
+
+    logger.debug("<< %s", self.__name)
     return
 
+  def __del__(self):
+    logger.debug(">> %s", self.__name)
+
   def __read_mbus(self):
     """
     Read Kamstrup via MBUS
@@ -103,129 +550,71 @@ class TaskReadHeatMeter(threading.Thread):
 
     :return: None
     """
-    logger.debug(f">> {self.__name}")
+    logger.debug(">> %s", self.__name)
 
-    # Clear the dict where we store all Kamstrup meter values
-    self.__json_values.clear()
-
-    # Loop forever till threads are requested to stop
-    while not self.__t_threads_stopper.is_set():
-      # wait till trigger to read values (or time out and start from start)
-      if not self.__t_readrate.wait(0.2):
-        continue
-      else:
-        # Read all registers from Kamstrup Multical
+    # Free running device; read when own deadline is due
+    if self.__heatmeter.interval is not None:
+      deadline = time.monotonic()
+      while not self.__t_threads_stopper.wait(max(0.0, deadline - time.monotonic())):
+        self.__mbus_session.acquire()
         try:
-          t = time.time()
+          data = self.__heatmeter.read(int(time.time()))
+        finally:
+          self.__mbus_session.release()
 
-          # get semaphore, as only one device can be read at same time via same MBUS
-          self.__mbus_semaphore.acquire()
-          logger.debug(f"{self.__name}: Acquired mbus semapahore after t = {round(time.time() - t, 2)} seconds")
+        self.__heatmeter.publish(data)
+        deadline = self.__heatmeter.next_deadline(deadline, self.__stretch())
 
-          # Get timestamp and add to dict
-          ts = self.__t_readrate.timestamp()
-          self.__json_values["timestamp"] = ts
+      logger.debug("<< %s", self.__name)
+      return
 
-          # Read kamstrup via MBUS
-          with serial.Serial(cfg.MBUS_PORT, cfg.MBUS_BAUDRATE, cfg.MBUS_BYTESIZE, cfg.MBUS_PARITY, cfg.MBUS_STOPBIT, timeout=0.5) as ser:
-            meterbus.send_ping_frame(ser, self.__mbus_address)
-            frame = meterbus.load(meterbus.recv_frame(ser, 1))
-            assert isinstance(frame, meterbus.TelegramACK), "Meterbus did not return a meterbus.TelegramACK"
+    # Last read cycle handled
+    cycle = 0
 
-            meterbus.send_request_frame(ser, self.__mbus_address)
-            frame = meterbus.load(meterbus.recv_frame(ser, meterbus.FRAME_DATA_LENGTH))
-            assert isinstance(frame, meterbus.TelegramLong), "Meterbus did not return a meterbus.TelegramLong"
+    # Loop forever till timer has stopped; a cycle triggered before stop is released below
+    while True:
+      # wait till trigger to read values for next cycle
+      cycle = self.__t_readrate.wait_next(cycle)
+      if cycle is None:
+        break
 
-            # Convert telegram to JSON to a DICT
-            kamstrup_json = frame.to_JSON()
-            kamstrup_dict = json.loads(kamstrup_json)
+      # Triggered cycle has to be released, also when stopping
+      if self.__t_threads_stopper.is_set():
+        self.__t_readrate.release(self.__name)
+        break
 
-        except Exception as e:
-          logger.warning(f"{e}")
+      # get MBUS, as only one device can be read at same time via same MBUS
+      # Wait time is measured by MBusSession (metric mbus_bus_wait_seconds)
+      self.__mbus_session.acquire()
 
-          # Flag that we are not connected to Kamstrup or not successfull in getting a telegram
-          self.__is_connected = False
+      # Read all registers from Kamstrup Multical
+      # Cycle is released after telegram has been published (aggregated burst is complete)
+      try:
+        try:
+          data = self.__heatmeter.read(self.__t_readrate.timestamp())
 
-        else:
-          # We are still connected to Kamstrup meter
-          self.__is_connected = True
+        finally:
+          # MBUS can be released
+          self.__mbus_session.release()
 
-          # We did read values; increment counter
-          self.__counter += 1
+        # Start parsing
+        self.__heatmeter.publish(data)
 
-        finally:
-          # Start parsing
-
-          # Semaphore can be released
-          self.__mbus_semaphore.release()
-          self.__t_readrate.release(self.__name)
-
-          if self.__is_connected:
-            # Build a dict of key:value, for MQTT JSON
-            # Do some rework on received values
-            for record in kamstrup_dict['body']['records']:
-              logger.debug(f"RECORD = {record}")
-
-              """
-              Multical 303:
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.ENERGY_WH', 'unit': 'MeasureUnit.WH', 'value': 70000}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.VOLUME', 'unit': 'MeasureUnit.M3', 'value': 69.66}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 2125}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 2166}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.ON_TIME', 'unit': 'MeasureUnit.SECONDS', 'value': 16038000}
-              RECORD = {'function': 'FunctionType.ERROR_STATE_VALUE', 'storage_number': 0, 'type': 'VIFUnit.ON_TIME', 'unit': 'MeasureUnit.SECONDS', 'value': 93600}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.FLOW_TEMPERATURE', 'unit': 'MeasureUnit.C', 'value': 31.560000000000002}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.RETURN_TEMPERATURE', 'unit': 'MeasureUnit.C', 'value': 30.330000000000002}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.TEMPERATURE_DIFFERENCE', 'unit': 'MeasureUnit.K', 'value': 1.23}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.POWER_W', 'unit': 'MeasureUnit.W', 'value': 2100}
-              RECORD = {'function': 'FunctionType.MAXIMUM_VALUE', 'storage_number': 0, 'type': 'VIFUnit.POWER_W', 'unit': 'MeasureUnit.W', 'value': -10000}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.VOLUME_FLOW', 'unit': 'MeasureUnit.M3_H', 'value': 1.299}
-              RECORD = {'function': 'FunctionType.MAXIMUM_VALUE', 'storage_number': 0, 'type': 'VIFUnit.VOLUME_FLOW', 'unit': 'MeasureUnit.M3_H', 'value': 1.584}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 0, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 0}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.ENERGY_WH', 'unit': 'MeasureUnit.WH', 'value': 0}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.VOLUME', 'unit': 'MeasureUnit.M3', 'value': 0}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 0}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.MANUFACTURER_SPEC', 'unit': 'MeasureUnit.NONE', 'value': 0}
-              RECORD = {'function': 'FunctionType.MAXIMUM_VALUE', 'storage_number': 1, 'type': 'VIFUnit.POWER_W', 'unit': 'MeasureUnit.W', 'value': 0}
-              RECORD = {'function': 'FunctionType.MAXIMUM_VALUE', 'storage_number': 1, 'type': 'VIFUnit.VOLUME_FLOW', 'unit': 'MeasureUnit.M3_H', 'value': 0}
-              RECORD = {'function': 'FunctionType.INSTANTANEOUS_VALUE', 'storage_number': 1, 'type': 'VIFUnit.DATE', 'unit': 'MeasureUnit.DATE', 'value': '2023-01-01'}
-              """
-
-              # storage numer 1 does not contain any relevant values for Multical 303
-              if record['storage_number'] == 1:
-                continue
-
-              if record['function'] == "FunctionType.INSTANTANEOUS_VALUE":
-                newvalue = str(record['type']).replace("VIFUnit.", "")
-                record.update({'type': newvalue})
-
-                # For Multical 601
-                if "tariff" in record:
-                  # device = d; tariff = t
-                  logger.debug(f"{self.__name}: RECORD: {record['type']}_d{record['device']}_t{record['tariff']} = {record['value']}")
-                  self.__json_values[f"{record['type']}_d{record['device']}_t{record['tariff']}"] = record['value']
-                else:
-                  logger.debug(f"{self.__name}: RECORD: {record['type']} = {record['value']}")
-
-                  # For temperatures, round to 2 digits
-                  if record['type'] == "FLOW_TEMPERATURE" or record['type'] == "RETURN_TEMPERATURE":
-                    self.__json_values[f"{record['type']}"] = round(record['value'],2)
-                  else:
-                    self.__json_values[f"{record['type']}"] = record['value']
-
-          self.__publish_telegram()
-
-      # As __t_readrate is still set, and to prevent that we will read again the heat meter in current sequence;
-      # wait till __t_readrate gets cleared; After __t_readrate is cleared, start from top
-      while self.__t_readrate.is_set():
-        logger.debug(f"{self.__name}: Wait till all tasks are done")
-        time.sleep(0.2)
-
-    logger.debug(f"<< {self.__name}")
+      finally:
+        self.__t_readrate.release(self.__name)
+
+    logger.debug("<< %s", self.__name)
     return
 
+  def __stretch(self):
+    """
+    :return: factor to stretch read interval of free running devices with
+    :rtype: float
+    """
+    return self.__governor.stretch() if self.__governor else 1.0
+
   def run(self):
-    logger.debug(f">> {self.__name}")
+    logger.debug(">> %s", self.__name)
 
     while not self.__t_threads_stopper.is_set():
       try:
@@ -237,5 +626,145 @@ class TaskReadHeatMeter(threading.Thread):
         # Something unexpected happens, stop all threads
         self.__t_threads_stopper.set()
 
-    logger.debug(f"<<")
+    logger.debug("<<")
+    return
+
+
+class TaskReadMBus(threading.Thread):
+  """
+  Read all devices on one MBUS (MBUS_SCHEDULER = "bus")
+  The thread owns the bus; devices are read one after the other:
+  - devices without read_rate in configured order, when ReadRateTimer triggers a cycle
+  - free running devices (own read_rate) in order of deadline (heap)
+  """
+  def __init__(self, bus, mbus_session, heatmeters, t_readrate, t_threads_stopper, governor=None):
+    logger.debug(">> %s; nrof devices = %s", bus, len(heatmeters))
+    super().__init__()
+    self.__bus = bus
+    self.__mbus_session = mbus_session
+
+    # Devices read in the READ_RATE burst
+    self.__heatmeters = [heatmeter for heatmeter in heatmeters if heatmeter.interval is None]
+
+    # Free running devices
+    self.__free_running = [heatmeter for heatmeter in heatmeters if heatmeter.interval is not None]
+
+    # determine when to read MBUS devices
+    self.__t_readrate = t_readrate
+
+    # Signal when to stop
+    self.__t_threads_stopper = t_threads_stopper
+
+    # Stretches read interval of free running devices when bus is overloaded; None is no stretching
+    self.__governor = governor
+
+    logger.debug("<< %s", self.__bus)
+    return
+
+  def __read_mbus(self):
+    """
+    Read all Kamstrup devices on the MBUS
+    Parse data
+
+    :return: None
+    """
+    logger.debug(">> %s", self.__bus)
+
+    # Last read cycle handled
+    cycle = 0
+
+    # Heap of (deadline, index, heatmeter) of free running devices; all are due at start
+    # index keeps order of equal deadlines deterministic
+    now = time.monotonic()
+    schedule = [(now, index, heatmeter) for index, heatmeter in enumerate(self.__free_running)]
+    heapq.heapify(schedule)
+
+    # Loop forever till timer has stopped; a cycle triggered before stop is released by __read_burst()
+    while True:
+      # wait till trigger to read values for next cycle, or till next free running device is due
+      # When stopping, only wait for a cycle to release or for the timer to stop
+      timeout = None
+      if schedule and not self.__t_threads_stopper.is_set():
+        timeout = max(0.0, schedule[0][0] - time.monotonic())
+      next_cycle = self.__t_readrate.wait_next(cycle, timeout)
+      if next_cycle is None:
+        break
+
+      if next_cycle != cycle:
+        cycle = next_cycle
+        self.__read_burst()
+
+      # Read free running devices which are due; devices becoming due meanwhile wait for next pass,
+      # so a READ_RATE cycle is not starved
+      now = time.monotonic()
+      while schedule and schedule[0][0] <= now and not self.__t_threads_stopper.is_set():
+        deadline, index, heatmeter = heapq.heappop(schedule)
+        self.__read(heatmeter, int(time.time()))
+        heapq.heappush(schedule, (heatmeter.next_deadline(deadline, self.__stretch()), index, heatmeter))
+
+    logger.debug("<< %s", self.__bus)
+    return
+
+  def __read(self, heatmeter, ts):
+    """
+    Read one device and publish its values
+
+    :param HeatMeter heatmeter:
+    :param int ts: timestamp for MQTT
+    :return: None
+    """
+    self.__mbus_session.acquire()
+    try:
+      data = heatmeter.read(ts)
+    finally:
+      self.__mbus_session.release()
+
+    heatmeter.publish(data)
+
+  def __read_burst(self):
+    """
+    Read all devices of the READ_RATE burst, in configured order
+    Every device releases ReadRateTimer, also when stopping or when reading a device raised an exception
+
+    :return: None
+    """
+    released = 0
+    try:
+      for heatmeter in self.__heatmeters:
+        if self.__t_threads_stopper.is_set():
+          continue
+
+        # Cycle is released after telegram has been published (aggregated burst is complete)
+        try:
+          self.__read(heatmeter, self.__t_readrate.timestamp())
+        finally:
+          self.__t_readrate.release(heatmeter.name)
+          released += 1
+
+    finally:
+      # Devices not read (stopping or exception); thread stops after an exception
+      for heatmeter in self.__heatmeters[released:]:
+        self.__t_readrate.release(heatmeter.name)
+
+  def __stretch(self):
+    """
+    :return: factor to stretch read interval of free running devices with
+    :rtype: float
+    """
+    return self.__governor.stretch() if self.__governor else 1.0
+
+  def run(self):
+    logger.debug(">> %s", self.__bus)
+
+    while not self.__t_threads_stopper.is_set():
+      try:
+        self.__read_mbus()
+
+      except Exception as e:
+        logger.error(f"{self.__bus}: {e}")
+
+        # Something unexpected happens, stop all threads
+        self.__t_threads_stopper.set()
+
+    logger.debug("<<")
     return
@@ -1,6 +1,6 @@
-from . log import logger
+from . log import logger, set_console_stream
 
 
-__version__ = "1.2.0"
+__version__ = "1.3.0"
 __author__  = "Hans IJntema"
 __license__ = "GPLv3"
\ No newline at end of file
@@ -22,6 +22,14 @@ script=os.path.basename(__main__.__file__)
 script=os.path.splitext(script)[0]
 logger = logging.getLogger(script + "." +  __name__)
 ====================================================================
+V1.3.0
+  Handlers run in a QueueListener thread; logging does not block on syslog/console/file
+  Identical warnings (and higher) are suppressed for DUPLICATE_INTERVAL seconds
+  Guard expensive debug formatting with: if logger.isEnabledFor(logging.DEBUG):
+
+V1.2.1
+  set_console_stream(); console messages to stderr when stdout carries data
+
 V1.2.0
   11-4-2023
   Restructering directory; __init__.py; no code change
@@ -55,10 +63,14 @@ V0.1:
 # Logging
 # ------------------------------------------------------------------------------------
 import __main__
+import atexit
 import logging
-from logging.handlers import SysLogHandler
+from logging.handlers import SysLogHandler, QueueHandler, QueueListener
 import os
+import queue
 import sys
+import threading
+import time
 import getpass
 
 
@@ -73,13 +85,69 @@ logger = logging.getLogger(script)
 logger.setLevel(logging.INFO)  # DEBUG, INFO, WARNING, ERROR, CRITICAL
 logger.propagate = False
 
+# Seconds an identical warning (or error) is suppressed after it has been logged
+DUPLICATE_INTERVAL = 60
+
+# Handlers are run by the QueueListener thread
+handlers = list()
+
+
+class DuplicateFilter(logging.Filter):
+  """
+  Suppress identical messages of level WARNING and higher for DUPLICATE_INTERVAL seconds,
+  eg an offline meter at a high READ_RATE
+  Nrof suppressed messages is appended to the next identical message that is logged
+  """
+  def __init__(self, interval=DUPLICATE_INTERVAL):
+    super().__init__()
+    self.__interval = interval
+    self.__lock = threading.Lock()
+
+    # (logger name, level, message):[time logged, nrof suppressed]
+    self.__seen = dict()
+
+  def filter(self, record):
+    if record.levelno < logging.WARNING:
+      return True
+
+    message = record.getMessage()
+    key = (record.name, record.levelno, message)
+    now = time.monotonic()
+    with self.__lock:
+      entry = self.__seen.get(key)
+      if entry is not None and now - entry[0] < self.__interval:
+        entry[1] += 1
+        return False
+
+      if entry is not None and entry[1]:
+        record.msg = f"{message} (suppressed {entry[1]} times in last {round(now - entry[0])} s)"
+        record.args = None
+
+      # Forget messages which are not repeated
+      if len(self.__seen) >= 1000:
+        self.__seen = {k: v for k, v in self.__seen.items() if now - v[0] < self.__interval}
+      self.__seen[key] = [now, 0]
+
+    return True
+
 # Console stdout
 c_handler = logging.StreamHandler(sys.stdout)
 # This setLevel determines wich messages are processed by this handler (assuming it arrives from global logger)
 c_handler.setLevel(logging.DEBUG)
 c_format = logging.Formatter('%(name)s %(levelname)s: FUNCTION:%(funcName)s LINE:%(lineno)d: %(message)s')
 c_handler.setFormatter(c_format)
-logger.addHandler(c_handler)
+handlers.append(c_handler)
+
+
+def set_console_stream(stream):
+  """
+  Redirect console messages, eg to sys.stderr when stdout is used for data
+
+  :param stream: sys.stdout or sys.stderr
+  :return: None
+  """
+  c_handler.setStream(stream)
+
 
 # Syslog
 if sys.platform == "linux":
@@ -90,7 +158,7 @@ if sys.platform == "linux":
                                '%(asctime)s FUNCTION:%(funcName)s LINE:%(lineno)d: %(message)s',
                                datefmt='%H:%M:%S')
   s_handler.setFormatter(s_format)
-  logger.addHandler(s_handler)
+  handlers.append(s_handler)
 
 
 # File
@@ -106,10 +174,25 @@ try:
                                '%(asctime)s FUNCTION:%(funcName)s LINE:%(lineno)d: %(message)s',
                                datefmt='%Y-%m-%d,%H:%M:%S')
   f_handler.setFormatter(f_format)
-  logger.addHandler(f_handler)
+  handlers.append(f_handler)
 except Exception as e:
   print(f"Exception {e}: /dev/shm/{script}.log permission denied")
 
+
+# Queue
+# Calling threads (eg reading the MBUS) only put records in the queue; handlers are run by the listener thread
+# Messages are formatted and duplicates are filtered in the calling thread
+log_queue = queue.SimpleQueue()
+q_handler = QueueHandler(log_queue)
+q_handler.addFilter(DuplicateFilter())
+logger.addHandler(q_handler)
+
+listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+listener.start()
+
+# Flush queued messages at exit
+atexit.register(listener.stop)
+
 # logger.debug('This is a debug message')
 # logger.info('This is an info message')
 # logger.warning('This is a warning message')
@@ -0,0 +1,209 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Own the serial port of one MBUS bus for the lifetime of the parser
+- Shared by all devices on that bus; only one device can be read at same time (half duplex)
+- Flush input buffer between transactions
+- Reopen port (with backoff) only after an I/O error
+"""
+
+import threading
+import time
+import serial
+
+# Local imports
+import metrics
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+
+class MBusSession:
+  """
+  Serial session for one MBUS bus
+  """
+
+  # Backoff (seconds) before reopening port after an I/O error; doubles after every failure
+  BACKOFF_MIN = 1
+  BACKOFF_MAX = 60
+
+  def __init__(self, port, baudrate, bytesize, parity, stopbits, timeout=0.5):
+    """
+    Args:
+      :param str port: serial device, eg /dev/tty-mbus
+      :param int baudrate:
+      :param int bytesize:
+      :param str parity:
+      :param float stopbits:
+      :param float timeout: read timeout in seconds
+
+    Returns:
+      None
+    """
+    logger.debug(f">> port = {port}")
+
+    self.__port = port
+    self.__baudrate = baudrate
+    self.__bytesize = bytesize
+    self.__parity = parity
+    self.__stopbits = stopbits
+    self.__timeout = timeout
+
+    # Open serial port; None when closed
+    self.__ser = None
+
+    # Only one device can be read at same time via same MBUS
+    self.__semaphore = threading.Semaphore(1)
+
+    # Total time (seconds) the bus has been held; measures bus occupancy (bus_planner.BusGovernor)
+    self.__busy_time = 0.0
+    self.__acquire_time = 0
+
+    # Bookkeeping for reopening port after an I/O error
+    self.__backoff = 0
+    self.__reopen_time = 0
+
+    logger.debug("<<")
+    return
+
+  @property
+  def port(self):
+    return self.__port
+
+  @property
+  def baudrate(self):
+    return self.__baudrate
+
+  @property
+  def busy_time(self):
+    return self.__busy_time
+
+  def acquire(self):
+    """
+    Get exclusive access to the bus
+
+    :return: None
+    """
+    t = time.monotonic()
+    self.__semaphore.acquire()
+    self.__acquire_time = time.monotonic()
+    metrics.observe("mbus_bus_wait_seconds", self.__acquire_time - t, {"bus": self.__port})
+
+  def release(self):
+    """
+    Release exclusive access to the bus
+
+    :return: None
+    """
+    self.__busy_time += time.monotonic() - self.__acquire_time
+    self.__semaphore.release()
+
+  def serial(self):
+    """
+    Return the open serial port; (re)open port when required
+    Input buffer is flushed, to start every transaction with an empty buffer
+    Call only while holding the bus (acquire)
+
+    :return: serial.Serial
+    :raises serial.SerialException: when port cannot be opened or reopen is postponed (backoff)
+    """
+    if self.__ser is None:
+      wait = self.__reopen_time - time.monotonic()
+      if wait > 0:
+        raise serial.SerialException(f"{self.__port}: reopen postponed for {round(wait, 1)} seconds")
+
+      self.__ser = serial.Serial(self.__port,
+                                 self.__baudrate,
+                                 self.__bytesize,
+                                 self.__parity,
+                                 self.__stopbits,
+                                 timeout=self.__timeout)
+      logger.info(f"Opened {self.__port}; baudrate = {self.__baudrate}")
+
+    self.__ser.reset_input_buffer()
+    return self.__ser
+
+  def io_ok(self):
+    """
+    Transaction completed without I/O error; reset backoff
+
+    :return: None
+    """
+    self.__backoff = 0
+
+  def io_error(self, e):
+    """
+    I/O error on serial port; close port and postpone reopening
+    Errors raised while reopening is postponed do not extend the backoff
+
+    :param Exception e: the I/O error
+    :return: None
+    """
+    if time.monotonic() < self.__reopen_time:
+      return
+
+    self.__backoff = min(max(self.__backoff * 2, self.BACKOFF_MIN), self.BACKOFF_MAX)
+    self.__reopen_time = time.monotonic() + self.__backoff
+    logger.warning(f"{self.__port}: I/O error {e}; reopen port after {self.__backoff} seconds")
+    self.close()
+
+  def close(self):
+    """
+    Close serial port
+
+    :return: None
+    """
+    if self.__ser is not None:
+      try:
+        self.__ser.close()
+      except Exception as e:
+        logger.warning(f"{self.__port}: {e}")
+
+      self.__ser = None
+      logger.debug(f"Closed {self.__port}")
+
+
+def configured_buses(config):
+  """
+  MBUS_BUSES of a configuration
+  Configurations from before MBUS_BUSES (MBUS_PORT, MBUS_BAUDRATE, ...) have a single bus 'mbus0'
+
+  :param config: configuration module
+  :return: MBUS_BUSES
+  :rtype: dict
+  :raises AttributeError: when neither MBUS_BUSES nor MBUS_PORT and friends are configured
+  """
+  if hasattr(config, "MBUS_BUSES"):
+    return config.MBUS_BUSES
+
+  try:
+    buses = {'mbus0': {'port': config.MBUS_PORT,
+                       'baudrate': config.MBUS_BAUDRATE,
+                       'bytesize': config.MBUS_BYTESIZE,
+                       'parity': config.MBUS_PARITY,
+                       'stopbits': config.MBUS_STOPBIT}}
+  except AttributeError as e:
+    raise AttributeError(f"MBUS_BUSES is not configured ({e}); see config.rename.py") from None
+
+  logger.warning("MBUS_PORT, MBUS_BAUDRATE, MBUS_BYTESIZE, MBUS_PARITY and MBUS_STOPBIT are deprecated; "
+                 "replace them by MBUS_BUSES (see config.rename.py)")
+  return buses
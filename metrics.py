@@ -0,0 +1,288 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Metrics registry: counters, gauges and histograms, with labels (eg meter, bus)
+- One registry per process (REGISTRY), like logging; use the module functions inc(), observe() and gauge()
+- TaskMetrics exports the registry every METRICS_INTERVAL seconds:
+  - retained to <MQTT_TOPIC_PREFIX>/metrics
+  - optionally as Prometheus text file (METRICS_PROMETHEUS_FILE), eg for node_exporter textfile collector
+
+Metrics:
+  mbus_bus_wait_seconds{bus}          wait for bus (semaphore)
+  mbus_ping_seconds{meter}            SND_NKE round trip
+  mbus_response_seconds{meter}        REQ_UD2 round trip (request till complete long frame)
+  mbus_decode_seconds{meter}          decode of telegram
+  mbus_burst_seconds                  READ_RATE burst
+  mbus_reads_total{meter}             successful reads
+  mbus_late_total{meter}              skipped reads of free running device (read was late)
+  mbus_timeouts_total{meter}          no or incomplete response
+  mbus_frame_errors_total{meter}      invalid frame (checksum, start/stop byte, length)
+  mqtt_publish_latency_seconds        enqueue till published (QoS>0: acknowledged)
+  mqtt_*                              MQTT client statistics (collected at export)
+"""
+
+import bisect
+import json
+import threading
+import time
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Upper bounds (seconds) of histogram buckets; MBUS transactions at 2400 baud take 0.05 - 1 seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+  """
+  Observations counted per bucket (not cumulative), with count, sum and max
+  """
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def summary(self):
+    """
+    :return: count, sum, avg, max and cumulative count per bucket upper bound
+    :rtype: dict
+    """
+    cumulative = 0
+    buckets = dict()
+    for bound, count in zip(self.buckets, self.counts):
+      cumulative += count
+      buckets[str(bound)] = cumulative
+    return {"count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "buckets": buckets}
+
+
+def _labels(labels):
+  """
+  :param dict labels: name:value
+  :return: hashable, sorted labels
+  :rtype: tuple
+  """
+  return tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value):
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_labels(labels, extra=()):
+  labels = tuple(labels) + tuple(extra)
+  if not labels:
+    return ""
+  return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Registry:
+  """
+  Thread safe collection of metrics
+  """
+  def __init__(self):
+    self.__lock = threading.Lock()
+
+    # (name, labels):value or Histogram
+    self.__counters = dict()
+    self.__gauges = dict()
+    self.__histograms = dict()
+
+    # Functions returning {name: value} of gauges, called at export (eg MQTT client statistics)
+    self.__collectors = list()
+
+  def inc(self, name, labels=None, value=1):
+    """
+    Increment counter
+
+    :param str name: eg "mbus_timeouts_total"
+    :param dict labels: eg {"meter": "MC303"}
+    :param value: increment
+    :return: None
+    """
+    key = (name, _labels(labels))
+    with self.__lock:
+      self.__counters[key] = self.__counters.get(key, 0) + value
+
+  def set(self, name, value, labels=None):
+    """
+    Set gauge
+
+    :param str name:
+    :param value:
+    :param dict labels:
+    :return: None
+    """
+    with self.__lock:
+      self.__gauges[(name, _labels(labels))] = value
+
+  def observe(self, name, value, labels=None, buckets=BUCKETS):
+    """
+    Add observation to histogram
+
+    :param str name: eg "mbus_response_seconds"
+    :param float value: eg seconds
+    :param dict labels: eg {"meter": "MC303"}
+    :param tuple buckets: upper bounds; used when histogram is created
+    :return: None
+    """
+    key = (name, _labels(labels))
+    with self.__lock:
+      histogram = self.__histograms.get(key)
+      if histogram is None:
+        histogram = self.__histograms[key] = Histogram(buckets)
+      histogram.observe(value)
+
+  def add_collector(self, collector):
+    """
+    :param collector: function returning {name: value}; called at every export
+    :return: None
+    """
+    self.__collectors.append(collector)
+
+  def __collect(self):
+    for collector in self.__collectors:
+      try:
+        for name, value in collector().items():
+          self.set(name, value)
+      except Exception as e:
+        logger.warning(f"Collector {collector}: {e}")
+
+  def snapshot(self):
+    """
+    :return: {name: {"label=value,...": value or histogram summary}}; "" is key without labels
+    :rtype: dict
+    """
+    self.__collect()
+
+    document = dict()
+    with self.__lock:
+      for metrics in (self.__counters, self.__gauges, self.__histograms):
+        for (name, labels), value in sorted(metrics.items()):
+          key = ",".join(f"{label}={label_value}" for label, label_value in labels)
+          document.setdefault(name, dict())[key] = value.summary() if isinstance(value, Histogram) else value
+
+    return document
+
+  def prometheus(self):
+    """
+    :return: metrics in Prometheus text exposition format
+    :rtype: str
+    """
+    self.__collect()
+
+    lines = list()
+    with self.__lock:
+      for metrics, metric_type in ((self.__counters, "counter"), (self.__gauges, "gauge")):
+        last = None
+        for (name, labels), value in sorted(metrics.items()):
+          if name != last:
+            lines.append(f"# TYPE {script.replace('-', '_')}_{name} {metric_type}")
+            last = name
+          lines.append(f"{script.replace('-', '_')}_{name}{_prometheus_labels(labels)} {float(value)}")
+
+      last = None
+      for (name, labels), histogram in sorted(self.__histograms.items()):
+        full_name = f"{script.replace('-', '_')}_{name}"
+        if name != last:
+          lines.append(f"# TYPE {full_name} histogram")
+          last = name
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+          cumulative += count
+          le = "+Inf" if bound == float("inf") else str(bound)
+          lines.append(f"{full_name}_bucket{_prometheus_labels(labels, (('le', le),))} {cumulative}")
+        lines.append(f"{full_name}_sum{_prometheus_labels(labels)} {histogram.sum}")
+        lines.append(f"{full_name}_count{_prometheus_labels(labels)} {histogram.count}")
+
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+gauge = REGISTRY.set
+observe = REGISTRY.observe
+
+
+class TaskMetrics(threading.Thread):
+  """
+  Export REGISTRY periodically to MQTT (retained) and optionally to a Prometheus text file
+  """
+  def __init__(self, t_mqtt, topic, interval, prometheus_file, t_threads_stopper, encode=json.dumps):
+    """
+    Args:
+      :param mqtt.MQTTClient t_mqtt:
+      :param str topic: retained metrics topic
+      :param float interval: seconds between exports
+      :param str prometheus_file: Prometheus text file; None is no file
+      :param threading.Event t_threads_stopper:
+      :param encode: function encoding the metrics document to a MQTT payload
+
+    Returns:
+      None
+    """
+    logger.debug(f">> topic = {topic}; interval = {interval}")
+    super().__init__()
+    self.__t_mqtt = t_mqtt
+    self.__topic = topic
+    self.__interval = interval
+    self.__prometheus_file = prometheus_file
+    self.__t_threads_stopper = t_threads_stopper
+    self.__encode = encode
+    logger.debug("<<")
+
+  def __export(self):
+    document = REGISTRY.snapshot()
+    document["timestamp"] = int(time.time())
+    self.__t_mqtt.do_publish(self.__topic, self.__encode(document), retain=True)
+
+    if self.__prometheus_file:
+      # Write atomically; scrapers never see a partial file
+      try:
+        with open(self.__prometheus_file + ".tmp", "w") as f:
+          f.write(REGISTRY.prometheus())
+        os.replace(self.__prometheus_file + ".tmp", self.__prometheus_file)
+      except OSError as e:
+        logger.warning(f"{self.__prometheus_file}: {e}")
+
+  def run(self):
+    logger.debug(">>")
+    while not self.__t_threads_stopper.wait(self.__interval):
+      # A failing export (collector, encoding, publish) does not stop exporting
+      try:
+        self.__export()
+      except Exception:
+        logger.exception("Metrics export failed")
+
+    logger.debug("<<")
@@ -1,8 +1,10 @@
 from . mqtt import MQTTClient
-from paho.mqtt.client import MQTTv31
-from paho.mqtt.client import MQTTv311
-from paho.mqtt.client import MQTTv5
+from . mqtt import MQTTv31
+from . mqtt import MQTTv311
+from . mqtt import MQTTv5
+from . spool import Spool
+from . publish_queue import PublishQueue
 
-__version__ = "2.0.0"
+__version__ = "2.5.2"
 __author__ = "Hans IJntema"
 __license__ = "GPLv3"
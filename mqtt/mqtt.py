@@ -17,6 +17,13 @@
   V1.1.5: Fix MQTT_ERR_NOMEM
   v1.1.6: Add clean session
   v2.0.0: Parameterize clean session; remove mqtt-rate
+  v2.1.0: Optional disk spool (store and forward) while disconnected from broker
+  v2.2.0: Optional bounded publish queue with drop policies; publish statistics
+  v2.3.0: Event driven main loop; own reconnect state machine with jittered exponential backoff; outage statistics
+  v2.4.0: Non blocking start; no connectivity probe; paho is imported and client is created on first use
+  v2.5.0: Optional latency observer (eg metrics histogram); nrof published messages in publish statistics
+  v2.5.1: No debug formatting of messages and paho callbacks when debug logging is disabled
+  v2.5.2: Wake up MQTT loop when a message is spooled
 
   LIMITATIONS
   * Only transport = TCP supported; websockets is not supported
@@ -43,14 +50,12 @@
 
 """
 
+import collections
+import re
 import time
 import threading
 import random
 import string
-import socket
-import paho.mqtt.client as mqtt_client
-import paho.mqtt as paho_mqtt
-from pkg_resources import parse_version
 
 # Logging
 import __main__
@@ -66,6 +71,40 @@ logger = logging.getLogger(script + "." + __name__)
 # However, there are cases that client freezes for ethernity after a MQTT_ERR_NOMEM
 # Implement a recover? With timeout? Try to reconnect?
 
+# paho is imported when the client is created (__client()), to keep it out of the startup path
+mqtt_client = None
+paho_mqtt = None
+
+# MQTT protocol versions (as paho.mqtt.client)
+MQTTv31 = 3
+MQTTv311 = 4
+MQTTv5 = 5
+
+
+def _import_paho():
+  global mqtt_client, paho_mqtt
+  import paho.mqtt.client as mqtt_client
+  import paho.mqtt as paho_mqtt
+
+
+def _version(version):
+  """
+  :param str version: eg "1.6.1"
+  :return: (major, minor, patch) for comparing
+  :rtype: tuple
+  """
+  return tuple(int(number) for number in re.findall(r"\d+", version)[:3])
+
+
+# Main loop wakes up at least every IDLE_TIMEOUT seconds, also when nothing happens
+IDLE_TIMEOUT = 60
+
+# Max seconds between connect and CONNACK
+CONNECT_TIMEOUT = 30
+
+# Max nrof queued or spooled messages handed to paho and not yet published (paho default of max inflight messages)
+MAX_INFLIGHT = 20
+
 
 class MQTTClient(threading.Thread):
   def __init__(self,
@@ -75,10 +114,16 @@ class MQTTClient(threading.Thread):
                mqtt_client_id=None,
                mqtt_qos=1,
                mqtt_cleansession=True,
-               mqtt_protocol=mqtt_client.MQTTv311,
+               mqtt_protocol=MQTTv311,
                username="",
                password="",
-               worker_threads_stopper=None):
+               worker_threads_stopper=None,
+               spool=None,
+               spool_drain_rate=20,
+               publish_queue=None,
+               reconnect_min_delay=1,
+               reconnect_max_delay=360,
+               latency_observer=None):
 
     """
     Args:
@@ -95,12 +140,20 @@ class MQTTClient(threading.Thread):
       :param threading.Event() worker_threads_stopper: stopper event for other worker threads;
       typically the worker threads are
              stopped in the main loop before the mqtt thread;but mqtt thread can also set this in case of failure
+      :param mqtt.spool.Spool spool: OPTIONAL: store messages on disk while disconnected, instead of in memory
+      :param float spool_drain_rate: max nrof spooled messages per second published after reconnect
+      :param mqtt.publish_queue.PublishQueue publish_queue: OPTIONAL: do_publish() queues messages,
+      which are handed to paho by the MQTT thread when connected (or spooled)
+      :param float reconnect_min_delay: delay before first reconnect attempt; doubles every failed attempt
+      :param float reconnect_max_delay: max delay between reconnect attempts
+      :param latency_observer: OPTIONAL: function called with enqueue to publish latency (seconds) of every
+      queued or spooled message
 
     Returns:
       None
     """
 
-    logger.info(f">> paho-mqtt version = {paho_mqtt.__version__}")
+    logger.debug(">>")
     super().__init__()
 
     self.__mqtt_broker = mqtt_broker
@@ -125,72 +178,68 @@ class MQTTClient(threading.Thread):
     else:
       self.__worker_threads_stopper = worker_threads_stopper
 
-    # Check if installed paho-mqtt version supports MQTT v5
-    # Demote to v311 if wrong version is installed
-    if self.__mqtt_protocol == mqtt_client.MQTTv5:
-      if parse_version(f"{paho_mqtt.__version__}") < parse_version("1.5.1"):
-        logger.warning(f"Incorrect paho-mqtt version ({paho_mqtt.__version__}) to support MQTT v5, "
-                       f"reverting to MQTT v311")
-        self.__mqtt_protocol = mqtt_client.MQTTv311
-
-    # clean_session is only implemented for MQTT v3
-    if self.__mqtt_protocol == mqtt_client.MQTTv311 or self.__mqtt_protocol == mqtt_client.MQTTv31:
-      self.__mqtt = mqtt_client.Client(self.__mqtt_client_id,
-                                       clean_session=mqtt_cleansession,
-                                       protocol=self.__mqtt_protocol)
-    elif self.__mqtt_protocol == mqtt_client.MQTTv5:
-      self.__mqtt = mqtt_client.Client(self.__mqtt_client_id,
-                                       protocol=self.__mqtt_protocol)
-    else:
+    if self.__mqtt_protocol not in (MQTTv31, MQTTv311, MQTTv5):
       logger.error(f"Unknown MQTT protocol version {mqtt_protocol}....exit")
       self.__worker_threads_stopper.set()
       self.__mqtt_stopper.set()
       return
 
+    # paho client; created on first use by __client()
+    self.__mqtt = None
+    self.__mqtt_lock = threading.Lock()
+    self.__username = username
+    self.__password = password
+
+    # Last will/testament; set when client is created
+    self.__will = None
+
     # Indicate whether thread has started - run() has been called
     self.__run = False
 
     # Todo parameterize
     self.__keepalive = 600
 
-    # MQTT client tries to force a reconnection if
-    # Client remains disconnected for more than MQTT_CONNECTION_TIMEOUT seconds
-    self.__MQTT_CONNECTION_TIMEOUT = 60
-
-    # Call back functions
-    self.__mqtt.on_connect = self.__on_connect
-    self.__mqtt.on_disconnect = self.__on_disconnect
-    self.__mqtt.on_message = self.__on_message
-
-    # Uncomment if needed for debugging
-#    self.__mqtt.on_publish = self.__on_publish
-#    self.__mqtt.on_log = self.__on_log
+    # Reconnect backoff
+    self.__reconnect_min_delay = reconnect_min_delay
+    self.__reconnect_max_delay = reconnect_max_delay
 
-    if self.__mqtt_protocol == mqtt_client.MQTTv311 or self.__mqtt_protocol == mqtt_client.MQTTv31:
-      self.__mqtt.on_subscribe = self.__on_subscribe_v31
-    elif self.__mqtt_protocol == mqtt_client.MQTTv5:
-      self.__mqtt.on_subscribe = self.__on_subscribe_v5
-    else:
-      self.__mqtt.on_subscribe = None
+    # Wakes up main loop: (dis)connect, publish, do_publish() and stop()
+    self.__wakeup = threading.Event()
 
-    self.__mqtt.on_unsubscribe = self.__on_unsubscribe
-
-    # Not yet implemented
-    # self.__mqtt.on_unsubscribe = self.__on_unsubscribe
+    # Set by callbacks when connection attempt failed or connection is lost; paho network thread has ended
+    self.__link_down = False
 
     # Managed via __set_connected_flag()
     # Keeps track of connected status
     self.__connected_flag = False
 
-    # Keep track how long client is disconnected
-    # When threshold is exceeded, try to recover
-    # In some cases, a MQTT_ERR_NOMEM is not recovered automatically
-    self.__disconnect_start_time = int(time.time())
+    # Outage statistics; outage is time (monotonic) between losing connection and reconnect
+    self.__outage_start = None
+    self.__nrof_outages = 0
+    self.__outage_total = 0.0
+    self.__outage_max = 0.0
+    self.__outage_last = 0.0
+    self.__nrof_connect_attempts = 0
 
     # Maintain a mqtt message count
     self.__mqtt_counter = 0
 
-    self.__mqtt.username_pw_set(username, password)
+    # Disk spool; messages are spooled when disconnected, or when spool is not yet drained (keep order)
+    self.__spool = spool
+    self.__spool_drain_rate = spool_drain_rate
+
+    # Bounded queue between publishing threads and MQTT thread; None is publish from calling thread
+    self.__publish_queue = publish_queue
+
+    # Queued/spooled messages handed to paho, not yet published:
+    # (MQTTMessageInfo, enqueue time or None, spool position or None)
+    self.__inflight = collections.deque()
+
+    # Enqueue to publish (QoS>0: acknowledged by broker) latency of queued messages
+    self.__latency_count = 0
+    self.__latency_sum = 0.0
+    self.__latency_max = 0.0
+    self.__latency_observer = latency_observer
 
     # status topic & message
     self.__status_topic = None
@@ -207,41 +256,92 @@ class MQTTClient(threading.Thread):
     # list of subscribed topics
     self.__list_of_subscribed_topics = []
 
-  def __del__(self):
-    logger.debug(f">>")
-    logger.info(f"Shutting down MQTT Client... {self.__mqtt_counter} MQTT messages have been published")
+  def __client(self):
+    """
+    paho client; created on first use
 
-  def __internet_on(self):
+    :return: paho client
+    :rtype: paho.mqtt.client.Client
     """
-      Test if there is connectivity with the MQTT broker
+    with self.__mqtt_lock:
+      if self.__mqtt is None:
+        self.__mqtt = self.__create_client()
+      return self.__mqtt
 
-    Returns:
-      return: connectivity status (True, False)
-      rtype: bool
+  def __create_client(self):
     """
-    logger.debug(f">>")
+    Import paho and create client
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-      # Format: s.connect((HOST, PORT))
-      s.connect((f"{self.__mqtt_broker}", int(self.__mqtt_port)))
-      s.shutdown(socket.SHUT_RDWR)
-      logger.debug(f"Internet connectivity to MQTT broker {self.__mqtt_broker} at port {self.__mqtt_port} available")
-      return True
-    except Exception as e:
-      logger.info(f"Internet connectivity to MQTT broker {self.__mqtt_broker} at port {self.__mqtt_port} "
-                  f"NOT yet available; Exception {e}")
-      return False
+    :return: paho client
+    :rtype: paho.mqtt.client.Client
+    """
+    t_start = time.monotonic()
+    _import_paho()
+    logger.info(f"paho-mqtt version = {paho_mqtt.__version__}")
+
+    # Check if installed paho-mqtt version supports MQTT v5
+    # Demote to v311 if wrong version is installed
+    if self.__mqtt_protocol == MQTTv5:
+      if _version(paho_mqtt.__version__) < _version("1.5.1"):
+        logger.warning(f"Incorrect paho-mqtt version ({paho_mqtt.__version__}) to support MQTT v5, "
+                       f"reverting to MQTT v311")
+        self.__mqtt_protocol = MQTTv311
+
+    # clean_session is only implemented for MQTT v3
+    if self.__mqtt_protocol == MQTTv311 or self.__mqtt_protocol == MQTTv31:
+      self.__mqtt = mqtt_client.Client(self.__mqtt_client_id,
+                                       clean_session=self.__mqtt_cleansession,
+                                       protocol=self.__mqtt_protocol,
+                                       reconnect_on_failure=False)
+    else:
+      self.__mqtt = mqtt_client.Client(self.__mqtt_client_id,
+                                       protocol=self.__mqtt_protocol,
+                                       reconnect_on_failure=False)
+
+    # Call back functions
+    self.__mqtt.on_connect = self.__on_connect
+    self.__mqtt.on_disconnect = self.__on_disconnect
+    self.__mqtt.on_message = self.__on_message
+
+    # Wake up main loop when a queued/spooled message has been published
+    self.__mqtt.on_publish = self.__on_publish
+
+    # Uncomment if needed for debugging
+#    self.__mqtt.on_log = self.__on_log
+
+    if self.__mqtt_protocol == MQTTv311 or self.__mqtt_protocol == MQTTv31:
+      self.__mqtt.on_subscribe = self.__on_subscribe_v31
+    elif self.__mqtt_protocol == MQTTv5:
+      self.__mqtt.on_subscribe = self.__on_subscribe_v5
+    else:
+      self.__mqtt.on_subscribe = None
+
+    self.__mqtt.on_unsubscribe = self.__on_unsubscribe
+
+    # Not yet implemented
+    # self.__mqtt.on_unsubscribe = self.__on_unsubscribe
+
+    self.__mqtt.username_pw_set(self.__username, self.__password)
+
+    if self.__will is not None:
+      self.__mqtt.will_set(*self.__will)
+
+    logger.debug(f"paho client created in {round(time.monotonic() - t_start, 3)} s")
+    return self.__mqtt
+
+  def __del__(self):
+    logger.debug(f">>")
+    logger.info(f"Shutting down MQTT Client... {self.__mqtt_counter} MQTT messages have been published")
 
   def __set_connected_flag(self, flag=True):
     logger.debug(f">> flag={flag}; current __connected_flag={self.__connected_flag}")
 
-    # if flag == False and __connected_flag == True; start trigger
-    if not flag and self.__connected_flag:
-      self.__disconnect_start_time = int(time.time())
-      logger.debug("Disconnect TIMER started")
+    # Paho network thread ends when connection is lost or refused (reconnect_on_failure=False)
+    if not flag:
+      self.__link_down = True
 
     self.__connected_flag = flag
+    self.__wakeup.set()
     return
 
   def __on_connect(self, _client, userdata, flags, rc, _properties=None):
@@ -303,7 +403,8 @@ class MQTTClient(threading.Thread):
     :param message: Queue()
     :return:
     """
-    logger.debug(f">> message = {message.topic}  {message.payload}")
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f">> message = {message.topic}  {message.payload}")
 
     self.__subscribed_queue.put(message)
 
@@ -323,7 +424,11 @@ class MQTTClient(threading.Thread):
     Returns:
       None
     """
-    logger.debug(f"userdata={userdata}; mid={mid}")
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f"userdata={userdata}; mid={mid}")
+
+    if self.__inflight:
+      self.__wakeup.set()
     return None
 
   def __on_subscribe_v5(self, _client, _userdata, mid, reasoncodes, _properties=None):
@@ -381,7 +486,8 @@ class MQTTClient(threading.Thread):
     Returns:
       None
     """
-    logger.debug(f"obj={client}; level={level}; buf={buf}")
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f"obj={client}; level={level}; buf={buf}")
 
   def __set_status(self):
     """
@@ -390,8 +496,9 @@ class MQTTClient(threading.Thread):
     """
     logger.debug(">>")
 
-    if self.__status_topic is not None:
-      self.do_publish(self.__status_topic, self.__status_payload, self.__status_retain)
+    # Not spooled or queued; status is published on every (re)connect
+    if self.__status_topic is not None and self.__connected_flag:
+      self.__publish(self.__status_topic, self.__status_payload, self.__status_retain)
 
     return
 
@@ -427,7 +534,10 @@ class MQTTClient(threading.Thread):
     if self.__run:
       logger.warning(f"Last Will/testament is set after run() is called. Not advised per documentation")
 
-    self.__mqtt.will_set(topic, payload, qos, retain)
+    with self.__mqtt_lock:
+      self.__will = (topic, payload, qos, retain)
+      if self.__mqtt is not None:
+        self.__mqtt.will_set(topic, payload, qos, retain)
 
   def do_publish(self, topic, message, retain=False):
     """
@@ -441,17 +551,241 @@ class MQTTClient(threading.Thread):
     Returns:
       None
     """
-    logger.debug(f">> TOPIC={topic}; MESSAGE={message}")
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f">> TOPIC={topic}; MESSAGE={message}")
+
+    if self.__publish_queue is not None:
+      self.__publish_queue.put(topic, message, retain)
+      self.__wakeup.set()
+      return
+
+    if self.__spool is not None and (not self.__connected_flag or not self.__spool.empty()):
+      self.__spool.append(topic, message, retain)
+      self.__wakeup.set()
+      return
+
+    self.__publish(topic, message, retain)
 
+  def __publish(self, topic, message, retain=False):
+    """
+    Hand message to paho
+
+    :param str topic: MQTT topic
+    :param message: MQTT message
+    :param bool retain: retained flag MQTT message
+    :return: paho MQTTMessageInfo; None when message is not accepted
+    """
     try:
-      mqttmessageinfo = self.__mqtt.publish(topic=topic, payload=message, qos=self.__qos, retain=retain)
+      mqttmessageinfo = self.__client().publish(topic=topic, payload=message, qos=self.__qos, retain=retain)
       self.__mqtt_counter += 1
 
       if mqttmessageinfo.rc != mqtt_client.MQTT_ERR_SUCCESS:
         logger.warning(f"MQTT publish was not successfull, rc = {mqttmessageinfo.rc}: "
                        f"{mqtt_client.error_string(mqttmessageinfo.rc)}")
+      return mqttmessageinfo
     except ValueError:
       logger.warning("")
+      return None
+
+  def __publish_tracked(self, topic, message, retain, t_enqueue=None, position=None):
+    """
+    Hand message to paho, and track it till it is published
+
+    :param str topic: MQTT topic
+    :param message: MQTT message
+    :param bool retain: retained flag MQTT message
+    :param float t_enqueue: time (monotonic) message was queued; None is not queued
+    :param tuple position: spool position; None is not spooled
+    :return: None
+    """
+    mqttmessageinfo = self.__publish(topic, message, retain)
+
+    # A QoS 0 message which is not accepted, is lost
+    if mqttmessageinfo is None or (self.__qos == 0 and mqttmessageinfo.rc != mqtt_client.MQTT_ERR_SUCCESS):
+      if position is not None:
+        self.__spool.commit(position)
+      return
+
+    self.__inflight.append((mqttmessageinfo, t_enqueue, position))
+
+  def __reap_inflight(self):
+    """
+    Remove published messages, in order; commit spool position and register latency
+
+    :return: None
+    """
+    now = time.monotonic()
+    while self.__inflight and self.__inflight[0][0].is_published():
+      _info, t_enqueue, position = self.__inflight.popleft()
+      if position is not None:
+        self.__spool.commit(position)
+      if t_enqueue is not None:
+        latency = now - t_enqueue
+        self.__latency_count += 1
+        self.__latency_sum += latency
+        self.__latency_max = max(self.__latency_max, latency)
+        if self.__latency_observer is not None:
+          self.__latency_observer(latency)
+
+  def __drain_spool(self, nrof_messages):
+    """
+    Publish spooled messages, oldest first
+    Spool position is committed when paho has published the message (QoS>0: acknowledged by broker)
+
+    :param int nrof_messages: max nrof messages to publish
+    :return: nrof messages published
+    """
+    published = 0
+    while published < nrof_messages and self.__connected_flag and len(self.__inflight) < MAX_INFLIGHT:
+      record = self.__spool.read()
+      if record is None:
+        break
+
+      topic, message, retain, _ts, position = record
+      self.__publish_tracked(topic, message, retain, position=position)
+      published += 1
+
+    return published
+
+  def __drain_queue(self):
+    """
+    Move queued messages to paho (when connected) or to spool (when disconnected or spool is not yet drained)
+    Messages remain queued when disconnected without spool, or when too many messages are in flight
+
+    :return: None
+    """
+    while True:
+      to_spool = self.__spool is not None and (not self.__connected_flag or not self.__spool.empty())
+      if not to_spool and (not self.__connected_flag or len(self.__inflight) >= MAX_INFLIGHT):
+        return
+
+      item = self.__publish_queue.get()
+      if item is None:
+        return
+
+      topic, message, retain, t_enqueue = item
+      if to_spool:
+        self.__spool.append(topic, message, retain)
+      else:
+        self.__publish_tracked(topic, message, retain, t_enqueue)
+
+  def publish_stats(self):
+    """
+    :return: publish queue (depth, max_depth, enqueued, dropped, coalesced), inflight,
+             nrof messages handed to paho (messages) and
+             enqueue to publish latency (latency_avg, latency_max in seconds)
+    :rtype: dict
+    """
+    stats = self.__publish_queue.stats() if self.__publish_queue is not None else dict()
+    stats["inflight"] = len(self.__inflight)
+    stats["messages"] = self.__mqtt_counter
+    stats["published"] = self.__latency_count
+    stats["latency_avg"] = self.__latency_sum / self.__latency_count if self.__latency_count else 0.0
+    stats["latency_max"] = self.__latency_max
+    return stats
+
+  def connection_stats(self):
+    """
+    :return: connected, nrof outages, outage time (total, max, last and current, in seconds) and
+             nrof connect attempts
+    :rtype: dict
+    """
+    current = time.monotonic() - self.__outage_start if self.__outage_start is not None else 0.0
+    return {"connected": self.__connected_flag,
+            "outages": self.__nrof_outages,
+            "outage_total": self.__outage_total + current,
+            "outage_max": max(self.__outage_max, current),
+            "outage_last": self.__outage_last,
+            "outage_current": current,
+            "connect_attempts": self.__nrof_connect_attempts}
+
+  def stop(self):
+    """
+    Stop MQTT thread
+
+    :return: None
+    """
+    logger.debug(">>")
+    self.__mqtt_stopper.set()
+    self.__wakeup.set()
+
+  def __backoff(self, attempt):
+    """
+    :param int attempt: nrof failed attempts
+    :return: seconds till next connect attempt; exponential, with random jitter of max 50%
+    :rtype: float
+    """
+    delay = min(self.__reconnect_max_delay, self.__reconnect_min_delay * 2 ** min(attempt - 1, 32))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+  def __connect(self):
+    """
+    Connect to broker (blocking, till CONNECT is sent) and start paho network thread
+
+    :return: True when CONNECT is sent; CONNACK is handled by __on_connect()
+    :rtype: bool
+    """
+    self.__client()
+    self.__nrof_connect_attempts += 1
+    self.__link_down = False
+    try:
+      # clean_session is only implemented for MQTT v3
+      if self.__mqtt_protocol == MQTTv311 or self.__mqtt_protocol == MQTTv31:
+        self.__mqtt.connect(host=self.__mqtt_broker,
+                            port=self.__mqtt_port,
+                            keepalive=self.__keepalive)
+      elif self.__mqtt_cleansession:
+        # TODO
+        # For clean_start set to True or Start_first_Only, a session expiry interval
+        # has to be set via properties object
+        # This is not yet implemented
+        self.__mqtt.connect(host=self.__mqtt_broker,
+                            port=self.__mqtt_port,
+                            keepalive=self.__keepalive,
+                            clean_start=mqtt_client.MQTT_CLEAN_START_FIRST_ONLY,
+                            properties=None)
+      else:
+        self.__mqtt.connect(host=self.__mqtt_broker,
+                            port=self.__mqtt_port,
+                            keepalive=self.__keepalive,
+                            clean_start=False,
+                            properties=None)
+    except (OSError, ValueError) as e:
+      logger.info(f"Connect to MQTT broker {self.__mqtt_broker}:{self.__mqtt_port} failed; {e}")
+      return False
+
+    self.__mqtt.loop_start()
+    return True
+
+  def __connection_lost(self, now):
+    """
+    Register start of outage
+
+    :param float now: time (monotonic)
+    :return: None
+    """
+    if self.__outage_start is None:
+      self.__outage_start = now
+      self.__nrof_outages += 1
+
+  def __connection_restored(self, now, attempts):
+    """
+    Register end of outage
+
+    :param float now: time (monotonic)
+    :param int attempts: nrof connect attempts
+    :return: None
+    """
+    if self.__outage_start is None:
+      logger.info(f"Connected to MQTT broker {self.__mqtt_broker}:{self.__mqtt_port}")
+      return
+
+    self.__outage_last = now - self.__outage_start
+    self.__outage_total += self.__outage_last
+    self.__outage_max = max(self.__outage_max, self.__outage_last)
+    self.__outage_start = None
+    logger.info(f"Reconnected to MQTT broker after {round(self.__outage_last, 1)} s and {attempts} attempts; "
+                f"{self.__nrof_outages} outages, {round(self.__outage_total, 1)} s in total")
 
   def set_message_trigger(self, subscribed_queue, trigger=None):
     """
@@ -467,10 +801,11 @@ class MQTTClient(threading.Thread):
     self.__message_trigger = trigger
     self.__subscribed_queue = subscribed_queue
 
-    # Re-subscribe, in case connection was lost
-    for topic in self.__list_of_subscribed_topics:
-      logger.debug(f"Resubscribe topic: {topic}")
-      self.__mqtt.subscribe(topic, self.__qos)
+    # Re-subscribe, in case connection was lost; otherwise subscribed when connected
+    if self.__connected_flag:
+      for topic in self.__list_of_subscribed_topics:
+        logger.debug(f"Resubscribe topic: {topic}")
+        self.__mqtt.subscribe(topic, self.__qos)
 
     return
 
@@ -491,7 +826,9 @@ class MQTTClient(threading.Thread):
     #  logger.warning(f"No connection with MQTT Broker; cannot subscribe...wait for connection")
     #  time.sleep(0.1)
 
-    self.__mqtt.subscribe(topic, self.__qos)
+    # Not connected: subscribed by __on_connect()
+    if self.__connected_flag:
+      self.__mqtt.subscribe(topic, self.__qos)
     return
 
   def unsubscribe(self, topic):
@@ -504,7 +841,8 @@ class MQTTClient(threading.Thread):
     :return:
     """
     logger.debug(f">> topic = {topic}")
-    self.__mqtt.unsubscribe(topic)
+    if self.__connected_flag:
+      self.__mqtt.unsubscribe(topic)
 
     try:
       self.__list_of_subscribed_topics.remove(topic)
@@ -517,92 +855,102 @@ class MQTTClient(threading.Thread):
     logger.info(f"Broker = {self.__mqtt_broker}>>")
     self.__run = True
 
-    # Wait till there is network connectivity to mqtt broker
-    # Start with a small delay and incrementally (+20%) make larger
-    delay = 0.1
-    while not self.__internet_on():
-      time.sleep(delay)
-      delay = delay * 1.2
-
-      # Timeout after 60min
-      if delay > 3600:
-        logger.error(f"No internet connection - EXIT")
-        self.__mqtt_stopper.set()
-        self.__worker_threads_stopper.set()
-        return
-
-    try:
-      # Options functions to be called before connecting
-      # Set queue to unlimitted (=65535) when qos>0
-      self.__mqtt.max_queued_messages_set(0)
-      self.__mqtt.reconnect_delay_set(min_delay=1, max_delay=360)
-
-      # clean_session is only implemented for MQTT v3
-      if self.__mqtt_protocol == mqtt_client.MQTTv311 or self.__mqtt_protocol == mqtt_client.MQTTv31:
-        self.__mqtt.connect_async(host=self.__mqtt_broker,
-                                  port=self.__mqtt_port,
-                                  keepalive=self.__keepalive)
-      elif self.__mqtt_protocol == mqtt_client.MQTTv5:
-        if self.__mqtt_cleansession:
-          # TODO
-          # For clean_start set to True or Start_first_Only, a session expiry interval
-          # has to be set via properties object
-          # This is not yet implemented
-          self.__mqtt.connect_async(host=self.__mqtt_broker,
-                                    port=self.__mqtt_port,
-                                    keepalive=self.__keepalive,
-                                    clean_start=mqtt_client.MQTT_CLEAN_START_FIRST_ONLY,
-                                    properties=None)
+    # Connect is attempted immediately, and retried with backoff (no connectivity probe)
+    # Until connected, messages are kept in publish queue or spool (or paho queue)
+    # Spooled messages which may be published; accumulates with spool_drain_rate, max 1 second worth
+    spool_budget = 0.0
+    t_loop = time.monotonic()
+
+    # Reconnect state machine; paho does not reconnect (reconnect_on_failure=False)
+    # "disconnected": connect when backoff delay has expired
+    # "connecting": CONNECT sent; wait for CONNACK (__on_connect) or failure (__link_down)
+    # "connected": till connection is lost (__link_down)
+    state = "disconnected"
+    next_attempt = time.monotonic()
+    t_connect = None
+    attempts = 0
+
+    logger.info(f"Start mqtt loop...")
+    while not self.__mqtt_stopper.is_set():
+      # Events after this point wake up the next sleep
+      self.__wakeup.clear()
+      now = time.monotonic()
+
+      if state != "disconnected" and self.__link_down:
+        # Network thread has ended; join it before connecting again
+        self.__mqtt.loop_stop()
+        if state == "connected":
+          self.__connection_lost(now)
+          attempts = 0
+        state = "disconnected"
+        attempts += 1
+        next_attempt = now + self.__backoff(attempts)
+        logger.debug(f"Next connect attempt in {round(next_attempt - now, 1)} s")
+
+      elif state == "connecting" and self.__connected_flag:
+        state = "connected"
+        self.__connection_restored(now, attempts)
+        attempts = 0
+
+      elif state == "connecting" and now - t_connect > CONNECT_TIMEOUT:
+        logger.warning(f"No CONNACK from MQTT broker within {CONNECT_TIMEOUT} s")
+        self.__mqtt.disconnect()
+        self.__mqtt.loop_stop()
+        state = "disconnected"
+        attempts += 1
+        next_attempt = now + self.__backoff(attempts)
+
+      if state == "disconnected" and now >= next_attempt:
+        if self.__connect():
+          state = "connecting"
+          t_connect = now
         else:
-          self.__mqtt.connect_async(host=self.__mqtt_broker,
-                                    port=self.__mqtt_port,
-                                    keepalive=self.__keepalive,
-                                    clean_start=False,
-                                    properties=None)
-      else:
-        logger.error(f"Unknown MQTT protocol version {self.__mqtt_protocol}....exit")
-        self.__worker_threads_stopper.set()
-        self.__mqtt_stopper.set()
+          attempts += 1
+          next_attempt = now + self.__backoff(attempts)
 
-    except Exception as e:
-      logger.exception(f"Exception {format(e)}")
-      self.__mqtt.disconnect()
-      self.__mqtt_stopper.set()
-      self.__worker_threads_stopper.set()
-      return
+      self.__reap_inflight()
 
-    else:
-      logger.info(f"Start mqtt loop...")
-      self.__mqtt.loop_start()
+      # Drain spool at a limited rate
+      if self.__spool is not None:
+        spool_budget = min(spool_budget + (now - t_loop) * self.__spool_drain_rate, max(1.0, self.__spool_drain_rate))
+        t_loop = now
+        if self.__connected_flag:
+          spool_budget -= self.__drain_spool(int(spool_budget))
 
-    # Start infinite loop which sends queued messages every second
-    while not self.__mqtt_stopper.is_set():
-      # Todo: reconnect stuff needed?
-
-      # Check connection status
-      # If disconnected time exceeds threshold
-      # then reconnect
-      if not self.__connected_flag:
-        disconnect_time = int(time.time()) - self.__disconnect_start_time
-        logger.debug(f"Disconnect TIMER = {disconnect_time}")
-        if disconnect_time > self.__MQTT_CONNECTION_TIMEOUT:
-          try:
-            self.__mqtt.reconnect()
-          except Exception as e:
-            logger.exception(f"Exception {format(e)}")
+      if self.__publish_queue is not None:
+        self.__drain_queue()
 
-            # reconnect failed....reset disconnect time, and retry after self.__MQTT_CONNECTION_TIMEOUT
-            self.__disconnect_start_time = int(time.time())
+      # Sleep till an event (see __wakeup) or a timer
+      timeout = IDLE_TIMEOUT
+      if state == "disconnected":
+        timeout = min(timeout, next_attempt - now)
+      elif state == "connecting":
+        timeout = min(timeout, t_connect + CONNECT_TIMEOUT - now)
+      elif self.__spool is not None and self.__spool_drain_rate and len(self.__inflight) < MAX_INFLIGHT and \
+           not self.__spool.empty():
+        timeout = min(timeout, (1.0 - spool_budget) / self.__spool_drain_rate)
 
-      time.sleep(0.1)
+      self.__wakeup.wait(max(0.0, timeout))
 
     # Close mqtt broker
     logger.debug(f"Close down MQTT client & connection to broker")
-    self.__mqtt.loop_stop()
-    self.__mqtt.disconnect()
+    if self.__mqtt is not None:
+      self.__mqtt.loop_stop()
+      self.__mqtt.disconnect()
     self.__mqtt_stopper.set()
     self.__worker_threads_stopper.set()
 
+    # Messages not yet published remain in spool for next start
+    if self.__spool is not None:
+      if self.__publish_queue is not None:
+        while (item := self.__publish_queue.get()) is not None:
+          self.__spool.append(*item[:3])
+      self.__spool.close()
+
+    if self.__publish_queue is not None:
+      logger.info(f"Publish statistics: {self.publish_stats()}")
+    logger.info(f"Connection statistics: {self.connection_stats()}")
+
     logger.info(f"Shutting down MQTT Client... {self.__mqtt_counter} MQTT messages have been published")
 
     logger.info(f"<<")
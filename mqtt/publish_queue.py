@@ -0,0 +1,153 @@
+"""
+  Bounded queue of MQTT messages, between publishing threads and the MQTT client thread
+
+  Policies when queue is full:
+  - "block": publishing thread waits (max block_timeout seconds; then message is dropped)
+  - "drop-oldest": oldest message is dropped
+  - "drop-newest": new message is dropped
+  - "coalesce": per topic only the latest message is kept (in place of the queued one);
+                when full, oldest message is dropped
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+POLICIES = ("block", "drop-oldest", "drop-newest", "coalesce")
+
+
+class PublishQueue:
+  def __init__(self, maxsize=1000, policy="drop-oldest", block_timeout=5.0):
+    """
+    Args:
+      :param int maxsize: max nrof queued messages
+      :param str policy: one of POLICIES
+      :param float block_timeout: max seconds a publishing thread waits with policy "block"
+
+    Returns:
+      None
+    :raises ValueError: unknown policy
+    """
+    logger.debug(f">> maxsize = {maxsize}; policy = {policy}")
+    if policy not in POLICIES:
+      raise ValueError(f"Unknown MQTT_QUEUE_POLICY '{policy}'; use one of {', '.join(POLICIES)}")
+
+    self.__maxsize = max(1, maxsize)
+    self.__policy = policy
+    self.__block_timeout = block_timeout
+    self.__condition = threading.Condition()
+
+    # key:(topic, message, retain, enqueue time (monotonic)); key is topic when coalescing
+    self.__queue = collections.OrderedDict()
+    self.__keys = itertools.count()
+
+    # Counters
+    self.__nrof_enqueued = 0
+    self.__nrof_dropped = 0
+    self.__nrof_coalesced = 0
+    self.__max_depth = 0
+
+    # Whether messages were dropped since last warning
+    self.__dropping = False
+
+    logger.debug("<<")
+    return
+
+  def __len__(self):
+    return len(self.__queue)
+
+  def __drop(self, reason):
+    self.__nrof_dropped += 1
+    if not self.__dropping:
+      logger.warning(f"Publish queue full ({self.__maxsize}); {reason} message dropped")
+      self.__dropping = True
+
+  def put(self, topic, message, retain=False):
+    """
+    Queue a message
+
+    :param str topic:
+    :param message:
+    :param bool retain:
+    :return: None
+    """
+    item = (topic, message, retain, time.monotonic())
+
+    with self.__condition:
+      self.__nrof_enqueued += 1
+
+      if self.__policy == "coalesce" and topic in self.__queue:
+        # Replace queued message; keep its position
+        self.__queue[topic] = item
+        self.__nrof_coalesced += 1
+        return
+
+      if len(self.__queue) >= self.__maxsize:
+        if self.__policy == "block":
+          self.__condition.wait_for(lambda: len(self.__queue) < self.__maxsize, self.__block_timeout)
+
+        if len(self.__queue) >= self.__maxsize:
+          if self.__policy in ("drop-newest", "block"):
+            self.__drop("newest")
+            return
+
+          self.__queue.popitem(last=False)
+          self.__drop("oldest")
+
+      key = topic if self.__policy == "coalesce" else next(self.__keys)
+      self.__queue[key] = item
+      self.__max_depth = max(self.__max_depth, len(self.__queue))
+      self.__condition.notify_all()
+
+  def get(self):
+    """
+    Take oldest message
+
+    :return: (topic, message, retain, enqueue time); None when queue is empty
+    :rtype: tuple
+    """
+    with self.__condition:
+      if not self.__queue:
+        return None
+
+      _key, item = self.__queue.popitem(last=False)
+      if not self.__queue:
+        self.__dropping = False
+
+      self.__condition.notify_all()
+      return item
+
+  def stats(self):
+    """
+    :return: depth, max_depth, enqueued, dropped, coalesced
+    :rtype: dict
+    """
+    with self.__condition:
+      return {"depth": len(self.__queue),
+              "max_depth": self.__max_depth,
+              "enqueued": self.__nrof_enqueued,
+              "dropped": self.__nrof_dropped,
+              "coalesced": self.__nrof_coalesced}
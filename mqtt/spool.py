@@ -0,0 +1,345 @@
+"""
+  Disk spool (store and forward) for MQTT messages
+
+  While the client is disconnected from the broker, messages are appended to segment files
+  instead of the (in memory) paho queue. After a reconnect, the spool is drained at a limited rate,
+  oldest message first; payloads are republished unchanged, so timestamps in payloads are preserved.
+
+  - Segment files <directory>/<nr>.seg; a new segment is started when a segment exceeds segment_bytes
+    and at every start, so a segment torn by a crash is never appended to
+  - Record: header (crc32, time, flags, topic length, payload length), topic, payload
+    A record with a wrong crc or a truncated record ends the segment (logged)
+  - Total size is bounded by max_bytes; when exceeded, the oldest segment is dropped (logged)
+  - Read position is committed to <directory>/position when the broker has acknowledged the messages
+    (at most once per COMMIT_INTERVAL seconds); after a crash, messages are delivered at least once
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import collections
+import struct
+import threading
+import time
+import zlib
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# crc32, time, flags, topic length, payload length
+HEADER = struct.Struct("<IdBHI")
+
+FLAG_RETAIN = 0x01
+
+SEGMENT_SUFFIX = ".seg"
+POSITION_FILE = "position"
+
+# Seconds between writes of the read position
+COMMIT_INTERVAL = 1.0
+
+
+class Spool:
+  def __init__(self, directory, max_bytes=16 * 1024 * 1024, segment_bytes=1024 * 1024):
+    """
+    Args:
+      :param str directory: directory of segment files; created when it does not exist
+      :param int max_bytes: max total size of segment files
+      :param int segment_bytes: max size of one segment file
+
+    Returns:
+      None
+    """
+    logger.debug(f">> directory = {directory}")
+    self.__directory = directory
+    self.__max_bytes = max_bytes
+    self.__segment_bytes = min(segment_bytes, max(1, max_bytes // 2))
+    self.__lock = threading.Lock()
+
+    os.makedirs(directory, exist_ok=True)
+
+    # Segment numbers, oldest first, and their size
+    self.__segments = collections.OrderedDict()
+    for filename in sorted(os.listdir(directory)):
+      if filename.endswith(SEGMENT_SUFFIX):
+        nr = int(filename[:-len(SEGMENT_SUFFIX)])
+        self.__segments[nr] = os.path.getsize(self.__path(nr))
+    self.__segments = collections.OrderedDict(sorted(self.__segments.items()))
+
+    # Empty segments are left by a start without spooling
+    for nr in [nr for nr, size in self.__segments.items() if size == 0]:
+      del self.__segments[nr]
+      os.unlink(self.__path(nr))
+
+    # Committed read position (segment, offset)
+    self.__committed = self.__load_position()
+    self.__commit_time = time.monotonic()
+
+    # Read position of next record to hand out; read file is kept open
+    self.__read = self.__committed
+    self.__read_fd = None
+    self.__read_fd_segment = None
+
+    # Nrof records appended & dropped since start
+    self.__nrof_appended = 0
+    self.__nrof_dropped = 0
+
+    # Always write to a new segment
+    self.__write_fd = None
+    self.__write_segment = None
+    self.__rotate()
+
+    # Remove segments which were completely delivered before last stop
+    self.commit(self.__committed)
+
+    if self.__read != (self.__write_segment, 0):
+      logger.info(f"Spool {directory}: {self.bytes} bytes not yet published")
+
+    logger.debug("<<")
+    return
+
+  def __path(self, nr):
+    return os.path.join(self.__directory, f"{nr:010d}{SEGMENT_SUFFIX}")
+
+  def __load_position(self):
+    """
+    :return: committed read position; start of oldest segment when not valid
+    :rtype: tuple
+    """
+    try:
+      with open(os.path.join(self.__directory, POSITION_FILE)) as f:
+        nr, offset = (int(field) for field in f.read().split())
+      if nr in self.__segments:
+        return nr, offset
+    except (OSError, ValueError):
+      pass
+
+    return next(iter(self.__segments), 0), 0
+
+  def __save_position(self):
+    path = os.path.join(self.__directory, POSITION_FILE)
+    try:
+      with open(path + ".tmp", "w") as f:
+        f.write(f"{self.__committed[0]} {self.__committed[1]}\n")
+      os.replace(path + ".tmp", path)
+    except OSError as e:
+      logger.warning(f"Spool: cannot save read position; {e}")
+    self.__commit_time = time.monotonic()
+
+  def __rotate(self):
+    """
+    Start a new write segment
+
+    :return: None
+    """
+    if self.__write_fd is not None:
+      os.fsync(self.__write_fd)
+      os.close(self.__write_fd)
+
+    nr = next(reversed(self.__segments), 0) + 1
+    self.__write_fd = os.open(self.__path(nr), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    self.__write_segment = nr
+    self.__segments[nr] = 0
+
+    # Nothing left to read in spool
+    if self.__read[0] not in self.__segments:
+      self.__read = (nr, 0)
+    if self.__committed[0] not in self.__segments:
+      self.__committed = (nr, 0)
+
+  def __drop_segment(self, nr):
+    """
+    Remove a (read or dropped) segment, which is not the write segment
+
+    :param int nr: segment
+    :return: None
+    """
+    if self.__read_fd_segment == nr:
+      os.close(self.__read_fd)
+      self.__read_fd = None
+      self.__read_fd_segment = None
+
+    del self.__segments[nr]
+    try:
+      os.unlink(self.__path(nr))
+    except OSError as e:
+      logger.warning(f"Spool: {e}")
+
+  def __next_segment(self, nr):
+    """
+    :return: segment after nr; is always there as write segment is the newest
+    :rtype: int
+    """
+    for segment in self.__segments:
+      if segment > nr:
+        return segment
+    return self.__write_segment
+
+  @property
+  def bytes(self):
+    """
+    :return: nrof bytes not yet handed out
+    :rtype: int
+    """
+    nr, offset = self.__read
+    return sum(size for segment, size in self.__segments.items() if segment >= nr) - offset
+
+  def empty(self):
+    """
+    :return: True when all records have been handed out
+    :rtype: bool
+    """
+    with self.__lock:
+      return self.bytes == 0
+
+  def append(self, topic, payload, retain=False):
+    """
+    Append a message; drop oldest segment when spool is full
+
+    :param str topic:
+    :param payload: str, bytes or None
+    :param bool retain:
+    :return: None
+    """
+    topic = topic.encode("utf-8")
+    if payload is None:
+      payload = b""
+    elif isinstance(payload, str):
+      payload = payload.encode("utf-8")
+    elif not isinstance(payload, bytes):
+      payload = str(payload).encode("utf-8")
+
+    body = HEADER.pack(0, time.time(), FLAG_RETAIN if retain else 0, len(topic), len(payload))[4:] + topic + payload
+    record = struct.pack("<I", zlib.crc32(body)) + body
+
+    with self.__lock:
+      if self.__segments[self.__write_segment] + len(record) > self.__segment_bytes and \
+         self.__segments[self.__write_segment] > 0:
+        self.__rotate()
+
+      os.write(self.__write_fd, record)
+      self.__segments[self.__write_segment] += len(record)
+      self.__nrof_appended += 1
+
+      # Bound total size by dropping oldest segments
+      while sum(self.__segments.values()) > self.__max_bytes and len(self.__segments) > 1:
+        nr = next(iter(self.__segments))
+        logger.warning(f"Spool full; dropped {self.__segments[nr]} bytes of oldest messages")
+        self.__nrof_dropped += 1
+        if self.__read[0] == nr:
+          self.__read = (self.__next_segment(nr), 0)
+        if self.__committed[0] == nr:
+          self.__committed = (self.__next_segment(nr), 0)
+        self.__drop_segment(nr)
+
+  def __read_record(self):
+    """
+    Read record at read position; skip to next segment at end of segment or at a corrupt record
+
+    :return: (topic, payload, retain, time, position after record); None when spool is empty
+    :rtype: tuple
+    """
+    while True:
+      nr, offset = self.__read
+      if (nr, offset) == (self.__write_segment, self.__segments[self.__write_segment]):
+        return None
+
+      if offset >= self.__segments[nr]:
+        self.__read = (self.__next_segment(nr), 0)
+        continue
+
+      if self.__read_fd_segment != nr:
+        if self.__read_fd is not None:
+          os.close(self.__read_fd)
+        self.__read_fd = os.open(self.__path(nr), os.O_RDONLY)
+        self.__read_fd_segment = nr
+
+      header = os.pread(self.__read_fd, HEADER.size, offset)
+      if len(header) == HEADER.size:
+        crc, ts, flags, topic_length, payload_length = HEADER.unpack(header)
+        data = os.pread(self.__read_fd, topic_length + payload_length, offset + HEADER.size)
+        if len(data) == topic_length + payload_length and zlib.crc32(header[4:] + data) == crc:
+          position = (nr, offset + HEADER.size + len(data))
+          self.__read = position
+          return data[:topic_length].decode("utf-8"), data[topic_length:], bool(flags & FLAG_RETAIN), ts, position
+
+      logger.warning(f"Spool: corrupt or truncated record in {self.__path(nr)} at {offset}; skip rest of segment")
+      if nr == self.__write_segment:
+        self.__rotate()
+      self.__read = (self.__next_segment(nr), 0)
+
+  def read(self):
+    """
+    Read next record; call commit() with the returned position when it has been delivered
+
+    :return: (topic, payload, retain, time, position); None when spool is empty
+    :rtype: tuple
+    """
+    with self.__lock:
+      return self.__read_record()
+
+  def commit(self, position):
+    """
+    Records up to position have been delivered; remove segments which are completely delivered
+
+    :param tuple position: position as returned by read()
+    :return: None
+    """
+    with self.__lock:
+      # Segment might have been dropped in the meantime (spool full)
+      if position[0] not in self.__segments:
+        return
+
+      self.__committed = position
+      for nr in list(self.__segments):
+        if nr == self.__write_segment or nr > position[0] or \
+           (nr == position[0] and position[1] < self.__segments[nr]):
+          break
+
+        # Segment is completely delivered
+        if nr == position[0]:
+          self.__committed = (self.__next_segment(nr), 0)
+        if nr == self.__read[0]:
+          self.__read = (self.__next_segment(nr), 0)
+        self.__drop_segment(nr)
+
+      if time.monotonic() - self.__commit_time >= COMMIT_INTERVAL:
+        self.__save_position()
+
+  def close(self):
+    """
+    Save read position and close files
+
+    :return: None
+    """
+    with self.__lock:
+      logger.info(f"Spool: {self.__nrof_appended} messages spooled; {self.__nrof_dropped} segments dropped; "
+                  f"{self.bytes} bytes not yet published")
+      self.__save_position()
+      if self.__read_fd is not None:
+        os.close(self.__read_fd)
+        self.__read_fd = None
+        self.__read_fd_segment = None
+      if self.__write_fd is not None:
+        os.fsync(self.__write_fd)
+        os.close(self.__write_fd)
+        self.__write_fd = None
+
+      # Remove empty write segment
+      if self.__segments.get(self.__write_segment) == 0:
+        self.__drop_segment(self.__write_segment)
@@ -0,0 +1,162 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Encode MQTT payloads as JSON, MessagePack or CBOR (MQTT_ENCODING)
+- msgpack and cbor2 are optional; only imported when selected
+- Serializer: per device serializer; for every key set, key order (sorted) is determined once
+  - JSON: keys are encoded once into a template; only values are encoded per telegram
+  - msgpack/cbor: dict is built in precompiled key order and encoded by the (C) packer in one call
+  Output is identical to json.dumps(values, sort_keys=True, separators=(',', ':')), or to
+  msgpack/cbor2 encoding of a dict with sorted keys
+"""
+
+import json
+import math
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+ENCODINGS = ("json", "msgpack", "cbor")
+
+# Max nrof precompiled key sets per device; change-only publishing (deadband.py) produces varying key sets
+MAX_TEMPLATES = 64
+
+
+def _json_value(value, int_repr=int.__repr__, float_repr=float.__repr__, isfinite=math.isfinite,
+                encode_string=json.encoder.encode_basestring_ascii):
+  """
+  :return: JSON encoding of value, as json.dumps
+  :rtype: str
+  """
+  t = type(value)
+  if t is int:
+    return int_repr(value)
+  if t is float and isfinite(value):
+    return float_repr(value)
+  if t is str:
+    return encode_string(value)
+  return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def _encoder(encoding):
+  """
+  Import optional dependency of encoding
+
+  :param str encoding: one of ENCODINGS
+  :return: function encoding one value to bytes; None for json
+  :raises ValueError: unknown encoding
+  :raises ImportError: msgpack or cbor2 is not installed
+  """
+  if encoding == "json":
+    return None
+  if encoding == "msgpack":
+    import msgpack
+    return msgpack.Packer().pack
+  if encoding == "cbor":
+    import cbor2
+    return cbor2.dumps
+
+  raise ValueError(f"Unknown MQTT_ENCODING '{encoding}'; use one of {', '.join(ENCODINGS)}")
+
+
+def encode(values, encoding="json"):
+  """
+  Encode a (nested) dict with sorted keys; not precompiled
+
+  :param dict values:
+  :param str encoding: one of ENCODINGS
+  :return: payload
+  :rtype: str or bytes
+  """
+  if encoding == "json":
+    return json.dumps(values, sort_keys=True, separators=(',', ':'))
+
+  def sort(value):
+    if isinstance(value, dict):
+      return {key: sort(value[key]) for key in sorted(value)}
+    return value
+
+  encoder = _encoder(encoding)
+  return encoder(sort(values))
+
+
+class Serializer:
+  """
+  Precompiled serializer of one device; learns key sets of its telegrams
+  """
+  def __init__(self, encoding="json"):
+    """
+    Args:
+      :param str encoding: one of ENCODINGS
+
+    Returns:
+      None
+    """
+    self.__encoding = encoding
+    self.__encoder = _encoder(encoding)
+
+    # Precompiled template per key set: frozenset(keys):(sorted keys, template)
+    self.__templates = dict()
+
+    if encoding == "json":
+      self.__compile = self.__compile_json
+      self.__encode = self.__encode_json
+    else:
+      self.__compile = self.__compile_binary
+      self.__encode = self.__encode_binary
+
+  @property
+  def encoding(self):
+    return self.__encoding
+
+  def __compile_json(self, keys):
+    # Template with encoded keys; '%' in keys is escaped
+    return "{" + ",".join(json.dumps(key).replace("%", "%%") + ":%s" for key in keys) + "}"
+
+  def __encode_json(self, template, keys, values):
+    return template % tuple([_json_value(values[key]) for key in keys])
+
+  def __compile_binary(self, keys):
+    return None
+
+  def __encode_binary(self, template, keys, values):
+    return self.__encoder({key: values[key] for key in keys})
+
+  def dumps(self, values):
+    """
+    :param dict values: flat dict
+    :return: payload
+    :rtype: str or bytes
+    """
+    key_set = frozenset(values)
+    compiled = self.__templates.get(key_set)
+    if compiled is None:
+      if len(self.__templates) >= MAX_TEMPLATES:
+        self.__templates.clear()
+
+      keys = tuple(sorted(values))
+      compiled = (keys, self.__compile(keys))
+      self.__templates[key_set] = compiled
+      logger.debug(f"Compiled {self.__encoding} serializer for {len(keys)} keys")
+
+    keys, template = compiled
+    return self.__encode(template, keys, values)
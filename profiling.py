@@ -0,0 +1,210 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Profile the running parser on request, without restart or attaching a profiler
+- SIGUSR1: cProfile all threads reading devices during PROFILE_CYCLES READ_RATE cycles
+  cProfile only profiles the thread which enables it; every reading thread enables its own
+  profiler at a checkpoint (start of HeatMeter.read()) and hands it in at the first checkpoint after the window
+  Report <PROFILE_DIR>/profile-<time>.txt (top PROFILE_TOP functions) and .prof (eg for snakeviz)
+- SIGUSR2: first signal starts tracemalloc; every next signal writes
+  <PROFILE_DIR>/memory-<time>.txt with top PROFILE_TOP allocations and growth since previous report
+- Reports are written by a separate thread; reading threads are not delayed
+"""
+
+import cProfile
+import pstats
+import threading
+import time
+import tracemalloc
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Allocations by tracemalloc and import machinery are not of interest
+_MEMORY_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),
+                   tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                   tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"))
+
+
+class Profiler:
+  def __init__(self, directory, cycles=10, top=25):
+    """
+    Args:
+      :param str directory: directory of reports; created when it does not exist
+      :param int cycles: nrof READ_RATE cycles profiled
+      :param int top: nrof functions/allocations in reports
+
+    Returns:
+      None
+    """
+    logger.debug(f">> directory = {directory}; cycles = {cycles}")
+    self.__directory = directory
+    self.__cycles = max(1, cycles)
+    self.__top = top
+    self.__lock = threading.Lock()
+
+    # Set by signal handler; profiling starts at next cycle
+    self.__requested = False
+
+    # Profiling window; session is 0 when not profiling
+    self.__session = 0
+    self.__last_session = 0
+    self.__cycles_left = 0
+    self.__window_start = None
+    self.__window = 0.0
+
+    # Profiler per thread; profilers handed in and nrof threads still profiling
+    self.__local = threading.local()
+    self.__profiles = list()
+    self.__running = 0
+
+    # Previous tracemalloc snapshot
+    self.__snapshot = None
+
+    logger.debug("<<")
+    return
+
+  def __path(self, prefix, suffix):
+    os.makedirs(self.__directory, exist_ok=True)
+    return os.path.join(self.__directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+
+  def request_cpu_profile(self, *_args):
+    """
+    Profile the next PROFILE_CYCLES cycles; signal handler (SIGUSR1)
+
+    :return: None
+    """
+    if self.__requested or self.__session or self.__profiles or self.__running:
+      logger.warning("Profiling already in progress; request ignored")
+      return
+
+    logger.info(f"Profiling next {self.__cycles} cycles")
+    self.__requested = True
+
+  def request_memory_report(self, *_args):
+    """
+    Start tracemalloc or write memory report; signal handler (SIGUSR2)
+
+    :return: None
+    """
+    threading.Thread(target=self.__memory_report, name="memory-report", daemon=True).start()
+
+  def cycle_end(self):
+    """
+    Start or end of a READ_RATE cycle; called by ReadRateTimer
+
+    :return: None
+    """
+    with self.__lock:
+      if self.__session:
+        self.__cycles_left -= 1
+        if self.__cycles_left == 0:
+          # Threads hand in their profiler at next checkpoint
+          self.__window = time.monotonic() - self.__window_start
+          self.__session = 0
+      elif self.__requested:
+        self.__requested = False
+        self.__last_session += 1
+        self.__session = self.__last_session
+        self.__cycles_left = self.__cycles
+        self.__window_start = time.monotonic()
+
+  def checkpoint(self):
+    """
+    Enable or hand in the profiler of calling thread, when profiling window has started or ended
+    Costs one comparison when nothing changed
+
+    :return: None
+    """
+    local = self.__local
+    session = self.__session
+    if getattr(local, "session", 0) == session:
+      return
+
+    report = False
+    profile = getattr(local, "profile", None)
+    if profile is not None:
+      profile.disable()
+      local.profile = None
+      with self.__lock:
+        self.__profiles.append((threading.current_thread().name, profile))
+        self.__running -= 1
+        report = self.__running == 0 and self.__session == 0
+
+    if session:
+      with self.__lock:
+        self.__running += 1
+      local.profile = cProfile.Profile()
+      local.profile.enable()
+
+    local.session = session
+
+    if report:
+      threading.Thread(target=self.__cpu_report, name="profile-report", daemon=True).start()
+
+  def __cpu_report(self):
+    with self.__lock:
+      profiles, self.__profiles = self.__profiles, list()
+
+    try:
+      path = self.__path("profile", ".txt")
+      with open(path, "w") as f:
+        f.write(f"{self.__cycles} cycles in {round(self.__window, 2)} seconds; "
+                f"threads: {', '.join(name for name, _profile in profiles)}\n\n")
+        stats = pstats.Stats(profiles[0][1], stream=f)
+        for _name, profile in profiles[1:]:
+          stats.add(profile)
+
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.__top)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self.__top)
+
+      stats.dump_stats(os.path.splitext(path)[0] + ".prof")
+      logger.info(f"Profile written to {path}")
+    except OSError as e:
+      logger.warning(f"Profile: {e}")
+
+  def __memory_report(self):
+    if not tracemalloc.is_tracing():
+      tracemalloc.start()
+      logger.info("tracemalloc started; signal again for a memory report")
+      return
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(_MEMORY_FILTERS)
+    current, peak = tracemalloc.get_traced_memory()
+    try:
+      path = self.__path("memory", ".txt")
+      with open(path, "w") as f:
+        f.write(f"Traced memory: current {current} bytes; peak {peak} bytes\n\n")
+        f.write(f"Top {self.__top} allocations:\n")
+        for statistic in snapshot.statistics("lineno")[:self.__top]:
+          f.write(f"{statistic}\n")
+
+        if self.__snapshot is not None:
+          f.write(f"\nTop {self.__top} growth since previous report:\n")
+          for statistic in snapshot.compare_to(self.__snapshot, "lineno")[:self.__top]:
+            f.write(f"{statistic}\n")
+
+      logger.info(f"Memory report written to {path}")
+    except OSError as e:
+      logger.warning(f"Memory report: {e}")
+
+    self.__snapshot = snapshot
@@ -14,14 +14,17 @@
 
 Description
 -----------
+- Trigger read cycles at READ_RATE (monotonic clock), synchronized across all worker threads
 
 """
 
+import math
 import threading
 import time
 
 # Local imports
 import config as cfg
+import metrics
 
 # Logging
 import __main__
@@ -32,32 +35,60 @@ script = os.path.basename(__main__.__file__)
 script = os.path.splitext(script)[0]
 logger = logging.getLogger(script + "." + __name__)
 
+# Max seconds between checks of t_threads_stopper while waiting for the barrier
+# A worker which stopped without releasing its cycle does not block the timer
+BARRIER_STOP_CHECK = 1.0
+
 
 # somehow inheriting threading.Event does not work
 # class ReadRateTimer(threading.Thread, threading.Event):
 class ReadRateTimer(threading.Thread):
   """
-  - Set a trigger based on read_rate (rate per hour, 3600 is every second)
-  - Clear trigger when all subscribed (nrof_threads) have cleared trigger
+  - Trigger a read cycle based on read_rate (rate per hour, 3600 is every second)
+  - Cycle ends (countdown barrier) when all subscribed (nrof_threads) have released the trigger
+  - Next cycle is triggered at the next deadline, but never before the current cycle has ended
 
+  Timer and workers block on a Condition or on t_threads_stopper; while waiting for the barrier,
+  the timer checks t_threads_stopper every BARRIER_STOP_CHECK seconds
   """
-  def __init__(self, read_rate, nrof_threads, t_threads_stopper):
-    logger.debug(f">> read_rate = {read_rate};  nrof threads = {nrof_threads}")
+  def __init__(self, read_rate, nrof_threads, t_threads_stopper, stretch=None, on_cycle_end=None):
+    """
+    Args:
+      :param float read_rate: READ_RATE
+      :param int nrof_threads: nrof threads (devices) which release every cycle
+      :param threading.Event t_threads_stopper:
+      :param stretch: function returning factor (>= 1) to stretch interval with; None is no stretching
+      :param on_cycle_end: function(ts) called when all threads have released a cycle; ts is MQTT timestamp of cycle
+
+    Returns:
+      None
+    """
+    logger.debug(">> read_rate = %s;  nrof threads = %s", read_rate, nrof_threads)
     super().__init__()
 
     # number of threads which needs to be synchronized with ReadRateTimer
     self.__nrof_threads = nrof_threads
     self.__t_threads_stopper = t_threads_stopper
-    self.__t_event = threading.Event()
 
-    # Bookkeeping for throttling read rate
-    self.__lastreadtime = 0
+    # Protects __set_counter, __cycle and __stopped; notified on trigger, barrier release and stop
+    self.__condition = threading.Condition()
+
+    # Read cycle sequence number; incremented when timer has shot
+    self.__cycle = 0
+
+    # Set when timer has stopped; wakes up waiting workers
+    self.__stopped = False
+
+    # Bookkeeping for throttling read rate (monotonic clock)
     self.__interval = 3600/read_rate
+    self.__deadline = 0
+    self.__stretch = stretch
+    self.__on_cycle_end = on_cycle_end
 
     # Measure time between Set and Release
     self.__triggertime = 0
 
-    # ReadRateTimer flag will be set when timer has shot
+    # Countdown barrier; nrof threads which still have to release current cycle
     self.__set_counter = 0
 
     # timestamp for MQTT
@@ -66,27 +97,43 @@ class ReadRateTimer(threading.Thread):
     logger.debug("<<")
     return
 
-  # threading.Event methods
-  def wait(self, timeout=None):
-    return self.__t_event.wait(timeout)
+  def wait_next(self, cycle, timeout=None):
+    """
+    Block till the timer has shot for a cycle later than cycle, or till timer has stopped
+
+    Args:
+      :param int cycle: last cycle handled by caller; 0 at start
+      :param float timeout: max seconds to wait; None is wait forever
 
-  def is_set(self):
-    return self.__t_event.is_set()
+    Returns:
+      :rtype: int
+      :return: new cycle (caller has to release() it); cycle on timeout; None when timer has stopped
+    """
+    with self.__condition:
+      self.__condition.wait_for(lambda: self.__cycle != cycle or self.__stopped, timeout)
+      if self.__cycle != cycle:
+        return self.__cycle
+      if self.__stopped:
+        return None
+      return cycle
 
   def release(self, name):
-    logger.debug(f">> name = {name}; set_counter = {self.__set_counter}")
+    logger.debug(">> name = %s", name)
+
+    with self.__condition:
+      if self.__set_counter <= 0:
+        logger.error(f"set_counter <= 0; this should not happen")
+        return
 
-    if self.__set_counter <= 0:
-      logger.error(f"set_counter <= 0; this should not happen")
-    else:
       # decrement counter
       self.__set_counter += -1
+      logger.debug("Updated set_counter = %s", self.__set_counter)
 
-    logger.debug(f"Updated set_counter = {self.__set_counter}")
-
-    if self.__set_counter == 0:
-      self.__t_event.clear()
-      logger.info(f"Read time elapsed = {round(time.time() - self.__triggertime, 2)} seconds")
+      if self.__set_counter == 0:
+        elapsed = time.monotonic() - self.__triggertime
+        metrics.observe("mbus_burst_seconds", elapsed)
+        logger.info(f"Read time elapsed = {round(elapsed, 2)} seconds")
+        self.__condition.notify_all()
 
   def timestamp(self):
     logger.debug(">>")
@@ -101,50 +148,60 @@ class ReadRateTimer(threading.Thread):
   def run(self):
     """
       - Exit when __stopper is set
-      - Wait till read_rate delay has been exceeded
+      - Wait till read_rate deadline; trigger cycle; wait till all threads have released cycle
 
     :return:
     """
     logger.debug(">>")
 
-    while not self.__t_threads_stopper.is_set():
-      # Wait based on READ_RATE
-      while not self.__t_threads_stopper.is_set() and not self.__t_event.is_set():
-        t_elapsed = int(time.time()) - self.__lastreadtime
+    # First cycle is triggered immediately
+    self.__deadline = time.monotonic()
 
-        if t_elapsed > self.__interval:
-          logger.debug(f"Read Rate has exceeded wait threshold")
-          # Read Rate has exceeded wait threshold;
-          # Store current time for next wait cycle
-          self.__lastreadtime = int(time.time())
+    # Wait based on READ_RATE; wakes up immediately when stopper is set
+    while not self.__t_threads_stopper.wait(max(0.0, self.__deadline - time.monotonic())):
+      with self.__condition:
+        # Store epoch, MQTT timestamp for all threads
+        self.__ts = int(time.time())
 
-          # Store epoch, MQTT timestamp for all threads
-          self.__ts = int(time.time())
+        # reset countdown barrier to subscribed threads
+        self.__set_counter = self.__nrof_threads
 
-          # reset tracking counter to subscribed threads
-          self.__set_counter = self.__nrof_threads
+        # Trigger cycle (timer has shot)
+        logger.debug("Cycle %s triggered", self.__cycle + 1)
+        self.__triggertime = time.monotonic()
+        self.__cycle += 1
+        self.__condition.notify_all()
 
-          # Set status (timer has shot)
-          logger.debug(f"Flag set")
-          self.__triggertime = time.time()
-          self.__t_event.set()
+        # Wait till all threads have released the cycle
+        # Workers release a triggered cycle, also when stopping; do not wait for a worker which has stopped anyway
+        while not self.__condition.wait_for(lambda: self.__set_counter == 0, BARRIER_STOP_CHECK):
+          if self.__t_threads_stopper.is_set():
+            break
 
-          # Break from inner while loop
+        # Stopped while a worker did not release the cycle; cycle has not ended
+        if self.__set_counter != 0:
           break
 
-        else:
-          # if all threads have executed their task, clear flag
-          if self.__set_counter == 0:
-
-            # Reset status
-            # This can be done without if statement, but that will pollute the debug messages
-            if self.is_set():
-              self.__t_event.clear()
-              logger.info(f"Read time elapsed = {round(time.time() - self.__triggertime, 2)} seconds")
-          else:
-            # wait a bit
-            time.sleep(0.2)
-            logger.debug(f"Wait to satisfy READ_RATE")
+      if self.__on_cycle_end:
+        try:
+          self.__on_cycle_end(self.__ts)
+        except Exception as e:
+          logger.error(f"on_cycle_end: {e}")
+
+      # Interval is stretched when bus is overloaded
+      interval = self.__interval * (self.__stretch() if self.__stretch else 1.0)
+
+      # Next deadline is fixed to the interval grid; skip deadlines missed by a slow cycle
+      self.__deadline += interval
+      now = time.monotonic()
+      if self.__deadline < now:
+        logger.debug("Cycle exceeded READ_RATE interval by %s seconds", round(now - self.__deadline, 2))
+        self.__deadline += math.ceil((now - self.__deadline) / interval) * interval
+
+    # Wake up workers waiting for next cycle
+    with self.__condition:
+      self.__stopped = True
+      self.__condition.notify_all()
 
     logger.debug("<<")
     return
@@ -0,0 +1,267 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Capture raw MBUS transactions (bytes written and read per device read) to an append-only file (CAPTURE_FILE)
+- Replay a capture file through the decode and publish pipeline (kamstrup-mqtt.py --replay)
+
+Capture file format (little endian):
+- Header: MAGIC
+- Record: wall time (double), monotonic time (double), len(name) (uint8), len(tx) (uint16), len(rx) (uint16),
+          followed by name (utf-8), tx bytes (requests) and rx bytes (responses)
+"""
+
+import struct
+import threading
+import time
+
+# Local imports
+import kamstrup_decode
+
+# Logging
+import __main__
+import logging
+import os
+
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+MAGIC = b"KMCAP\x01"
+RECORD = struct.Struct("<ddBHH")
+
+# Single character acknowledge (response to SND_NKE)
+ACK = 0xE5
+
+
+class CaptureWriter:
+  """
+  Append transactions to capture file; shared by all devices (thread safe)
+  """
+  def __init__(self, path):
+    """
+    Args:
+      :param str path: capture file; created when it does not exist
+
+    Returns:
+      None
+    """
+    logger.debug(f">> path = {path}")
+    self.__path = path
+    self.__lock = threading.Lock()
+    self.__file = open(path, "ab")
+
+    if self.__file.tell() == 0:
+      self.__file.write(MAGIC)
+
+    logger.info(f"Capturing MBUS transactions to {path}")
+    logger.debug("<<")
+    return
+
+  def write(self, name, tx, rx):
+    """
+    Append one transaction
+
+    :param str name: device name
+    :param bytes tx: bytes written to MBUS
+    :param bytes rx: bytes read from MBUS
+    :return: None
+    """
+    name = name.encode("utf-8")
+    record = RECORD.pack(time.time(), time.monotonic(), len(name), len(tx), len(rx)) + name + tx + rx
+
+    with self.__lock:
+      self.__file.write(record)
+      self.__file.flush()
+
+  def close(self):
+    with self.__lock:
+      self.__file.close()
+
+
+class CaptureSerial:
+  """
+  Wrap serial.Serial; keep copy of all bytes written and read during one transaction
+  """
+  def __init__(self, ser):
+    self.__ser = ser
+    self.tx = bytearray()
+    self.rx = bytearray()
+
+  def write(self, data):
+    self.tx += data
+    return self.__ser.write(data)
+
+  def read(self, size=1):
+    data = self.__ser.read(size)
+    self.rx += data
+    return data
+
+  def __getattr__(self, name):
+    return getattr(self.__ser, name)
+
+
+def read_capture(path):
+  """
+  Read capture file
+
+  :param str path:
+  :return: generator of (wall time, monotonic time, name, tx, rx)
+  :raises ValueError: when file is not a capture file
+  """
+  with open(path, "rb") as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f"{path} is not a capture file")
+
+    while True:
+      header = f.read(RECORD.size)
+      if len(header) < RECORD.size:
+        # End of file; a truncated last record (eg power loss during write) is ignored
+        return
+
+      wall, mono, len_name, len_tx, len_rx = RECORD.unpack(header)
+      body = f.read(len_name + len_tx + len_rx)
+      if len(body) < len_name + len_tx + len_rx:
+        return
+
+      yield wall, mono, body[:len_name].decode("utf-8"), body[len_name:len_name + len_tx], body[len_name + len_tx:]
+
+
+def response_frames(rx):
+  """
+  Long frames in bytes read during a transaction (ACKs are skipped)
+  More than one frame for a multi telegram readout
+
+  :param bytes rx:
+  :return: raw long frames, till first invalid frame
+  :rtype: list
+  """
+  frames = list()
+  i = 0
+  while i < len(rx):
+    if rx[i] == ACK:
+      i += 1
+    elif rx[i] == kamstrup_decode.FRAME_START and i + 1 < len(rx):
+      data = bytes(rx[i:i + rx[i + 1] + 6])
+      if not kamstrup_decode.is_long_frame(data):
+        break
+
+      frames.append(data)
+      i += len(data)
+    else:
+      break
+
+  return frames
+
+
+class TaskReplay(threading.Thread):
+  """
+  Replay capture file through HeatMeter decode and publish
+  In aggregate mode, a burst ends when a device of the READ_RATE burst is read again
+  """
+  def __init__(self, path, heatmeters, speed, t_threads_stopper, aggregator=None):
+    """
+    Args:
+      :param str path: capture file
+      :param dict heatmeters: name:kamstrup_mbus.HeatMeter
+      :param float speed: 1 is real time, 10 is ten times faster; 0 is as fast as possible
+      :param threading.Event t_threads_stopper:
+      :param aggregate.BurstAggregator aggregator: MQTT_AGGREGATE; None is not aggregated
+
+    Returns:
+      None
+    """
+    logger.debug(f">> path = {path}; speed = {speed}")
+    super().__init__()
+    self.__path = path
+    self.__heatmeters = heatmeters
+    self.__speed = speed
+    self.__t_threads_stopper = t_threads_stopper
+    self.__aggregator = aggregator
+
+    # Names of burst devices replayed in current burst, and timestamp of burst
+    self.__burst = set()
+    self.__burst_ts = None
+
+    logger.debug("<<")
+    return
+
+  def __burst_read(self, heatmeter, ts):
+    """
+    Publish aggregated burst when heatmeter starts a new burst
+
+    :param kamstrup_mbus.HeatMeter heatmeter: device about to be replayed
+    :param int ts: timestamp of replayed read
+    :return: None
+    """
+    # Free running devices are not part of a burst
+    if self.__aggregator is None or heatmeter.interval is not None:
+      return
+
+    if heatmeter.name in self.__burst:
+      self.__publish_burst()
+
+    if not self.__burst:
+      self.__burst_ts = ts
+    self.__burst.add(heatmeter.name)
+
+  def __publish_burst(self):
+    if self.__burst:
+      self.__aggregator.publish(self.__burst_ts)
+      self.__burst = set()
+
+  def run(self):
+    logger.debug(">>")
+
+    counter = 0
+    t_start = time.monotonic()
+    try:
+      # Time of capture of previous record, and time it was replayed
+      prev_wall = prev_mono = None
+      t_replay = t_start
+
+      for wall, mono, name, tx, rx in read_capture(self.__path):
+        if self.__t_threads_stopper.is_set():
+          break
+
+        heatmeter = self.__heatmeters.get(name)
+        if heatmeter is None:
+          logger.debug("%s: Not configured; skipped", name)
+          continue
+
+        if self.__speed and prev_mono is not None:
+          # Monotonic time is not valid between two runs of the parser; use wall time instead
+          delta = mono - prev_mono if mono >= prev_mono else wall - prev_wall
+          t_replay += max(0.0, delta) / self.__speed
+          if self.__t_threads_stopper.wait(max(0.0, t_replay - time.monotonic())):
+            break
+
+        prev_wall, prev_mono = wall, mono
+        self.__burst_read(heatmeter, int(wall))
+        heatmeter.replay(int(wall), response_frames(rx))
+        counter += 1
+
+      # Last burst
+      self.__publish_burst()
+
+    except Exception as e:
+      logger.error(f"{self.__path}: {e}")
+      self.__t_threads_stopper.set()
+
+    t_elapsed = time.monotonic() - t_start
+    logger.info(f"Replayed {counter} telegrams in {round(t_elapsed, 2)} seconds "
+                f"({round(counter / t_elapsed if t_elapsed else 0)} telegrams/second)")
+    logger.debug("<<")
+    return
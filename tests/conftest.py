@@ -0,0 +1,18 @@
+"""
+Tests run without MBUS hardware or MQTT broker: python -m pytest -q
+The parser modules import config; config.rename.py is used as config
+"""
+
+import importlib.util
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'tools'))
+sys.path.insert(0, root)
+
+if "config" not in sys.modules:
+  spec = importlib.util.spec_from_file_location("config", os.path.join(root, 'config.rename.py'))
+  config = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(config)
+  sys.modules["config"] = config
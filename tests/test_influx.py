@@ -0,0 +1,39 @@
+import re
+
+import influx
+import kamstrup_decode
+import kamstrup_sim
+import meterbus
+
+
+def field_types(line):
+  """key:type of the fields of a line; type is the line protocol suffix ("i", "u", '"') or "" for float"""
+  fields = line.split(" ")[1]
+  return {key: re.sub(r"[0-9.e+-]", "", value) for key, value in (field.split("=") for field in fields.split(","))}
+
+
+def test_untyped_number_keeps_type():
+  writer = influx.LineProtocolWriter("stdout", "kamstrup")
+  line_int = writer.line("kamstrup/MC303", {"VOLUME": 70, "timestamp": 1})
+  line_float = writer.line("kamstrup/MC303", {"VOLUME": 69.66, "timestamp": 2})
+
+  assert field_types(line_int) == field_types(line_float) == {"VOLUME": ""}
+
+
+def test_configured_types():
+  writer = influx.LineProtocolWriter("stdout", "kamstrup", {"ENERGY_WH": "uint", "COUNT": "int"})
+  line = writer.line("kamstrup/MC303", {"ENERGY_WH": 70000.0, "COUNT": 3, "NAME": "x", "timestamp": 1})
+
+  assert field_types(line) == {"COUNT": "i", "ENERGY_WH": "u", "NAME": '"x"'}
+
+
+def test_decoded_telegrams_keep_types():
+  # Whole numbers are decoded as int (eg VOLUME of telegram 34); field types may not change between reads
+  writer = influx.LineProtocolWriter("stdout", "kamstrup")
+  types = list()
+  for n in (0, 34):
+    values = {"timestamp": 1}
+    kamstrup_decode.decode_records(meterbus.load(kamstrup_sim.telegram("MC303", 11, n)).records, values)
+    types.append(field_types(writer.line("kamstrup/MC303", values)))
+
+  assert types[0] == types[1]
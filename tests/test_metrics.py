@@ -0,0 +1,48 @@
+import json
+import threading
+import time
+
+import metrics
+
+
+class BrokerStandIn:
+  def __init__(self, failures):
+    self.failures = failures
+    self.publishes = list()
+
+  def do_publish(self, topic, message, retain=False):
+    if self.failures:
+      self.failures -= 1
+      raise ConnectionError("publish failed")
+    self.publishes.append((topic, message))
+
+
+def test_export_continues_after_errors():
+  def failing_collector():
+    raise RuntimeError("collector failed")
+
+  metrics.REGISTRY.add_collector(failing_collector)
+
+  encodings = list()
+
+  def encode(document):
+    encodings.append(document)
+    if len(encodings) == 1:
+      raise ValueError("encoding failed")
+    return json.dumps(document)
+
+  broker = BrokerStandIn(failures=1)
+  stopper = threading.Event()
+  task = metrics.TaskMetrics(broker, "kamstrup/metrics", 0.01, None, stopper, encode)
+  task.start()
+
+  # First export fails encoding, second fails publishing; later exports are published
+  deadline = time.monotonic() + 5
+  while not broker.publishes and time.monotonic() < deadline:
+    time.sleep(0.01)
+  stopper.set()
+  task.join()
+
+  assert broker.publishes
+  assert broker.publishes[0][0] == "kamstrup/metrics"
+  assert len(encodings) >= 3
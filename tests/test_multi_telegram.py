@@ -0,0 +1,62 @@
+import kamstrup_mbus
+import kamstrup_sim
+
+
+class SessionStandIn:
+  """MBusSession on a kamstrup_sim.FakeSerial"""
+  def __init__(self, ser):
+    self.ser = ser
+
+  def serial(self):
+    return self.ser
+
+  def io_ok(self):
+    pass
+
+  def io_error(self, e):
+    raise AssertionError(f"Unexpected I/O error {e}")
+
+
+class BrokerStandIn:
+  def __init__(self):
+    self.publishes = list()
+
+  def do_publish(self, topic, message, retain=False):
+    self.publishes.append((topic, message))
+
+
+def test_readout_not_merged_when_telegram_fails(monkeypatch):
+  meter = kamstrup_sim.Meter(11, 'MC303', nrof_telegrams=3)
+  ser = kamstrup_sim.FakeSerial(kamstrup_sim.MBusSlaves([meter]))
+  broker = BrokerStandIn()
+  heatmeter = kamstrup_mbus.HeatMeter("MC303", 11, SessionStandIn(ser), broker, max_telegrams=3)
+  values = heatmeter._HeatMeter__json_values
+
+  heatmeter.publish(heatmeter.read(1))
+  assert ("kamstrup/MC303/status", "power on") in broker.publishes
+  published = dict(values)
+
+  # Second telegram of next readout cannot be decoded
+  decode = kamstrup_mbus.HeatMeter._HeatMeter__decode
+
+  def failing_decode(self, data, index=0):
+    if index == 1:
+      raise ValueError("Cannot decode record")
+    decode(self, data, index)
+
+  monkeypatch.setattr(kamstrup_mbus.HeatMeter, "_HeatMeter__decode", failing_decode)
+  broker.publishes.clear()
+  heatmeter.publish(heatmeter.read(2))
+
+  # All telegrams were read (no retry), no value of the readout is merged or published
+  assert meter.access == 6
+  assert {key: value for key, value in values.items() if key != "timestamp"} == \
+         {key: value for key, value in published.items() if key != "timestamp"}
+  assert broker.publishes == [("kamstrup/MC303/status", "power off")]
+
+  # Next readout is decoded and published again
+  monkeypatch.undo()
+  broker.publishes.clear()
+  heatmeter.publish(heatmeter.read(3))
+  assert values != published
+  assert broker.publishes[0][0] == "kamstrup/MC303"
@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+"""
+Benchmark decode, publish, scheduling and read cycle of kamstrup-mqtt
+
+Runs without MBUS hardware or MQTT broker:
+- Synthetic Multical 303/601 telegrams (tools/kamstrup_sim.py)
+- Fake serial port with simulated meters (kamstrup_sim.FakeSerial)
+- Broker stand-in recording publishes instead of sending them
+
+Results are written as JSON (stdout or --output), to track regressions across versions
+
+Usage: tools/kamstrup-benchmark.py [-o results.json] [-n 2000] [--meters 10] [--cycles 20]
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import sys
+import threading
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root)
+
+
+def load_config(path):
+    """Make configuration importable as module config, as used by the parser modules"""
+    spec = importlib.util.spec_from_file_location("config", path)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules["config"] = config
+
+    # Older config.py; missing settings get their default
+    import config_defaults
+    config_defaults.apply(config)
+    return config
+
+
+def version():
+    with open(os.path.join(root, 'kamstrup-mqtt.py')) as f:
+        match = re.search(r'^__version__ = "(.*)"', f.read(), re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def stats(samples, scale=1e6):
+    """Summary of samples (seconds), scaled (default: microseconds)"""
+    samples = sorted(samples)
+    return {'n': len(samples),
+            'min': round(samples[0] * scale, 3),
+            'median': round(statistics.median(samples) * scale, 3),
+            'mean': round(statistics.fmean(samples) * scale, 3),
+            'p99': round(samples[min(len(samples) - 1, int(0.99 * len(samples)))] * scale, 3),
+            'max': round(samples[-1] * scale, 3)}
+
+
+def timed(function, n):
+    samples = list()
+    for i in range(n):
+        t = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+class BrokerStandIn:
+    """Stand-in for mqtt.MQTTClient; records publishes"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.publishes = list()
+        self.bytes = 0
+
+    def do_publish(self, topic, message, retain=False):
+        with self.lock:
+            self.publishes.append((time.monotonic(), topic))
+            self.bytes += len(topic) + len(message)
+
+    def set_status(self, topic, status, retain=False):
+        self.do_publish(topic, status, retain)
+
+
+def bench_decode(n):
+    """Per telegram decode time: layout cache and full meterbus parser"""
+    results = dict()
+    for model in kamstrup_sim.MODELS:
+        data = kamstrup_sim.telegram(model, 11, 1)
+
+        cache = kamstrup_decode.TelegramLayoutCache(model)
+        cache.learn(data, meterbus.load(data))
+
+        def decode_cached():
+            values = dict()
+            assert cache.decode(data, values)
+
+        def decode_meterbus():
+            values = dict()
+            kamstrup_decode.decode_records(meterbus.load(data).records, values)
+
+        results[model] = {'frame_length': len(data),
+                          'layout_cache_us': stats(timed(decode_cached, n)),
+                          'meterbus_us': stats(timed(decode_meterbus, max(1, n // 10)))}
+    return results
+
+
+def bench_publish(n):
+    """Cost of publishing a decoded telegram (json.dumps(sort_keys=True) and do_publish)"""
+    results = dict()
+    for model in kamstrup_sim.MODELS:
+        broker = BrokerStandIn()
+        heatmeter = kamstrup.HeatMeter(model, 11, None, broker)
+        heatmeter.replay(int(time.time()), [kamstrup_sim.telegram(model, 11, 1)])
+
+        # Decode errors are only logged; do not report numbers of the error path
+        value_topic = (cfg.MQTT_TOPIC_PREFIX + "/" + model).replace('//', '/')
+        if value_topic not in (topic for _t, topic in broker.publishes):
+            raise RuntimeError(f"{model}: telegram was not decoded and published")
+
+        # Private method; measured without decode
+        publish_telegram = heatmeter._HeatMeter__publish_telegram
+        data = kamstrup_sim.telegram(model, 11, 2)
+        results[model] = {'publish_telegram_us': stats(timed(publish_telegram, n)),
+                          'decode_and_publish_us': stats(timed(lambda: heatmeter.publish(data), n)),
+                          'bytes_per_publish': broker.bytes // len(broker.publishes)}
+    return results
+
+
+def bench_timer(cycles, interval):
+    """ReadRateTimer jitter: time between deadline and worker wakeup"""
+    stopper = threading.Event()
+    timer = sample_rate.ReadRateTimer(3600 / interval, 1, stopper)
+    wakeups = list()
+
+    def worker():
+        cycle = 0
+        while True:
+            cycle = timer.wait_next(cycle)
+            if cycle is None:
+                return
+            wakeups.append(time.monotonic())
+            timer.release("benchmark")
+            if len(wakeups) >= cycles:
+                stopper.set()
+
+    t_worker = threading.Thread(target=worker)
+    t_worker.start()
+    timer.start()
+    t_worker.join()
+    timer.join()
+
+    jitter = [abs(t - (wakeups[0] + i * interval)) for i, t in enumerate(wakeups)]
+    return {'interval_s': interval, 'jitter_ms': stats(jitter, 1e3)}
+
+
+def bench_cycle(nrof_meters, cycles, interval, baudrate):
+    """End-to-end read cycle: trigger, read all meters on one bus, decode and publish"""
+    class FakeMBusSession(mbus_session.MBusSession):
+        """MBusSession on a kamstrup_sim.FakeSerial instead of a serial port"""
+        def __init__(self, fake_serial):
+            super().__init__("fake", 2400, 8, 'E', 1)
+            self.fake_serial = fake_serial
+
+        def serial(self):
+            self.fake_serial.reset_input_buffer()
+            return self.fake_serial
+
+    meters = [kamstrup_sim.Meter(address, model)
+              for address, model in zip(range(1, nrof_meters + 1), ['MC303', 'MC601'] * nrof_meters)]
+    fake_serial = kamstrup_sim.FakeSerial(kamstrup_sim.MBusSlaves(meters), baudrate)
+    session = FakeMBusSession(fake_serial)
+    broker = BrokerStandIn()
+    stopper = threading.Event()
+
+    heatmeters = [kamstrup.HeatMeter(f"meter{meter.address}", meter.address, session, broker) for meter in meters]
+    timer = sample_rate.ReadRateTimer(3600 / interval, nrof_meters, stopper)
+    worker = kamstrup.TaskReadMBus("bench", session, heatmeters, timer, stopper)
+
+    # Cycle has ended when every meter has published its values
+    # Status and counter are not published every read; only value topics are counted
+    value_topics = {(cfg.MQTT_TOPIC_PREFIX + "/" + heatmeter.name).replace('//', '/') for heatmeter in heatmeters}
+
+    def value_publishes():
+        with broker.lock:
+            return [t for t, topic in broker.publishes if topic in value_topics]
+
+    t_start = time.monotonic()
+    timer.start()
+    worker.start()
+    while len(value_publishes()) < cycles * nrof_meters and worker.is_alive():
+        time.sleep(0.01)
+    stopper.set()
+    worker.join()
+    timer.join()
+    t_elapsed = time.monotonic() - t_start
+
+    publishes = value_publishes()
+    ends = [publishes[(i + 1) * nrof_meters - 1] for i in range(cycles)]
+    starts = [t_start + i * interval for i in range(cycles)]
+    return {'meters': nrof_meters,
+            'baudrate': baudrate,
+            'interval_s': interval,
+            'cycle_latency_ms': stats([end - start for start, end in zip(starts, ends)], 1e3),
+            'telegrams_per_second': round(cycles * nrof_meters / t_elapsed, 1),
+            'bus_busy_s': round(session.busy_time, 3)}
+
+
+if __name__ == '__main__':
+    default_config = os.path.join(root, 'config.py')
+    if not os.path.exists(default_config):
+        default_config = os.path.join(root, 'config.rename.py')
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark kamstrup-mqtt decode, publish, scheduling and read cycle.')
+    parser.add_argument('-c', '--config',
+                        type=str, default=default_config,
+                        help='Configuration file (default: config.py, else config.rename.py)')
+    parser.add_argument('-o', '--output',
+                        type=str, default=None,
+                        help='Write JSON results to file instead of stdout')
+    parser.add_argument('-n', '--iterations',
+                        type=int, default=2000,
+                        help='Iterations of decode and publish benchmarks')
+    parser.add_argument('--meters',
+                        type=int, default=10,
+                        help='Number of simulated meters in read cycle benchmark')
+    parser.add_argument('--cycles',
+                        type=int, default=20,
+                        help='Number of cycles in timer and read cycle benchmarks')
+    parser.add_argument('--interval',
+                        type=float, default=0.2,
+                        help='Interval (seconds) of timer and read cycle benchmarks')
+    parser.add_argument('-b', '--baudrate',
+                        type=int, default=None,
+                        help='Simulate wire delays of this baudrate in read cycle benchmark')
+
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+
+    # Only report errors of the parser modules
+    logging.getLogger(os.path.splitext(os.path.basename(__file__))[0]).setLevel(logging.ERROR)
+
+    import meterbus
+    import kamstrup_decode
+    import kamstrup_mbus as kamstrup
+    import kamstrup_sim
+    import mbus_session
+    import sample_rate
+
+    results = {'version': version(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'timestamp': int(time.time()),
+               'decode': bench_decode(args.iterations),
+               'publish': bench_publish(args.iterations),
+               'timer': bench_timer(args.cycles, args.interval),
+               'cycle': bench_cycle(args.meters, args.cycles, args.interval, args.baudrate)}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
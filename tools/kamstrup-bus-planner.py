@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+"""
+Estimate MBUS bus utilisation of a kamstrup-mqtt configuration
+
+Usage: tools/kamstrup-bus-planner.py [-c config.py] [-f NAME=BYTES ...]
+Exit code is 1 when a bus exceeds MBUS_MAX_UTILISATION
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bus_planner
+import mbus_session
+
+
+def load_config(path):
+    spec = importlib.util.spec_from_file_location("config", path)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    return config
+
+
+if __name__ == '__main__':
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    default_config = os.path.join(root, 'config.py')
+    if not os.path.exists(default_config):
+        default_config = os.path.join(root, 'config.rename.py')
+
+    parser = argparse.ArgumentParser(
+        description='Estimate MBUS bus utilisation of a kamstrup-mqtt configuration.')
+    parser.add_argument('-c', '--config',
+                        type=str, default=default_config,
+                        help='Configuration file (default: config.py, else config.rename.py)')
+    parser.add_argument('-f', '--frame-length',
+                        type=str, action='append', default=[],
+                        help='Observed telegram length of a device, as NAME=BYTES')
+    parser.add_argument('-r', '--read-rate',
+                        type=int, default=None,
+                        help='Override READ_RATE (reads per hour)')
+
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    read_rate = args.read_rate or cfg.READ_RATE
+    max_utilisation = getattr(cfg, 'MBUS_MAX_UTILISATION', 0.8)
+    frame_lengths = dict()
+    for arg in args.frame_length:
+        name, length = arg.split('=')
+        frame_lengths[name] = int(length)
+
+    report = bus_planner.estimate(mbus_session.configured_buses(cfg),
+                                  cfg.MBUS_KAMSTRUP_DEVICES,
+                                  read_rate,
+                                  getattr(cfg, 'MBUS_PING_MODE', "always"),
+                                  frame_lengths)
+
+    print(f"Configuration: {os.path.abspath(args.config)}; READ_RATE = {read_rate}")
+    for line in bus_planner.format_report(report, max_utilisation):
+        print(line)
+
+    if any(r['utilisation'] > max_utilisation for r in report.values()):
+        derated_rate, device_rates = bus_planner.derate(report, read_rate, max_utilisation)
+        print(f"Derated: READ_RATE = {round(derated_rate, 1)}")
+        for name, rate in device_rates.items():
+            print(f"  {name}: read_rate = {round(rate, 1)}")
+        sys.exit(1)
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+"""
+Simulate Kamstrup Multical meters on a MBUS, behind a pseudo-terminal (Linux)
+
+Answers SND_NKE and REQ_UD2 for a range of primary addresses with synthetic Multical 303/601
+telegrams (tools/kamstrup_sim.py). With a baudrate, requests and responses take as long as on the wire
+(11 bits per character) and the meter answers after a response delay.
+
+Point the port of a bus in MBUS_BUSES at the printed (or --link) device to run kamstrup-mqtt.py
+against the simulated meters, eg:
+  tools/kamstrup-mbus-simulator.py --link /tmp/tty-mbus --addresses 1-250 --baudrate 2400
+"""
+
+import argparse
+import os
+import select
+import signal
+import sys
+import termios
+import time
+import tty
+
+import kamstrup_sim
+
+
+def parse_addresses(text):
+    """Parse eg '1-10,20,30-32' into a list of addresses"""
+    addresses = list()
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            addresses += range(int(first), int(last) + 1)
+        else:
+            addresses.append(int(part))
+    return addresses
+
+
+def write_paced(fd, data, baudrate, chunk_time=0.01):
+    """Write data at baudrate, in chunks of about chunk_time seconds"""
+    if not baudrate:
+        os.write(fd, data)
+        return
+
+    chunk = max(1, int(chunk_time * baudrate / kamstrup_sim.BITS_PER_CHAR))
+    t = time.monotonic()
+    for i in range(0, len(data), chunk):
+        os.write(fd, data[i:i + chunk])
+        t += kamstrup_sim.wire_time(len(data[i:i + chunk]), baudrate)
+        time.sleep(max(0.0, t - time.monotonic()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate Kamstrup Multical meters on a MBUS behind a pseudo-terminal.')
+    parser.add_argument('-a', '--addresses',
+                        type=str, default='1',
+                        help='Primary addresses of simulated meters, eg 1-250 or 1,3,5-8')
+    parser.add_argument('-m', '--models',
+                        type=str, default='MC303,MC601',
+                        help='Models, assigned to addresses in turn')
+    parser.add_argument('-b', '--baudrate',
+                        type=int, default=2400,
+                        help='Simulate wire delays of this baudrate; 0 is no delays')
+    parser.add_argument('-t', '--telegrams',
+                        type=int, default=1,
+                        help='Telegrams per readout (more records follow); needs max_telegrams in config')
+    parser.add_argument('-d', '--response-delay',
+                        type=float, default=None,
+                        help='Seconds between end of request and start of response (default: 50 bit times)')
+    parser.add_argument('-l', '--link',
+                        type=str, default=None,
+                        help='Create symlink to pseudo-terminal, eg /tmp/tty-mbus')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print every request')
+
+    args = parser.parse_args()
+
+    models = args.models.split(',')
+    meters = [kamstrup_sim.Meter(address, models[i % len(models)], args.telegrams)
+              for i, address in enumerate(parse_addresses(args.addresses))]
+    slaves = kamstrup_sim.MBusSlaves(meters)
+
+    response_delay = args.response_delay
+    if response_delay is None:
+        response_delay = 50 / args.baudrate if args.baudrate else 0.0
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    attributes = termios.tcgetattr(slave)
+    attributes[3] &= ~termios.ECHO
+    termios.tcsetattr(slave, termios.TCSANOW, attributes)
+    device = os.ttyname(slave)
+
+    if args.link:
+        if os.path.lexists(args.link):
+            os.unlink(args.link)
+        os.symlink(device, args.link)
+
+    print(f"Simulating {len(meters)} meters on {args.link or device} ({device}); "
+          f"baudrate = {args.baudrate}; response delay = {round(response_delay * 1000, 1)} ms", flush=True)
+
+    stopped = False
+
+    def stop(sig, stackframe):
+        global stopped
+        stopped = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    nrof_requests = nrof_responses = nrof_bytes = 0
+    t_start = time.monotonic()
+    try:
+        while not stopped:
+            try:
+                readable, _, _ = select.select([master], [], [], 0.5)
+            except InterruptedError:
+                continue
+            if not readable:
+                continue
+
+            data = os.read(master, 256)
+            nrof_requests += len(data) // kamstrup_sim.SHORT_FRAME_LENGTH
+            if args.baudrate:
+                # Request has been received completely after its wire time
+                time.sleep(kamstrup_sim.wire_time(len(data), args.baudrate))
+
+            for response in slaves.request(data):
+                if args.verbose:
+                    print(f"{data.hex()} -> {len(response)} bytes", flush=True)
+                time.sleep(response_delay)
+                write_paced(master, response, args.baudrate)
+                nrof_responses += 1
+                nrof_bytes += len(response)
+    finally:
+        if args.link and os.path.islink(args.link):
+            os.unlink(args.link)
+
+    t_elapsed = time.monotonic() - t_start
+    print(f"Requests = {nrof_requests}; responses = {nrof_responses}; bytes = {nrof_bytes}; "
+          f"bus load = {round(100 * kamstrup_sim.wire_time(nrof_bytes, args.baudrate or 1) / t_elapsed, 1) if args.baudrate else '-'}%")
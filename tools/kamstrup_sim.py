@@ -0,0 +1,323 @@
+"""
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Description
+-----------
+- Synthetic Kamstrup Multical 303 and 601 telegrams (RSP_UD long frames), see kamstrup_decode.py
+- Simulated MBUS slave (Meter) answering SND_NKE and REQ_UD2
+  Optionally records are sent in more than one telegram (more records follow, DIF 0x1F); the next telegram
+  is sent when FCB is toggled, the previous telegram is repeated otherwise; SND_NKE restarts the readout
+- FakeSerial: serial.Serial stand-in with simulated meters behind it, optionally with wire delays
+Used by tools/kamstrup-benchmark.py and tools/kamstrup-mbus-simulator.py; not used by the parser
+"""
+
+import threading
+import time
+
+BITS_PER_CHAR = 11
+
+# MBUS control fields
+C_SND_NKE = 0x40
+C_REQ_UD2 = (0x5B, 0x7B)
+C_FCB = 0x20
+ACK = b"\xE5"
+
+# Last record of a telegram when more records follow in next telegram
+MORE_RECORDS_FOLLOW = [0x1F]
+
+# Short frame: start, C, A, checksum, stop
+SHORT_FRAME_START = 0x10
+SHORT_FRAME_LENGTH = 5
+
+
+def _i32(v):
+  return list((v & 0xFFFFFFFF).to_bytes(4, 'little'))
+
+
+def _i16(v):
+  return list((v & 0xFFFF).to_bytes(2, 'little'))
+
+
+def mc303_records(n):
+  """
+  Records of a Multical 303 telegram; values change with n, layout does not
+
+  :param int n: access number
+  :return: list of records (list of bytes)
+  """
+  return [
+    [0x04, 0x06] + _i32(70 + n // 10),             # ENERGY_WH (kWh)
+    [0x04, 0x14] + _i32(6966 + n),                 # VOLUME
+    [0x04, 0xFF, 0x07] + _i32(2125 + n),           # MANUFACTURER_SPEC
+    [0x04, 0xFF, 0x08] + _i32(2166 + n),           # MANUFACTURER_SPEC
+    [0x04, 0x22] + _i32(4455 + n // 60),           # ON_TIME (hours)
+    [0x34, 0x22] + _i32(26),                       # ON_TIME (error)
+    [0x02, 0x59] + _i16(3156 + n % 7),             # FLOW_TEMPERATURE
+    [0x02, 0x5D] + _i16(3033 + n % 5),             # RETURN_TEMPERATURE
+    [0x02, 0x61] + _i16(123 + n % 7 - n % 5),      # TEMPERATURE_DIFFERENCE
+    [0x04, 0x2D] + _i32(21 + n % 3),               # POWER_W
+    [0x14, 0x2D] + _i32(-100),                     # POWER_W (max)
+    [0x04, 0x3B] + _i32(1299 + n % 11),            # VOLUME_FLOW
+    [0x14, 0x3B] + _i32(1584),                     # VOLUME_FLOW (max)
+    [0x04, 0xFF, 0x22] + _i32(0),                  # MANUFACTURER_SPEC (info)
+    [0x44, 0x06] + _i32(0),                        # storage 1
+    [0x44, 0x14] + _i32(0),
+    [0x44, 0xFF, 0x07] + _i32(0),
+    [0x44, 0xFF, 0x08] + _i32(0),
+    [0x54, 0x2D] + _i32(0),
+    [0x54, 0x3B] + _i32(0),
+    [0x42, 0x6C] + [0x01, 0x31],                   # DATE
+  ]
+
+
+def mc601_records(n):
+  """
+  Records of a Multical 601 telegram, including device (d) and tariff (t) subunits
+
+  :param int n: access number
+  :return: list of records (list of bytes)
+  """
+  return [
+    [0x04, 0x06] + _i32(1234 + n // 10),           # ENERGY_WH (kWh)
+    [0x04, 0x14] + _i32(5678 + n),                 # VOLUME
+    [0x84, 0x10, 0x06] + _i32(11),                 # ENERGY_WH_d0_t1
+    [0x84, 0x20, 0x06] + _i32(12),                 # ENERGY_WH_d0_t2
+    [0x84, 0x40, 0x14] + _i32(13),                 # VOLUME_d1_t0
+    [0x84, 0x80, 0x40, 0x14] + _i32(14),           # VOLUME_d2_t0
+    [0x84, 0xC0, 0x40, 0x06] + _i32(15),           # ENERGY_WH_d3_t0
+    [0x02, 0x59] + _i16(2012 + n % 7),             # FLOW_TEMPERATURE
+    [0x02, 0x5D] + _i16(1987 + n % 5),             # RETURN_TEMPERATURE
+    [0x04, 0x2D] + _i32(n % 3),                    # POWER_W
+    [0x0C, 0x78] + [0x78, 0x56, 0x34, 0x12],       # FABRICATION_NO
+    [0x04, 0x6D] + [0x1E, 0x0C, 0x01, 0x31],       # DATE_TIME
+  ]
+
+
+MODELS = {
+  'MC303': mc303_records,
+  'MC601': mc601_records,
+}
+
+
+def long_frame(address, records, id_nr=12345678, access=0):
+  """
+  RSP_UD long frame with variable data structure (CI = 0x72)
+
+  :param int address: primary address
+  :param list records: list of records (list of bytes)
+  :param int id_nr: identification number (BCD)
+  :param int access: access number
+  :return: raw long frame
+  :rtype: bytes
+  """
+  body = [0x72]
+  body += [int(str(id_nr).zfill(8)[i:i + 2], 16) for i in (6, 4, 2, 0)]
+  body += [0x2D, 0x2C, 0x1B, 0x04, access & 0xFF, 0x00, 0x00, 0x00]
+  for record in records:
+    body += record
+
+  user = [0x08, address] + body
+  return bytes([0x68, len(user), len(user), 0x68] + user + [sum(user) & 0xFF, 0x16])
+
+
+def telegram(model, address, n=0):
+  """
+  :param str model: 'MC303' or 'MC601'
+  :param int address: primary address
+  :param int n: access number; values change with n
+  :return: raw long frame
+  :rtype: bytes
+  """
+  return long_frame(address, MODELS[model](n), id_nr=10000000 + address, access=n)
+
+
+def telegrams(model, address, n=0, count=1):
+  """
+  Records of one readout split over count telegrams; all but the last telegram end with DIF 0x1F
+
+  :param str model: 'MC303' or 'MC601'
+  :param int address: primary address
+  :param int n: access number of first telegram; values change with n
+  :param int count: nrof telegrams
+  :return: raw long frames
+  :rtype: list
+  """
+  records = MODELS[model](n)
+  size = -(-len(records) // count)
+  frames = list()
+  for i in range(count):
+    part = records[i * size:(i + 1) * size]
+    if i < count - 1:
+      part = part + [MORE_RECORDS_FOLLOW]
+    frames.append(long_frame(address, part, id_nr=10000000 + address, access=n + i))
+
+  return frames
+
+
+class Meter:
+  """
+  Simulated MBUS slave with a primary address
+  """
+  def __init__(self, address, model='MC303', nrof_telegrams=1):
+    """
+    :param int address: primary address
+    :param str model: 'MC303' or 'MC601'
+    :param int nrof_telegrams: telegrams per readout
+    """
+    self.address = address
+    self.model = model
+    self.nrof_telegrams = nrof_telegrams
+
+    # Nrof telegrams sent
+    self.access = 0
+
+    # Multi telegram readout: telegrams of current readout, telegram last sent and its FCB
+    self.__readout = None
+    self.__index = 0
+    self.__fcb = None
+
+  def respond(self, c):
+    """
+    :param int c: control field of a short frame addressed to this meter
+    :return: response; None when there is no response
+    :rtype: bytes
+    """
+    if c == C_SND_NKE:
+      self.__readout = None
+      self.__fcb = None
+      return ACK
+
+    if c in C_REQ_UD2 and self.nrof_telegrams > 1:
+      fcb = c & C_FCB
+      if self.__readout is not None and fcb == self.__fcb:
+        # FCB not toggled; repeat telegram
+        return self.__readout[self.__index]
+
+      self.__fcb = fcb
+      if self.__readout is None or self.__index == len(self.__readout) - 1:
+        self.__readout = telegrams(self.model, self.address, self.access + 1, self.nrof_telegrams)
+        self.__index = 0
+      else:
+        self.__index += 1
+
+      self.access += 1
+      return self.__readout[self.__index]
+
+    if c in C_REQ_UD2:
+      self.access += 1
+      return telegram(self.model, self.address, self.access)
+
+    return None
+
+
+class MBusSlaves:
+  """
+  Simulated meters on one MBUS; parses request bytes and returns responses
+  """
+  def __init__(self, meters):
+    """
+    :param list meters: list of Meter
+    """
+    self.meters = {meter.address: meter for meter in meters}
+    self.__buffer = bytearray()
+
+  def request(self, data):
+    """
+    Feed bytes written by master
+
+    :param bytes data:
+    :return: list of responses, one per complete request addressed to a simulated meter
+    """
+    self.__buffer += data
+    responses = list()
+    while len(self.__buffer) >= SHORT_FRAME_LENGTH:
+      if self.__buffer[0] != SHORT_FRAME_START:
+        # Resynchronise on start of next short frame
+        del self.__buffer[0]
+        continue
+
+      c, a = self.__buffer[1], self.__buffer[2]
+      del self.__buffer[:SHORT_FRAME_LENGTH]
+
+      meter = self.meters.get(a)
+      response = meter.respond(c) if meter else None
+      if response:
+        responses.append(response)
+
+    return responses
+
+
+def wire_time(nrof_bytes, baudrate):
+  """
+  :param int nrof_bytes:
+  :param int baudrate:
+  :return: seconds to transmit nrof_bytes
+  :rtype: float
+  """
+  return nrof_bytes * BITS_PER_CHAR / baudrate
+
+
+class FakeSerial:
+  """
+  serial.Serial stand-in with simulated meters (MBusSlaves) behind it
+  With a baudrate, reads take as long as they would on the wire (response delay included)
+  """
+  def __init__(self, slaves, baudrate=None, timeout=0.5):
+    """
+    :param MBusSlaves slaves:
+    :param int baudrate: None is no wire delay
+    :param float timeout: read timeout, when no response is available
+    """
+    self.__slaves = slaves
+    self.__baudrate = baudrate
+    self.timeout = timeout
+    self.__rx = bytearray()
+    self.__lock = threading.Lock()
+
+    # Nrof bytes written and read
+    self.bytes_written = 0
+    self.bytes_read = 0
+
+  def write(self, data):
+    with self.__lock:
+      self.bytes_written += len(data)
+      for response in self.__slaves.request(bytes(data)):
+        self.__rx += response
+
+    if self.__baudrate:
+      time.sleep(wire_time(len(data), self.__baudrate) + 11 / self.__baudrate)
+
+    return len(data)
+
+  def read(self, size=1):
+    with self.__lock:
+      data = bytes(self.__rx[:size])
+      del self.__rx[:size]
+      self.bytes_read += len(data)
+
+    if self.__baudrate:
+      time.sleep(wire_time(len(data), self.__baudrate))
+
+    if len(data) < size and self.timeout:
+      # Nothing more to read; like a serial port, return after timeout
+      time.sleep(self.timeout)
+
+    return data
+
+  def reset_input_buffer(self):
+    with self.__lock:
+      self.__rx.clear()
+
+  def close(self):
+    pass